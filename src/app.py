@@ -117,6 +117,9 @@ async def main():
                 BotCommand("help", f"{emoji.RED_QUESTION_MARK} Help!"),
             ]
         )
+
+        # Resume the tasks interrupted by the last restart
+        await webdav_moduele.restore(app)
         await idle()
 
 
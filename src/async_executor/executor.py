@@ -1,140 +1,260 @@
 import asyncio
 import inspect
 import os
+import time
 import traceback
-from asyncio import events
-from concurrent.futures import Future, ThreadPoolExecutor
+from concurrent.futures import Future
 from threading import Lock
-from typing import Callable
+from typing import Awaitable, Callable, Hashable
 
+from async_executor.loops import LoopPool, run_in_loop
+from async_executor.scheduler import FairShareScheduler
+from async_executor.stats import ClassStats, Histogram
 from async_executor.task import Task, TaskState
 from asyncio.exceptions import CancelledError
 
 
 class TaskExecutor(object):
-    def __init__(self, max_tasks: int = 10, workers: int | None = None) -> None:
+    def __init__(
+        self,
+        max_tasks: int = 10,
+        workers: int | None = None,
+        resource_limits: dict[str, int] | None = None,
+        idle_timeout: float = 60.0,
+        gate: Callable[[], Awaitable[None]] | None = None,
+    ) -> None:
         super().__init__()
+        # Awaited by every task before entering the queues, it holds the
+        # admission (e.g. while the memory is exhausted). The children aren't
+        # held, their parent was admitted and waits for them
+        self._gate = gate
         self.workers = workers or min(32, os.cpu_count())
-        self._executor = ThreadPoolExecutor(
-            max_workers=workers, thread_name_prefix="async_executor"
-        )
-        self._semaphore = asyncio.Semaphore(max_tasks)
+        self._pool = LoopPool(self.workers, idle_timeout=idle_timeout)
+        self._scheduler = FairShareScheduler(max_tasks)
+        self._configured_limits = set()
         self._lock = Lock()
         self._count = 0
         self._active_count = 0
 
-        self._futures = []
-        self._loops = []
-        self._count_tasks = []
-        self._threads_running = 0
+        # Introspection, all guarded by `_lock`
+        self._queued: set[Task] = set()
+        self._running: set[Task] = set()
+        self._admission_wait = Histogram.exponential(0.01, 2, 20)
+        self._classes: dict[str, ClassStats] = dict()
+
+        for resource, limit in (resource_limits or dict()).items():
+            self.set_limit(resource, limit)
+
+    def _record(self, task: Task, elapsed: float) -> None:
+        name = type(task).__name__
+        state, _ = task.state
+        current, _ = task.progress
+        if current is None and len(task._childs_states) > 0:
+            current, _ = task.childs_progress
+
+        with self._lock:
+            stats = self._classes.get(name)
+            if stats is None:
+                stats = self._classes[name] = ClassStats()
+            stats.results[state.name] = stats.results.get(state.name, 0) + 1
+
+        stats.duration.observe(elapsed)
+        if state == TaskState.SUCCESSFULL and current and elapsed > 0:
+            stats.throughput.observe(current / elapsed)
 
-    def _start_loop(self) -> None:
-        loop = events.new_event_loop()
+    async def _run(self, task: Task) -> Task:
+        with self._lock:
+            self._active_count += 1
+        start = time.monotonic()
         try:
-            events.set_event_loop(loop)
-            with self._lock:
-                self._loops.append(loop)
-            loop.run_forever()
+            await task.start()
+            task.set_state(TaskState.SUCCESSFULL)
+        except CancelledError:
+            task.set_state(TaskState.CANCELLED, f"Task cancelled")
+        except Exception as e:
+            task.set_state(TaskState.ERROR, f"`{traceback.format_exc()}`")
         finally:
-            try:
-                loop.run_until_complete(loop.shutdown_asyncgens())
-                loop.run_until_complete(loop.shutdown_default_executor())
-            finally:
-                events.set_event_loop(None)
-                loop.close()
-
-    async def _execute(self, task: Task, index: int) -> tuple[int, Task]:
-        async with self._semaphore:
-            self._active_count += 1
-            try:
-                await task.start()
-                task.set_state(TaskState.SUCCESSFULL)
-            except CancelledError:
-                task.set_state(TaskState.CANCELLED, f"Task cancelled")
-            except Exception as e:
-                task.set_state(TaskState.ERROR, f"`{traceback.format_exc()}`")
-            self._active_count -= 1
+            with self._lock:
+                self._active_count -= 1
+            self._record(task, time.monotonic() - start)
 
-            return (index, task)
+        return task
+
+    async def _execute(self, task: Task, current_thread: bool) -> Task:
+        queued_at = time.monotonic()
+        try:
+            if self._gate is not None and task._parent is None:
+                await self._gate()
+
+            async with self._scheduler.slot(
+                task._key, task._weight, task._priority, task.RESOURCE_CLASS
+            ):
+                self._admission_wait.observe(time.monotonic() - queued_at)
+                with self._lock:
+                    self._queued.discard(task)
+                    self._running.add(task)
+
+                if current_thread:
+                    return await self._run(task)
+
+                # Queued tasks aren't bound to any loop, the least loaded loop
+                # takes the task only once it has been admitted
+                loop = self._pool.acquire()
+                try:
+                    return await run_in_loop(loop, self._run, task)
+                finally:
+                    self._pool.release(loop)
+        except CancelledError:
+            task.set_state(TaskState.CANCELLED, f"Task cancelled")
+            return task
+        finally:
+            with self._lock:
+                self._queued.discard(task)
+                self._running.discard(task)
 
     def shutdown(self, wait: bool = True) -> None:
-        self._executor.shutdown(wait, cancel_futures=True)
-        self._count_tasks = 0
-        self._threads_running = 0
+        self._pool.shutdown(wait)
+
+    def set_weight(self, key: Hashable, weight: float) -> None:
+        self._scheduler.set_weight(key, weight)
+
+    def set_limit(self, resource: str, limit: int) -> None:
+        self._scheduler.set_limit(resource, limit)
+        self._configured_limits.add(resource)
+
+    @property
+    def loops_count(self) -> int:
+        return len(self._pool.loops)
+
+    @property
+    def queued_count(self) -> int:
+        return self._scheduler.queued
+
+    def stats(self) -> dict:
+        """
+        Snapshot of the executor: tasks waiting admission and running by
+        state, running tasks by resource class, admission wait times and the
+        duration/throughput of the finished tasks by class. Thread-safe.
+        """
+        with self._lock:
+            queued = [x.state[0].name for x in self._queued]
+            running = [x.state[0].name for x in self._running]
+            classes = list(self._classes.items())
+
+        def count(states: list[str]) -> dict[str, int]:
+            ret = dict()
+            for state in states:
+                ret[state] = ret.get(state, 0) + 1
+            return ret
+
+        return {
+            "queued": count(queued),
+            "running": count(running),
+            "resources": self._scheduler.running_by_resource(),
+            "limits": self._scheduler.get_limits(),
+            "loops": self.loops_count,
+            "admission_wait": self._admission_wait.snapshot(),
+            "classes": {name: stats.snapshot() for name, stats in classes},
+        }
+
+    def class_stats(self, name: str) -> ClassStats | None:
+        with self._lock:
+            return self._classes.get(name)
+
+    @property
+    def admission_wait(self) -> Histogram:
+        return self._admission_wait
+
+    async def loops_lag(self, timeout: float = 5.0) -> dict[str, float | None]:
+        """
+        Time (seconds) that a callback waits to run in the caller loop and in
+        every worker loop. `None` if the loop didn't answer within `timeout`.
+        """
+
+        async def probe(loop: asyncio.AbstractEventLoop) -> float | None:
+            future = Future()
+            start = time.monotonic()
+
+            def answer():
+                if not future.done():
+                    future.set_result(time.monotonic() - start)
+
+            try:
+                loop.call_soon_threadsafe(answer)
+                return await asyncio.wait_for(asyncio.wrap_future(future), timeout)
+            except (RuntimeError, asyncio.TimeoutError):  # Closed or blocked
+                return None
+
+        loops = [("home", asyncio.get_running_loop())] + [
+            (f"worker-{i}", loop) for i, loop in enumerate(self._pool.loops)
+        ]
+        lags = await asyncio.gather(*(probe(loop) for _, loop in loops))
+        return {name: lag for (name, _), lag in zip(loops, lags)}
 
     @property
     def total_count(self) -> int:
-        return self._count
+        with self._lock:
+            return self._count
 
     @property
     def active_count(self) -> int:
-        return self._active_count
+        with self._lock:
+            return self._active_count
 
     def schedule(
         self,
         task: Task,
         on_end_callback: Callable[[Task], None] = None,
         current_thread: bool = True,
+        key: Hashable = None,
+        weight: float | None = None,
+        priority: int = 0,
     ) -> None:
         if not isinstance(task, Task):
             raise TypeError("the task argument must be a instance from 'Task'")
 
+        # Fair-share admission: `key` selects the queue (usually the user ID)
+        task._key = key
+        task._weight = weight
+        task._priority = priority
+        task._current_thread = current_thread
+
+        # Loop that owns the objects shared by the tasks (e.g. pyrogram client)
+        if task._home_loop is None:
+            task._home_loop = asyncio.get_running_loop()
+
+        # Use the limit declared by the task class unless it was configured
+        resource = task.RESOURCE_CLASS
+        if resource is not None and resource not in self._configured_limits:
+            if task.RESOURCE_LIMIT is not None:
+                self._scheduler.set_limit(resource, task.RESOURCE_LIMIT)
+            self._configured_limits.add(resource)
+
         # WARNING: From here, this tasks has been owned by this executor
         # task: Task = cls(*args, **kwargs)
 
         with self._lock:
             self._count += 1
+            self._queued.add(task)
 
-            if current_thread:
-                future = asyncio.create_task(self._execute(task, -1))
-            else:
-                if self._threads_running >= self.workers:
-                    # Look for minimun-impact thread for run in their loop
-                    u = min(range(self.workers), key=lambda x: self._count_tasks[x])
-                else:
-                    # Append new thread to pool
-                    future = self._executor.submit(self._start_loop)
-                    self._futures.append(future)
-                    self._count_tasks.append(0)
-
-                    u = self._threads_running
-                    self._threads_running += 1
-
-                # Run the coro in the minimun-impact loop
-                future = asyncio.run_coroutine_threadsafe(
-                    self._execute(task, u), loop=self._loops[u]
-                )
-                future = asyncio.wrap_future(future)  # wrap to use with await
-                self._count_tasks[u] += 1
-
-            # assign task future
-            task._future = future
-
-            if future.done():
-                if on_end_callback is not None:
-                    if inspect.iscoroutinefunction(on_end_callback):
-                        asyncio.create_task(on_end_callback(task))
-                    else:
-                        on_end_callback(task)
-                return task
-
-            def at_end(f: Future[tuple[int, Task]]):
-                # Do something with result
-                if f.cancelled():
-                    return
-
-                index, task = f.result()
-                with self._lock:
-                    if index != -1:
-                        self._count_tasks[index] -= 1
+        future = asyncio.create_task(self._execute(task, current_thread))
 
-                    if on_end_callback is not None:
-                        if inspect.iscoroutinefunction(on_end_callback):
-                            asyncio.create_task(on_end_callback(task))
-                        else:
-                            on_end_callback(task)
+        # assign task future
+        task._future = future
+        task._executor = self
+
+        def at_end(f: Future[Task]):
+            # Do something with result
+            if f.cancelled():
+                return
+
+            task = f.result()
+            if on_end_callback is not None:
+                if inspect.iscoroutinefunction(on_end_callback):
+                    asyncio.create_task(on_end_callback(task))
+                else:
+                    on_end_callback(task)
 
-            future.add_done_callback(at_end)
-            task._executor = self
+        future.add_done_callback(at_end)
 
         return task
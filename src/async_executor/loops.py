@@ -0,0 +1,234 @@
+import asyncio
+import inspect
+import time
+import weakref
+from asyncio import events
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+from typing import Any, Callable, Generic, TypeVar
+
+T = TypeVar("T")
+
+# Every LoopLocal alive, used to close the values of a loop when it's stopped
+_LOCALS: "weakref.WeakSet[LoopLocal]" = weakref.WeakSet()
+
+
+class LoopLocal(Generic[T]):
+    """
+    Keep one value per event loop (HTTP connectors, sessions, ...). The value
+    is created lazily in the running loop and finalized when the loop is
+    stopped by the `LoopPool`.
+    """
+
+    def __init__(
+        self,
+        factory: Callable[[], T],
+        finalizer: Callable[[T], Any] | None = None,
+    ) -> None:
+        self._factory = factory
+        self._finalizer = finalizer
+        self._values: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, T]" = (
+            weakref.WeakKeyDictionary()
+        )
+        self._lock = Lock()
+        _LOCALS.add(self)
+
+    def get(self) -> T:
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            value = self._values.get(loop)
+            if value is None:
+                value = self._factory()
+                self._values[loop] = value
+            return value
+
+    async def discard(self, loop: asyncio.AbstractEventLoop) -> None:
+        with self._lock:
+            value = self._values.pop(loop, None)
+
+        if value is None or self._finalizer is None:
+            return
+
+        result = self._finalizer(value)
+        if inspect.isawaitable(result):
+            await result
+
+
+async def _discard_locals(loop: asyncio.AbstractEventLoop) -> None:
+    for local in list(_LOCALS):
+        try:
+            await local.discard(loop)
+        except Exception:
+            pass
+
+
+async def run_in_loop(
+    loop: asyncio.AbstractEventLoop, func: Callable, *args, **kwargs
+) -> Any:
+    """Await the coroutine function `func` inside `loop` from any other loop"""
+    if asyncio.get_running_loop() is loop:
+        return await func(*args, **kwargs)
+
+    future = asyncio.run_coroutine_threadsafe(func(*args, **kwargs), loop=loop)
+    return await asyncio.wrap_future(future)
+
+
+class LoopBridge(object):
+    """
+    Proxy for an object owned by another event loop (e.g. the pyrogram client).
+    Coroutine methods and async generators are executed in the owner loop, any
+    other attribute is returned as is.
+    """
+
+    def __init__(self, obj: Any, loop: asyncio.AbstractEventLoop) -> None:
+        self._obj = obj
+        self._loop = loop
+
+    def __getattr__(self, name: str) -> Any:
+        attr = getattr(self._obj, name)
+        loop = self._loop
+
+        if inspect.isasyncgenfunction(attr):
+
+            async def agen_wrapper(*args, **kwargs):
+                gen = attr(*args, **kwargs)
+
+                async def step():
+                    return await gen.__anext__()
+
+                async def close():
+                    await gen.aclose()
+
+                try:
+                    while True:
+                        try:
+                            yield await run_in_loop(loop, step)
+                        except StopAsyncIteration:
+                            break
+                finally:
+                    await run_in_loop(loop, close)
+
+            return agen_wrapper
+
+        if inspect.iscoroutinefunction(attr):
+
+            async def coro_wrapper(*args, **kwargs):
+                return await run_in_loop(loop, attr, *args, **kwargs)
+
+            return coro_wrapper
+
+        return attr
+
+
+class _LoopState(object):
+    __slots__ = ("loop", "running", "idle_since")
+
+    def __init__(self, loop: asyncio.AbstractEventLoop) -> None:
+        self.loop = loop
+        self.running = 0
+        self.idle_since = time.monotonic()
+
+
+class LoopPool(object):
+    """
+    Event loops running on worker threads. A new loop is started when all the
+    loops are busy (up to `max_loops`) and a loop idle for more than
+    `idle_timeout` seconds is stopped and its thread returned to the pool.
+    """
+
+    def __init__(
+        self, max_loops: int, idle_timeout: float = 60.0, min_loops: int = 0
+    ) -> None:
+        self.max_loops = max_loops
+        self.idle_timeout = idle_timeout
+        self.min_loops = min_loops
+
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_loops, thread_name_prefix="async_executor"
+        )
+        self._lock = Lock()
+        self._states: dict[asyncio.AbstractEventLoop, _LoopState] = dict()
+
+    @property
+    def loops(self) -> list[asyncio.AbstractEventLoop]:
+        with self._lock:
+            return list(self._states.keys())
+
+    def load(self) -> dict[asyncio.AbstractEventLoop, int]:
+        with self._lock:
+            return {loop: state.running for loop, state in self._states.items()}
+
+    def _run_loop(self, loop: asyncio.AbstractEventLoop) -> None:
+        try:
+            events.set_event_loop(loop)
+            loop.run_forever()
+        finally:
+            try:
+                loop.run_until_complete(_discard_locals(loop))
+                loop.run_until_complete(loop.shutdown_asyncgens())
+                loop.run_until_complete(loop.shutdown_default_executor())
+            finally:
+                events.set_event_loop(None)
+                loop.close()
+
+    def _spawn(self) -> _LoopState:
+        # WARNING: Must be called with the lock held
+        loop = events.new_event_loop()
+        state = _LoopState(loop)
+        self._states[loop] = state
+        self._executor.submit(self._run_loop, loop)
+        return state
+
+    def acquire(self) -> asyncio.AbstractEventLoop:
+        """Choose the least loaded loop for a new task"""
+        with self._lock:
+            state = min(self._states.values(), key=lambda x: x.running, default=None)
+
+            if state is None or (
+                state.running > 0 and len(self._states) < self.max_loops
+            ):
+                state = self._spawn()
+
+            state.running += 1
+            return state.loop
+
+    def release(self, loop: asyncio.AbstractEventLoop) -> None:
+        with self._lock:
+            state = self._states.get(loop)
+            if state is None:  # Already stopped
+                return
+
+            state.running -= 1
+            if state.running == 0:
+                state.idle_since = time.monotonic()
+                loop.call_soon_threadsafe(
+                    loop.call_later,
+                    self.idle_timeout,
+                    self._reclaim,
+                    loop,
+                    state.idle_since,
+                )
+
+    def _reclaim(self, loop: asyncio.AbstractEventLoop, idle_since: float) -> None:
+        # Called inside the idle loop, `idle_since` identify the idle period
+        with self._lock:
+            state = self._states.get(loop)
+            if (
+                state is None
+                or state.running > 0
+                or state.idle_since != idle_since
+                or len(self._states) <= self.min_loops
+            ):
+                return
+            self._states.pop(loop)
+
+        loop.stop()
+
+    def shutdown(self, wait: bool = True) -> None:
+        with self._lock:
+            states = list(self._states.values())
+            self._states.clear()
+
+        for state in states:
+            state.loop.call_soon_threadsafe(state.loop.stop)
+        self._executor.shutdown(wait, cancel_futures=True)
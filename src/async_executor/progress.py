@@ -0,0 +1,139 @@
+import time
+
+
+class Progress(object):
+    """
+    Progress of a transfer. The hot path only stores the last point and, at
+    most every `resolution` seconds, a (time, bytes) sample in a ring buffer.
+    The speed (EWMA of the rates between the samples) and the ETA are only
+    computed when somebody reads them.
+
+    WARNING: The updates aren't locked, they rely on the atomic assignments
+    of the interpreter. A reader can get a sample older than the last one.
+    """
+
+    __slots__ = (
+        "size",
+        "resolution",
+        "alpha",
+        "current",
+        "total",
+        "_times",
+        "_points",
+        "_index",
+        "_count",
+        "_last_sample",
+        "_speed_hint",
+        "_eta_hint",
+        "_cache_key",
+        "_cache_speed",
+    )
+
+    def __init__(
+        self, size: int = 32, resolution: float = 0.5, alpha: float = 0.3
+    ) -> None:
+        self.size = size
+        self.resolution = resolution
+        self.alpha = alpha
+
+        self._times = [0.0] * size
+        self._points = [0] * size
+        self.reset()
+
+    def reset(self) -> None:
+        self.current: int | None = None
+        self.total: int | None = None
+        self._index = 0
+        self._count = 0
+        self._last_sample = float("-inf")
+        self._speed_hint: float | None = None
+        self._eta_hint: float | None = None
+        self._cache_key = None
+        self._cache_speed: float | None = None
+
+    def update(
+        self,
+        current: int | None,
+        total: int | None,
+        speed: float | None = None,
+        eta: float | None = None,
+    ) -> None:
+        self.current = current
+        self.total = total
+        self._speed_hint = speed
+        self._eta_hint = eta
+
+        if current is None:
+            return
+
+        # The count went back (a reset or a retry), the old samples would
+        # give a negative rate
+        last = self._points[(self._index - 1) % self.size]
+        if self._count > 0 and current < last:
+            self._index = 0
+            self._count = 0
+            self._cache_key = None
+
+        now = time.monotonic()
+        if now - self._last_sample < self.resolution and self._count > 0:
+            return
+
+        index = self._index
+        self._times[index] = now
+        self._points[index] = current
+        self._index = (index + 1) % self.size
+        self._count += 1
+        self._last_sample = now
+
+    def _samples(self) -> list[tuple[float, int]]:
+        count = min(self._count, self.size)
+        start = (self._index - count) % self.size
+        return [
+            (
+                self._times[(start + i) % self.size],
+                self._points[(start + i) % self.size],
+            )
+            for i in range(count)
+        ]
+
+    @property
+    def speed(self) -> float | None:
+        if self._speed_hint is not None:
+            return self._speed_hint
+
+        now = time.monotonic()
+        key = (self._count, self.current, int(now / self.resolution))
+        if key == self._cache_key:
+            return self._cache_speed
+
+        samples = self._samples()
+        if self.current is not None and len(samples) > 0:
+            # A stalled transfer (no samples lately) must slow down the speed
+            last_time, _ = samples[-1]
+            if now - last_time >= self.resolution:
+                samples.append((now, self.current))
+
+        speed = None
+        for (t0, p0), (t1, p1) in zip(samples, samples[1:]):
+            if t1 <= t0:
+                continue
+            rate = max(0, p1 - p0) / (t1 - t0)
+            speed = (
+                rate
+                if speed is None
+                else (self.alpha * rate + (1 - self.alpha) * speed)
+            )
+
+        self._cache_key = key
+        self._cache_speed = speed
+        return speed
+
+    @property
+    def eta(self) -> float | None:
+        if self._eta_hint is not None:
+            return self._eta_hint
+
+        speed = self.speed
+        if speed is None or speed <= 0 or self.total is None or self.current is None:
+            return None
+        return max(0, self.total - self.current) / speed
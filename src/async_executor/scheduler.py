@@ -0,0 +1,243 @@
+import asyncio
+from asyncio.exceptions import CancelledError
+from collections import deque
+from contextlib import asynccontextmanager
+from threading import Lock
+from typing import Hashable
+
+
+class _Waiter(object):
+    __slots__ = ("key", "resource", "loop", "future", "granted")
+
+    def __init__(
+        self, key: Hashable, resource: str | None, loop: asyncio.AbstractEventLoop
+    ) -> None:
+        self.key = key
+        self.resource = resource
+        self.loop = loop
+        self.future = loop.create_future()
+        self.granted = False
+
+
+def _wake(future: asyncio.Future) -> None:
+    if not future.done():
+        future.set_result(None)
+
+
+class FairShareScheduler(object):
+    """
+    Admission control for the executor slots. Every key (usually the user ID)
+    gets its own queue and the queues are served with deficit round robin, so
+    a key with weight `w` is admitted `w` times per round. Higher priority
+    classes are always served before the lower ones.
+
+    Tasks can also belong to a named resource class with its own concurrency
+    limit, a waiter is only admitted when its class has capacity left.
+    """
+
+    def __init__(self, capacity: int, quantum: float = 1.0) -> None:
+        if capacity <= 0:
+            raise ValueError("capacity must be greater than zero")
+
+        self.capacity = capacity
+        self.quantum = quantum
+
+        self._lock = Lock()
+        self._running = 0
+        self._weights: dict[Hashable, float] = dict()
+        self._queues: dict[tuple[int, Hashable], deque[_Waiter]] = dict()
+        self._deficits: dict[tuple[int, Hashable], float] = dict()
+        self._rings: dict[int, deque[tuple[int, Hashable]]] = dict()
+        self._limits: dict[str, int] = dict()
+        self._resources: dict[str, int] = dict()
+
+    def set_limit(self, resource: str, limit: int) -> None:
+        if limit <= 0:
+            raise ValueError("limit must be greater than zero")
+        with self._lock:
+            self._limits[resource] = limit
+            self._dispatch()
+
+    def get_limits(self) -> dict[str, int]:
+        with self._lock:
+            return self._limits.copy()
+
+    def running_by_resource(self) -> dict[str, int]:
+        with self._lock:
+            return self._resources.copy()
+
+    def _has_capacity(self, resource: str | None) -> bool:
+        if resource is None or resource not in self._limits:
+            return True
+        return self._resources.get(resource, 0) < self._limits[resource]
+
+    def _take(self, resource: str | None) -> None:
+        self._running += 1
+        if resource is not None:
+            self._resources[resource] = self._resources.get(resource, 0) + 1
+
+    def _give_back(self, resource: str | None) -> None:
+        self._running -= 1
+        if resource is not None:
+            self._resources[resource] -= 1
+
+    def set_weight(self, key: Hashable, weight: float) -> None:
+        if weight <= 0:
+            raise ValueError("weight must be greater than zero")
+        with self._lock:
+            self._weights[key] = weight
+
+    def get_weight(self, key: Hashable) -> float:
+        with self._lock:
+            return self._weights.get(key, 1)
+
+    @property
+    def running(self) -> int:
+        with self._lock:
+            return self._running
+
+    @property
+    def queued(self) -> int:
+        with self._lock:
+            return sum(len(q) for q in self._queues.values())
+
+    def queued_by_key(self) -> dict[Hashable, int]:
+        with self._lock:
+            ret = dict()
+            for (_, key), queue in self._queues.items():
+                ret[key] = ret.get(key, 0) + len(queue)
+            return ret
+
+    def _pick(self) -> _Waiter | None:
+        for priority in sorted(self._rings, reverse=True):
+            ring = self._rings[priority]
+            blocked = 0
+
+            while blocked < len(ring):
+                qkey = ring[0]
+                queue = self._queues[qkey]
+
+                # First waiter of this queue whose resource class isn't full
+                waiter = next(
+                    (w for w in queue if self._has_capacity(w.resource)), None
+                )
+                if waiter is None:
+                    ring.rotate(-1)
+                    blocked += 1
+                    continue
+
+                # Only the queues that can't take a waiter end the round, a
+                # queue that earned credit is served in a next turn
+                blocked = 0
+                if self._deficits[qkey] < 1:
+                    self._deficits[qkey] += self.quantum * self._weights.get(qkey[1], 1)
+                    if self._deficits[qkey] < 1:
+                        ring.rotate(-1)
+                        continue
+
+                self._deficits[qkey] -= 1
+                queue.remove(waiter)
+
+                if len(queue) == 0:
+                    # Idle queues don't keep their credit (DRR)
+                    ring.popleft()
+                    self._queues.pop(qkey)
+                    self._deficits.pop(qkey)
+                elif self._deficits[qkey] < 1:
+                    ring.rotate(-1)
+
+                return waiter
+
+            if len(ring) == 0:
+                self._rings.pop(priority)
+        return None
+
+    def _dispatch(self) -> None:
+        # WARNING: Must be called with the lock held
+        while self._running < self.capacity:
+            waiter = self._pick()
+            if waiter is None:
+                break
+
+            waiter.granted = True
+            self._take(waiter.resource)
+            waiter.loop.call_soon_threadsafe(_wake, waiter.future)
+
+    def _remove(self, waiter: _Waiter, priority: int) -> None:
+        qkey = (priority, waiter.key)
+        queue = self._queues.get(qkey)
+        if queue is None:
+            return
+
+        try:
+            queue.remove(waiter)
+        except ValueError:
+            return
+
+        if len(queue) == 0:
+            self._rings[priority].remove(qkey)
+            self._queues.pop(qkey)
+            self._deficits.pop(qkey)
+
+    async def acquire(
+        self,
+        key: Hashable = None,
+        weight: float | None = None,
+        priority: int = 0,
+        resource: str | None = None,
+    ) -> None:
+        if weight is not None:
+            self.set_weight(key, weight)
+
+        loop = asyncio.get_running_loop()
+
+        with self._lock:
+            if (
+                self._running < self.capacity
+                and len(self._queues) == 0
+                and self._has_capacity(resource)
+            ):
+                self._take(resource)
+                return
+
+            waiter = _Waiter(key, resource, loop)
+            qkey = (priority, key)
+            if qkey not in self._queues:
+                self._queues[qkey] = deque()
+                self._deficits[qkey] = 0
+                self._rings.setdefault(priority, deque()).append(qkey)
+            self._queues[qkey].append(waiter)
+            self._dispatch()
+
+        try:
+            await waiter.future
+        except CancelledError:
+            with self._lock:
+                if waiter.granted:
+                    # The slot was given while we were cancelled, pass it on
+                    self._give_back(resource)
+                    self._dispatch()
+                else:
+                    self._remove(waiter, priority)
+            raise
+
+    def release(self, resource: str | None = None) -> None:
+        with self._lock:
+            if self._running <= 0:
+                raise RuntimeError("release() called more times than acquire()")
+            self._give_back(resource)
+            self._dispatch()
+
+    @asynccontextmanager
+    async def slot(
+        self,
+        key: Hashable = None,
+        weight: float | None = None,
+        priority: int = 0,
+        resource: str | None = None,
+    ):
+        await self.acquire(key, weight, priority, resource)
+        try:
+            yield
+        finally:
+            self.release(resource)
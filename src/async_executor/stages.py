@@ -0,0 +1,342 @@
+import asyncio
+import hashlib
+import multiprocessing
+import os
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from itertools import count
+from multiprocessing.shared_memory import SharedMemory
+from threading import Lock
+from typing import Any, Callable
+
+
+class Stage(object):
+    """
+    CPU-bound step of a pipeline (hashing, compression, ...). The stage lives
+    in a worker process and receive the chunks in order.
+    """
+
+    def update(self, data: memoryview) -> bytes | None:
+        raise NotImplementedError
+
+    def finalize(self) -> Any:
+        return None
+
+
+class HashStage(Stage):
+    def __init__(self, name: str = "sha1") -> None:
+        self._hash = hashlib.new(name)
+
+    def update(self, data: memoryview) -> None:
+        self._hash.update(data)
+
+    def finalize(self) -> str:
+        return self._hash.hexdigest()
+
+
+def merkle_root(name: str, digests: list[bytes]) -> bytes:
+    """Root of the hash tree over `digests`, an odd node is promoted as is"""
+    if len(digests) == 0:
+        return hashlib.new(name).digest()
+
+    level = list(digests)
+    while len(level) > 1:
+        level = [
+            (
+                hashlib.new(name, level[i] + level[i + 1]).digest()
+                if i + 1 < len(level)
+                else level[i]
+            )
+            for i in range(0, len(level), 2)
+        ]
+    return level[0]
+
+
+class TreeHashStage(Stage):
+    """
+    Hash tree of the data: fixed size leaves are hashed in parallel threads
+    (hashlib releases the GIL) and combined in a Merkle tree. The root of a
+    single leaf is the plain hash of the data, `digest` is always the plain
+    hash (what sha1sum and the like output).
+    """
+
+    def __init__(self, name: str = "sha256", leaf_size: int = 1048576) -> None:
+        self._name = name
+        self._leaf_size = leaf_size
+        self._buffer = bytearray()
+        self._leaves: list[Future] = []
+        self._size = 0
+        self._digest = hashlib.new(name)
+
+    def _push(self, data: bytes) -> None:
+        self._leaves.append(
+            _threads().submit(lambda: hashlib.new(self._name, data).digest())
+        )
+
+    def update(self, data: memoryview) -> None:
+        self._size += len(data)
+        self._digest.update(data)
+        offset = 0
+
+        if len(self._buffer) > 0:
+            offset = min(len(data), self._leaf_size - len(self._buffer))
+            self._buffer += data[:offset]
+            if len(self._buffer) < self._leaf_size:
+                return
+            self._push(bytes(self._buffer))
+            self._buffer.clear()
+
+        # The view is only valid during this call, the leaves are copied
+        while len(data) - offset >= self._leaf_size:
+            self._push(bytes(data[offset : offset + self._leaf_size]))
+            offset += self._leaf_size
+        self._buffer += data[offset:]
+
+    def finalize(self) -> dict[str, Any]:
+        if len(self._buffer) > 0 or len(self._leaves) == 0:
+            self._push(bytes(self._buffer))
+            self._buffer.clear()
+
+        leaves = [x.result() for x in self._leaves]
+        return {
+            "algorithm": self._name,
+            "size": self._size,
+            "leaf_size": self._leaf_size,
+            "root": merkle_root(self._name, leaves).hex(),
+            "digest": self._digest.hexdigest(),
+            "leaves": [x.hex() for x in leaves],
+        }
+
+
+# Threads of the process to hash the leaves
+_THREADS: ThreadPoolExecutor | None = None
+_THREADS_LOCK = Lock()
+
+
+def _threads() -> ThreadPoolExecutor:
+    global _THREADS
+    with _THREADS_LOCK:
+        if _THREADS is None:
+            _THREADS = ThreadPoolExecutor(
+                max_workers=os.cpu_count() or 1, thread_name_prefix="hash"
+            )
+        return _THREADS
+
+
+def _reset_threads() -> None:
+    # The threads aren't inherited by the forked workers
+    global _THREADS, _THREADS_LOCK
+    _THREADS, _THREADS_LOCK = None, Lock()
+
+
+os.register_at_fork(after_in_child=_reset_threads)
+
+
+# Worker process state
+_STAGES: dict[int, Stage] = dict()
+_BLOCKS: dict[str, SharedMemory] = dict()
+
+
+def _worker_open(id: int, factory: Callable[..., Stage], args: tuple) -> None:
+    _STAGES[id] = factory(*args)
+
+
+def _worker_update(id: int, name: str, length: int) -> bytes | None:
+    block = _BLOCKS.get(name)
+    if block is None:
+        block = _BLOCKS[name] = SharedMemory(name=name)
+
+    view = block.buf[:length]
+    try:
+        return _STAGES[id].update(view)
+    finally:
+        view.release()
+
+
+def _worker_close(id: int, names: list[str]) -> Any:
+    for name in names:
+        block = _BLOCKS.pop(name, None)
+        if block is not None:
+            block.close()
+
+    stage = _STAGES.pop(id, None)
+    return stage.finalize() if stage is not None else None
+
+
+class StageStream(object):
+    """
+    Feed a stage running in a worker process. The chunks are copied into a
+    small ring of shared memory blocks, so up to `depth` chunks are processed
+    while the caller keeps doing I/O.
+    """
+
+    def __init__(
+        self,
+        runner: "StageRunner",
+        worker: int,
+        id: int,
+        block_size: int,
+        depth: int,
+    ) -> None:
+        self._runner = runner
+        self._worker = worker
+        self._id = id
+        self._block_size = block_size
+        self._blocks = [
+            SharedMemory(create=True, size=block_size) for _ in range(depth)
+        ]
+        self._free = deque(self._blocks)
+        self._pending: deque[tuple[Future, SharedMemory]] = deque()
+        self._closed = False
+        self.result: Any = None
+
+    async def __aenter__(self) -> "StageStream":
+        return self
+
+    async def __aexit__(self, *args) -> None:
+        await self.close()
+
+    async def _wait_oldest(self) -> bytes | None:
+        future, block = self._pending.popleft()
+        try:
+            return await asyncio.wrap_future(future)
+        finally:
+            self._free.append(block)
+
+    async def _submit(self, data: memoryview) -> Future:
+        if len(self._free) == 0:
+            await self._wait_oldest()
+
+        block = self._free.popleft()
+        block.buf[: len(data)] = data
+        future = self._runner._submit(
+            self._worker, _worker_update, self._id, block.name, len(data)
+        )
+        self._pending.append((future, block))
+        return future
+
+    async def feed(self, data: bytes) -> None:
+        """Queue the chunk to the stage without wait the result"""
+        view = memoryview(data)
+        for offset in range(0, len(view), self._block_size):
+            await self._submit(view[offset : offset + self._block_size])
+
+    async def transform(self, data: bytes) -> bytes:
+        """Process the chunk and return the output of the stage"""
+        view = memoryview(data)
+        futures = [
+            await self._submit(view[offset : offset + self._block_size])
+            for offset in range(0, len(view), self._block_size)
+        ]
+        ret = [await asyncio.wrap_future(f) for f in futures]
+        return b"".join(x for x in ret if x is not None)
+
+    async def close(self) -> Any:
+        if self._closed:
+            return self.result
+        self._closed = True
+
+        try:
+            while len(self._pending) > 0:
+                await self._wait_oldest()
+
+            self.result = await asyncio.wrap_future(
+                self._runner._submit(
+                    self._worker,
+                    _worker_close,
+                    self._id,
+                    [block.name for block in self._blocks],
+                )
+            )
+            return self.result
+        finally:
+            for block in self._blocks:
+                block.close()
+                block.unlink()
+            self._runner._release(self._worker)
+
+
+class InlineStageStream(object):
+    """Same interface than `StageStream` but runs the stage in the caller"""
+
+    def __init__(self, stage: Stage) -> None:
+        self._stage = stage
+        self.result: Any = None
+
+    async def __aenter__(self) -> "InlineStageStream":
+        return self
+
+    async def __aexit__(self, *args) -> None:
+        await self.close()
+
+    async def feed(self, data: bytes) -> None:
+        self._stage.update(memoryview(data))
+
+    async def transform(self, data: bytes) -> bytes:
+        return self._stage.update(memoryview(data)) or b""
+
+    async def close(self) -> Any:
+        if self._stage is not None:
+            self.result = self._stage.finalize()
+            self._stage = None
+        return self.result
+
+
+class StageRunner(object):
+    """
+    Run pipeline stages in a pool of worker processes. Every stream is pinned
+    to one worker (the stage keeps state between chunks) and the streams are
+    spread over the workers. With zero workers the stages run inline.
+    """
+
+    def __init__(
+        self,
+        workers: int | None = None,
+        block_size: int = 2097152,
+        depth: int = 4,
+    ) -> None:
+        self.workers = (
+            workers if workers is not None else max(0, (os.cpu_count() or 1) - 1)
+        )
+        self.block_size = block_size
+        self.depth = depth
+
+        self._lock = Lock()
+        self._ids = count()
+        self._pools: list[ProcessPoolExecutor | None] = [None] * self.workers
+        self._streams = [0] * self.workers
+
+    def _submit(self, worker: int, func: Callable, *args) -> Future:
+        return self._pools[worker].submit(func, *args)
+
+    def _release(self, worker: int) -> None:
+        with self._lock:
+            self._streams[worker] -= 1
+
+    def open(self, factory: Callable[..., Stage], *args) -> StageStream:
+        """Open a stream to a new stage `factory(*args)`"""
+        if self.workers == 0:
+            return InlineStageStream(factory(*args))
+
+        with self._lock:
+            worker = min(range(self.workers), key=lambda x: self._streams[x])
+            self._streams[worker] += 1
+
+            if self._pools[worker] is None:
+                # WARNING: spawn would re-import the main module of the bot
+                self._pools[worker] = ProcessPoolExecutor(
+                    max_workers=1, mp_context=multiprocessing.get_context("fork")
+                )
+            id = next(self._ids)
+
+        stream = StageStream(self, worker, id, self.block_size, self.depth)
+        self._submit(worker, _worker_open, id, factory, args)
+        return stream
+
+    def shutdown(self, wait: bool = True) -> None:
+        with self._lock:
+            pools = [x for x in self._pools if x is not None]
+            self._pools = [None] * self.workers
+
+        for pool in pools:
+            pool.shutdown(wait, cancel_futures=True)
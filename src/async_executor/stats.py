@@ -0,0 +1,78 @@
+import bisect
+from threading import Lock
+
+
+class Histogram(object):
+    """
+    Fixed buckets histogram. `bounds` are the upper limits of the buckets, a
+    last bucket keeps the values greater than the last bound.
+    """
+
+    __slots__ = ("bounds", "counts", "count", "sum", "_lock")
+
+    def __init__(self, bounds: list[float]) -> None:
+        self.bounds = sorted(bounds)
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self._lock = Lock()
+
+    @classmethod
+    def exponential(cls, start: float, factor: float, count: int) -> "Histogram":
+        return cls([start * factor**i for i in range(count)])
+
+    def observe(self, value: float) -> None:
+        index = bisect.bisect_left(self.bounds, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.count += 1
+            self.sum += value
+
+    @property
+    def mean(self) -> float | None:
+        with self._lock:
+            return self.sum / self.count if self.count > 0 else None
+
+    def quantile(self, q: float) -> float | None:
+        """Upper bound of the bucket holding the `q` quantile"""
+        with self._lock:
+            if self.count == 0:
+                return None
+
+            rank = q * self.count
+            seen = 0
+            for index, count in enumerate(self.counts):
+                seen += count
+                if seen >= rank and count > 0:
+                    break
+
+        return self.bounds[index] if index < len(self.bounds) else float("inf")
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                "bounds": list(self.bounds),
+                "counts": list(self.counts),
+                "count": self.count,
+                "sum": self.sum,
+            }
+
+
+class ClassStats(object):
+    """Durations (seconds) and throughput (bytes/sec) of the tasks of a class"""
+
+    __slots__ = ("duration", "throughput", "results")
+
+    def __init__(self) -> None:
+        # 0.1 sec to ~15 hours
+        self.duration = Histogram.exponential(0.1, 2, 20)
+        # 16 KiB/sec to ~128 GiB/sec
+        self.throughput = Histogram.exponential(16384, 2, 24)
+        self.results: dict[str, int] = dict()
+
+    def snapshot(self) -> dict:
+        return {
+            "duration": self.duration.snapshot(),
+            "throughput": self.throughput.snapshot(),
+            "results": self.results.copy(),
+        }
@@ -1,12 +1,14 @@
 import inspect
-import time
 import asyncio
 import functools
 from enum import Enum
 from threading import Lock
-from typing import Callable
+from typing import Any, Callable
 from uuid import UUID, uuid4
 
+from async_executor.loops import LoopBridge, run_in_loop
+from async_executor.progress import Progress
+
 
 class TaskState(Enum):
     UNKNOW = 0
@@ -19,25 +21,49 @@ class TaskState(Enum):
 
 
 class Task(object):
+    # Named resource class and its default concurrency limit in the executor
+    RESOURCE_CLASS: str | None = None
+    RESOURCE_LIMIT: int | None = None
+
     def __init__(self, **kwargs) -> None:
         self.id: UUID = uuid4()
 
         self._state: tuple[TaskState, str | None] = (TaskState.UNKNOW, None)
-        self._progress: tuple[int | None, int | None] = (None, None)
+        self._progress = Progress()
         self._lock = Lock()
-        self._last_point: int | None = None
-        self._last_time: float | None = None
-        self._eta: float | None = None
-        self._speed: float | None = None
         self._executor = None
         self._childs: list[Task] = []
+        self._parent: Task | None = None
         self._future = None
+        self._key = None
+        self._weight: float | None = None
+        self._priority: int = 0
+        self._current_thread: bool = True
+        self._home_loop: asyncio.AbstractEventLoop | None = None
+
+        # Running totals of the childs (and grandchilds), updated as they report
+        self._aggregate = Progress()
+        self._childs_current = 0
+        self._childs_total = 0
+        self._childs_states: dict[TaskState, int] = dict()
+        self._reported: tuple[int, int] = (0, 0)  # Reported to the parent
 
         self.kwargs = kwargs
 
     def cancel(self) -> None:
         self.cancel_childs()
-        self._future.cancel()
+
+        # The future can live in any loop of the executor
+        loop = self._future.get_loop()
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+
+        if loop is running:
+            self._future.cancel()
+        else:
+            loop.call_soon_threadsafe(self._future.cancel)
 
     def cancel_childs(self) -> None:
         if self._future is None:
@@ -50,24 +76,54 @@ class Task(object):
         # Body of the rutine to task execute
         raise NotImplementedError
 
+    def bridge(self, obj: Any) -> Any:
+        """Wrap an object owned by the home loop to use it from this task"""
+        if self._home_loop is None or asyncio.get_running_loop() is self._home_loop:
+            return obj
+        return LoopBridge(obj, self._home_loop)
+
+    async def call_home(self, func: Callable, *args, **kwargs) -> Any:
+        """Await the coroutine function `func` in the home loop"""
+        if self._home_loop is None:
+            return await func(*args, **kwargs)
+        return await run_in_loop(self._home_loop, func, *args, **kwargs)
+
     def schedule_child(
         self,
         task: "Task",
         remove_on_complete: bool = True,
         on_end_callback: Callable[["Task"], None] | None = None,
     ) -> None:
+        task._home_loop = self._home_loop
+        task._parent = self
+        self._add_childs_state(None, task.state[0])
+
         if remove_on_complete:
 
             def remove(t):
                 self._childs.remove(t)
+                if on_end_callback is None:
+                    return
                 if inspect.iscoroutinefunction(on_end_callback):
                     asyncio.create_task(on_end_callback(t))
                 else:
                     on_end_callback(t)
 
-            self._executor.schedule(task, lambda t: remove(t))
+            self._executor.schedule(
+                task,
+                lambda t: remove(t),
+                current_thread=self._current_thread,
+                key=self._key,
+                priority=self._priority,
+            )
         else:
-            self._executor.schedule(task, on_end_callback)
+            self._executor.schedule(
+                task,
+                on_end_callback,
+                current_thread=self._current_thread,
+                key=self._key,
+                priority=self._priority,
+            )
         self._childs.append(task)
 
     def childs(self) -> list["Task"]:
@@ -91,56 +147,81 @@ class Task(object):
 
     @property
     def progress(self) -> tuple[int | None, int | None]:
-        with self._lock:
-            return self._progress
+        return (self._progress.current, self._progress.total)
 
     @property
     def eta(self) -> float | None:
-        with self._lock:
-            return self._eta
+        return self._progress.eta
 
     @property
     def speed(self) -> float | None:
+        return self._progress.speed
+
+    @property
+    def childs_progress(self) -> tuple[int, int]:
+        """Bytes transferred and total bytes of all the childs"""
         with self._lock:
-            return self._speed
+            return (self._childs_current, self._childs_total)
 
-    def reset_stats(self) -> None:
+    @property
+    def childs_speed(self) -> float | None:
+        return self._aggregate.speed
+
+    @property
+    def childs_eta(self) -> float | None:
+        return self._aggregate.eta
+
+    def childs_states(self) -> dict[TaskState, int]:
         with self._lock:
-            self._last_point = None
-            self._last_time = None
-            self._eta = None
-            self._speed = None
-            self._progress = (None, None)
+            return {k: v for k, v in self._childs_states.items() if v > 0}
 
-    def set_state(self, state: TaskState, description: str | None = None) -> None:
+    def _add_childs_progress(self, current: int, total: int) -> None:
         with self._lock:
-            self._state = (state, description)
-        return None
+            self._childs_current += current
+            self._childs_total += total
+            self._aggregate.update(self._childs_current, self._childs_total)
 
-    def make_progress(self, current: int, total: int, *args, **kwargs) -> None:
+        if self._parent is not None:
+            self._parent._add_childs_progress(current, total)
+
+    def _add_childs_state(self, old: TaskState | None, new: TaskState) -> None:
         with self._lock:
-            self._progress = (current, total)
+            if old is not None:
+                self._childs_states[old] -= 1
+            self._childs_states[new] = self._childs_states.get(new, 0) + 1
+
+    def _report(self, current: int | None, total: int | None) -> None:
+        # Send to the parent the difference with the last report, O(1)
+        current, total = (current or 0), (total or 0)
+        last_current, last_total = self._reported
+        if current != last_current or total != last_total:
+            self._reported = (current, total)
+            self._parent._add_childs_progress(
+                current - last_current, total - last_total
+            )
 
-            try:
-                if self._last_time is None:
-                    self._last_time = time.monotonic()
-                    self._last_point = current
-                    return
+    def reset_stats(self) -> None:
+        self._progress.reset()
+        if self._parent is not None:
+            self._report(None, None)
 
-                # compute eta
-                if current is not None:
-                    self._speed = kwargs.get(
-                        "speed",
-                        (current - self._last_point)
-                        / (time.monotonic() - self._last_time),
-                    )
-                    self._eta = kwargs.get("eta", (total - current) / self._speed)
-            except Exception:
-                self._eta = None
-                self._speed = None
+    def set_state(self, state: TaskState, description: str | None = None) -> None:
+        with self._lock:
+            old, _ = self._state
+            self._state = (state, description)
 
+        if self._parent is not None and old != state:
+            self._parent._add_childs_state(old, state)
         return None
 
+    def make_progress(self, current: int, total: int, *args, **kwargs) -> None:
+        # Hot path: called for every chunk transferred
+        self._progress.update(
+            current, total, kwargs.get("speed", None), kwargs.get("eta", None)
+        )
+        if self._parent is not None:
+            self._report(current, total)
+
     def __hash__(self) -> int:
         return hash(self.id)
 
@@ -0,0 +1,181 @@
+import io
+import tempfile
+from threading import Lock
+from typing import IO, Awaitable, Callable
+
+
+class BufferPool(object):
+    """
+    Bounded pool of reusable memory buffers for the small files. A buffer is
+    allocated the first time that it's needed and then kept for the next
+    files, so at most `count * size` bytes are used. A file that outgrows its
+    buffer is moved to a file of the `spill()` coroutine.
+    """
+
+    def __init__(
+        self,
+        size: int,
+        count: int,
+        spill: Callable[[], Awaitable[IO[bytes]]] | None = None,
+    ) -> None:
+        self.size = size
+        self.count = count
+        self.spill = spill if spill is not None else _temporary_file
+
+        self._lock = Lock()
+        self._free: list[bytearray] = []
+        self._allocated = 0
+
+    @property
+    def available(self) -> int:
+        with self._lock:
+            return len(self._free) + (self.count - self._allocated)
+
+    def try_acquire(self) -> bytearray | None:
+        """Take a buffer without waiting, `None` if all of them are in use"""
+        with self._lock:
+            if len(self._free) > 0:
+                return self._free.pop()
+            if self._allocated < self.count:
+                self._allocated += 1
+                return bytearray(self.size)
+            return None
+
+    def release(self, buffer: bytearray) -> None:
+        with self._lock:
+            self._free.append(buffer)
+
+    def open(self) -> "PooledFile | None":
+        buffer = self.try_acquire()
+        return PooledFile(self, buffer) if buffer is not None else None
+
+
+async def _temporary_file() -> IO[bytes]:
+    return tempfile.TemporaryFile()
+
+
+class PooledFile(io.RawIOBase):
+    """
+    Binary file over a pooled buffer. If the data doesn't fit, `make_room`
+    moves the content to a spill file of the pool (and the buffer returned to
+    the pool) before it's written.
+    """
+
+    def __init__(self, pool: BufferPool, buffer: bytearray) -> None:
+        super().__init__()
+        self._pool = pool
+        self._buffer: bytearray | None = buffer
+        self._view = memoryview(buffer)
+        self._length = 0
+        self._position = 0
+        self._file = None  # After the rollover
+
+    @property
+    def name(self) -> str:
+        return self._file.name if self._file is not None else "<memory>"
+
+    @property
+    def rolled(self) -> bool:
+        return self._file is not None
+
+    async def make_room(self, size: int) -> None:
+        """Move to a spill file if `size` bytes more don't fit in the buffer"""
+        if self._file is not None or self._position + size <= len(self._view):
+            return
+
+        file = await self._pool.spill()
+        try:
+            file.write(self._view[: self._length])
+            file.seek(self._position)
+        except BaseException:
+            file.close()
+            raise
+        self._file = file
+        self._release()
+
+    def _release(self) -> None:
+        if self._buffer is not None:
+            self._view.release()
+            self._pool.release(self._buffer)
+            self._buffer = None
+
+    def readable(self) -> bool:
+        return True
+
+    def writable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def fileno(self) -> int:
+        if self._file is not None:
+            return self._file.fileno()
+        raise io.UnsupportedOperation("in memory file")
+
+    def write(self, data: bytes) -> int:
+        if self._file is not None:
+            return self._file.write(data)
+
+        end = self._position + len(data)
+        if end > len(self._view):
+            raise io.UnsupportedOperation("The data doesn't fit, make room before")
+
+        if self._position > self._length:  # The buffer has data of other files
+            self._view[self._length : self._position] = bytes(
+                self._position - self._length
+            )
+        self._view[self._position : end] = data
+        self._position = end
+        self._length = max(self._length, end)
+        return len(data)
+
+    def read(self, size: int = -1) -> bytes:
+        if self._file is not None:
+            return self._file.read(size)
+
+        end = self._length if size < 0 else min(self._length, self._position + size)
+        data = bytes(self._view[self._position : end])
+        self._position = max(self._position, end)
+        return data
+
+    def readinto(self, buffer) -> int:
+        data = self.read(len(buffer))
+        buffer[: len(data)] = data
+        return len(data)
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        if self._file is not None:
+            return self._file.seek(offset, whence)
+
+        if whence == io.SEEK_CUR:
+            offset += self._position
+        elif whence == io.SEEK_END:
+            offset += self._length
+        self._position = max(0, offset)
+        return self._position
+
+    def tell(self) -> int:
+        if self._file is not None:
+            return self._file.tell()
+        return self._position
+
+    def truncate(self, size: int | None = None) -> int:
+        if self._file is not None:
+            return self._file.truncate(size)
+
+        size = self._position if size is None else size
+        self._length = min(self._length, size)
+        return size
+
+    def flush(self) -> None:
+        if self._file is not None:
+            self._file.flush()
+
+    def close(self) -> None:
+        if self.closed:
+            return
+        super().close()
+        if self._file is not None:
+            self._file.close()
+        self._release()
@@ -0,0 +1,89 @@
+import time
+from typing import AsyncGenerator
+
+import config
+import psutil
+
+from memory import GOVERNOR
+
+# Bounds of the transfer chunks, tunable from the environment
+MIN_CHUNK_SIZE = int(config.CHUNK_SIZE_MIN) * 1024
+MAX_CHUNK_SIZE = int(config.CHUNK_SIZE_MAX) * 1024
+
+# Used memory (percent) from which the chunks are kept at the minimum size
+MEMORY_PRESSURE = 90.0
+
+_pressure = (0.0, False)  # Last check (time, result)
+
+
+def memory_pressure() -> bool:
+    """
+    System memory almost exhausted (checked at most once per second) or the
+    bot over its memory watermarks
+    """
+    global _pressure
+    checked_at, result = _pressure
+    now = time.monotonic()
+    if now - checked_at >= 1.0:
+        result = psutil.virtual_memory().percent >= MEMORY_PRESSURE
+        _pressure = (now, result)
+    return result or GOVERNOR.paused
+
+
+class ChunkSizer(object):
+    """
+    Size of the chunks of a transfer. It starts small, so the first bytes
+    move soon, and then follows the measured throughput to move a chunk
+    every `target` seconds: a fast link gets big chunks (few system calls and
+    writes) and a slow link small ones. Under memory pressure the chunks are
+    kept at the minimum size.
+    """
+
+    __slots__ = ("minimum", "maximum", "target", "alpha", "size", "_rate")
+
+    def __init__(
+        self,
+        minimum: int = MIN_CHUNK_SIZE,
+        maximum: int = MAX_CHUNK_SIZE,
+        initial: int | None = None,
+        target: float = 0.25,
+        alpha: float = 0.5,
+    ) -> None:
+        self.minimum = minimum
+        self.maximum = max(minimum, maximum)
+        self.target = target
+        self.alpha = alpha
+        self.size = max(minimum, min(self.maximum, initial or minimum * 4))
+        self._rate: float | None = None
+
+    def observe(self, length: int, elapsed: float) -> int:
+        """Account a chunk of `length` bytes moved in `elapsed` seconds"""
+        if memory_pressure():
+            self.size = self.minimum
+            return self.size
+
+        if length <= 0:
+            return self.size
+
+        # A short chunk that was moved at once doesn't say anything of the link
+        rate = length / max(elapsed, 1e-4)
+        self._rate = (
+            rate
+            if self._rate is None
+            else (self.alpha * rate + (1 - self.alpha) * self._rate)
+        )
+
+        # Grow at most x2 per chunk, to avoid jumps on a single fast read
+        size = min(int(self._rate * self.target), self.size * 2)
+        self.size = max(self.minimum, min(self.maximum, size))
+        return self.size
+
+    async def iter_stream(self, stream) -> AsyncGenerator[bytes, None]:
+        """Read an `aiohttp.StreamReader` with adaptive chunks"""
+        while True:
+            start = time.monotonic()
+            chunk = await stream.read(self.size)
+            if not chunk:
+                break
+            self.observe(len(chunk), time.monotonic() - start)
+            yield chunk
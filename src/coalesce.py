@@ -0,0 +1,337 @@
+import asyncio
+import shutil
+import tempfile
+from contextlib import asynccontextmanager
+from threading import Lock
+from typing import Any, AsyncGenerator, BinaryIO, Hashable
+from urllib.parse import urlsplit, urlunsplit
+
+from storage import STORAGE, Reservation
+
+# Bytes of a stream kept in memory while no follower joins its flight
+SHARED_WINDOW = 4194304
+
+
+class CoalescedSourceError(Exception):
+    """The task that was downloading the shared source failed"""
+
+
+def url_key(url: str, fragment: bool = False) -> str:
+    """
+    Normalized `url`. The fragment is never sent, so it's dropped unless the
+    source identifies the content with it (`fragment`, e.g. Mega links)
+    """
+    # Scheme and host are case insensitive
+    parts = urlsplit(url.strip())
+    netloc = parts.netloc.lower()
+    if (parts.scheme, netloc.rsplit(":", 1)[-1]) in (("http", "80"), ("https", "443")):
+        netloc = netloc.rsplit(":", 1)[0]
+    return urlunsplit(
+        (
+            parts.scheme.lower(),
+            netloc,
+            parts.path or "/",
+            parts.query,
+            parts.fragment if fragment else "",
+        )
+    )
+
+
+def _wake(future: asyncio.Future) -> None:
+    if not future.done():
+        future.set_result(None)
+
+
+class Flight(object):
+    """
+    One in-flight download of a source. The leader publishes a value (e.g. the
+    downloaded files, that live in `directory`) or tees the byte stream. The
+    start of the stream is kept in memory and spooled to a file only when a
+    follower joins, the followers replay it from the start. A stream that
+    nobody followed in its first `SHARED_WINDOW` bytes doesn't take more
+    followers. The directory is removed when the last task leaves.
+
+    The tasks of a flight can run in different event loops.
+    """
+
+    def __init__(self, key: Hashable) -> None:
+        self.key = key
+        self._lock = Lock()
+        self._refs = 0
+        self._directory: str | None = None
+        self._reservation: Reservation | None = None
+        self._waiters: list[tuple[asyncio.AbstractEventLoop, asyncio.Future]] = []
+
+        self._published = False
+        self._value: Any = None
+        self._error: BaseException | None = None
+
+        self._joinable = True
+        self._spool: str | None = None
+        self._spool_reservation: Reservation | None = None
+        self._size = 0
+        self._done = False
+
+    @property
+    def directory(self) -> str:
+        """Scratch directory shared by all the tasks of this flight"""
+        with self._lock:
+            if self._directory is None:
+                self._directory = tempfile.mkdtemp(prefix="flight-")
+            return self._directory
+
+    async def reserve(self, size: int | None) -> None:
+        """Reserve the temporary storage of the flight, the directory moves there"""
+        reservation = await STORAGE.reserve(size)
+        with self._lock:
+            if self._reservation is None and self._directory is None:
+                self._reservation = reservation
+                self._directory = reservation.directory
+                reservation = None
+        if reservation is not None:
+            reservation.release()  # Already placed
+
+    def _notify(self) -> None:
+        # WARNING: Must be called with the lock held
+        for loop, future in self._waiters:
+            loop.call_soon_threadsafe(_wake, future)
+        self._waiters.clear()
+
+    async def _wait(self, ready) -> None:
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            if ready():
+                return
+            future = loop.create_future()
+            self._waiters.append((loop, future))
+        await future
+
+    def set_result(self, value: Any) -> None:
+        with self._lock:
+            self._published = True
+            self._value = value
+            self._notify()
+
+    def set_exception(self, error: BaseException) -> None:
+        with self._lock:
+            if self._error is None and not self._done:
+                self._error = error
+                self._notify()
+
+    async def result(self) -> Any:
+        """Wait the value published by the leader"""
+        await self._wait(lambda: self._published or self._error is not None)
+        with self._lock:
+            if self._error is not None and not self._published:
+                raise CoalescedSourceError(str(self._error)) from self._error
+            return self._value
+
+    def unshare(self) -> None:
+        """Leader side: the stream won't be teed, the followers download it"""
+        with self._lock:
+            self._joinable = False
+            self._notify()
+
+    def _share(
+        self, size: int | None, head: list[bytes], full: bool
+    ) -> BinaryIO | None:
+        """
+        Spool the start of the stream if a follower joined, otherwise stop
+        taking followers once the start is `full`
+        """
+        with self._lock:
+            if self._refs <= 1:
+                if full:
+                    self._joinable = False
+                    self._notify()
+                return None
+
+        # The leader doesn't wait for room, the followers download by their own
+        reservation = STORAGE.try_reserve(size)
+        if reservation is None:
+            with self._lock:
+                self._joinable = False
+                self._notify()
+            return None
+
+        file = reservation.create("stream")
+        try:
+            for chunk in head:
+                file.write(chunk)
+            file.flush()
+        except BaseException:
+            file.close()
+            reservation.release()
+            raise
+
+        with self._lock:
+            self._spool_reservation = reservation
+            self._spool = file.name
+            self._size = sum(len(x) for x in head)
+            self._notify()
+        return file
+
+    async def tee(
+        self, generator: AsyncGenerator[bytes, None], size: int | None = None
+    ) -> AsyncGenerator[bytes, None]:
+        """
+        Leader side: yield the chunks of `generator` (`size` bytes, if known)
+        while sharing them with the followers
+        """
+        head: list[bytes] = []
+        held = 0
+        file = None
+        try:
+            async for chunk in generator:
+                if file is not None:
+                    file.write(chunk)
+                    file.flush()
+                    with self._lock:
+                        self._size += len(chunk)
+                        self._notify()
+                elif self._joinable:
+                    head.append(chunk)
+                    held += len(chunk)
+                    file = self._share(size, head, held > SHARED_WINDOW)
+                    if file is not None or not self._joinable:
+                        head = []
+                yield chunk
+
+            if file is None and self._joinable:
+                file = self._share(size, head, True)
+        finally:
+            if file is not None:
+                file.close()
+
+        with self._lock:
+            self._done = True
+            self._notify()
+
+    async def shared(self) -> bool:
+        """
+        Follower side: wait until the leader shares the stream, `False` if it
+        doesn't (no room to spool it, or the leader left) and the follower
+        has to download the source by itself
+        """
+        await self._wait(
+            lambda: self._spool is not None
+            or not self._joinable
+            or self._error is not None
+        )
+        with self._lock:
+            return self._spool is not None
+
+    async def replay(self, chunk_size: int = 2097152) -> AsyncGenerator[bytes, None]:
+        """Follower side: yield the stream of the leader from the start"""
+        if not await self.shared():
+            with self._lock:
+                error = self._error
+            if error is None:
+                raise CoalescedSourceError("The download isn't shared")
+            raise CoalescedSourceError(str(error)) from error
+
+        offset = 0
+        with open(self._spool, "rb") as file:
+            while True:
+                with self._lock:
+                    size, done, error = self._size, self._done, self._error
+
+                if offset < size:
+                    data = file.read(min(chunk_size, size - offset))
+                    offset += len(data)
+                    yield data
+                elif error is not None:
+                    raise CoalescedSourceError(str(error)) from error
+                elif done:
+                    return
+                else:
+                    await self._wait(
+                        lambda: self._size > offset
+                        or self._done
+                        or self._error is not None
+                    )
+
+    def _acquire(self) -> None:
+        with self._lock:
+            self._refs += 1
+
+    def _join(self) -> bool:
+        """Follow the flight, if it still takes followers"""
+        with self._lock:
+            if not self._joinable:
+                return False
+            self._refs += 1
+            return True
+
+    def _release(self) -> None:
+        with self._lock:
+            self._refs -= 1
+            last = self._refs == 0
+        if not last:
+            return
+        if self._directory is not None:
+            shutil.rmtree(self._directory, ignore_errors=True)
+        for reservation in (self._reservation, self._spool_reservation):
+            if reservation is not None:
+                reservation.release()
+
+
+class FlightHandle(object):
+    """Participation of a task in a `Flight`"""
+
+    def __init__(self, flight: Flight, leader: bool) -> None:
+        self.flight = flight
+        self.leader = leader
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self.flight, name)
+
+
+class Coalescer(object):
+    """
+    Deduplicate concurrent downloads of the same source. The first task that
+    joins a key becomes the leader and downloads the source, the tasks that
+    join the key while the leader is working follow its flight. Once the
+    leader leaves (or its flight stops taking followers), the next task that
+    joins the key starts a new flight.
+    """
+
+    def __init__(self) -> None:
+        self._lock = Lock()
+        self._flights: dict[Hashable, Flight] = dict()
+
+    @property
+    def flights(self) -> int:
+        with self._lock:
+            return len(self._flights)
+
+    @asynccontextmanager
+    async def join(self, key: Hashable):
+        """Join the flight of `key`, a `None` key is never shared"""
+        with self._lock:
+            flight = self._flights.get(key) if key is not None else None
+            leader = flight is None or not flight._join()
+            if leader:
+                flight = Flight(key)
+                if key is not None:
+                    self._flights[key] = flight
+                flight._acquire()
+
+        try:
+            yield FlightHandle(flight, leader)
+        except BaseException as e:
+            if leader:
+                flight.set_exception(e)
+            raise
+        finally:
+            if leader:
+                with self._lock:
+                    if self._flights.get(key) is flight:
+                        self._flights.pop(key)
+                # The leader left without finishing the stream or publishing
+                flight.set_exception(CoalescedSourceError("Download interrupted"))
+            flight._release()
+
+
+# Downloads shared by all the services
+COALESCER = Coalescer()
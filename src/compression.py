@@ -0,0 +1,131 @@
+import mimetypes
+import os
+import time
+from threading import Lock
+from typing import Any
+
+import zstandard
+
+from async_executor.stages import Stage
+
+# Extensions of the formats that are already compressed
+COMPRESSED_EXTENSIONS = {
+    ".7z", ".aac", ".apk", ".avi", ".avif", ".br", ".bz2", ".cbr", ".cbz",
+    ".deb", ".docx", ".epub", ".flac", ".flv", ".gif", ".gz", ".heic", ".jar",
+    ".jpeg", ".jpg", ".lz", ".lz4", ".lzma", ".m4a", ".m4v", ".mkv", ".mov",
+    ".mp3", ".mp4", ".odt", ".ogg", ".opus", ".png", ".pptx", ".rar", ".rpm",
+    ".tgz", ".txz", ".webm", ".webp", ".whl", ".wmv", ".xlsx", ".xz", ".zip",
+    ".zst",
+}  # fmt: skip
+
+# Levels tried to pick the level of a stream
+LEVELS = (1, 3, 6, 9, 12, 15, 19)
+
+# Size of the data sample used to measure the levels
+SAMPLE_SIZE = 262144
+
+# Level used while the uplink speed is unknown
+DEFAULT_LEVEL = 3
+
+
+def is_compressed(filename: str) -> bool:
+    """The file is a compressed format (archives, images, audio and video)"""
+    extension = os.path.splitext(filename)[1].lower()
+    if extension in COMPRESSED_EXTENSIONS:
+        return True
+
+    mime, encoding = mimetypes.guess_type(filename)
+    if encoding is not None:
+        return True
+    if mime is None:
+        return False
+    # Only the raw formats of the media are worth to compress
+    return mime.split("/")[0] in ("image", "audio", "video") and not mime.endswith(
+        ("bmp", "wav", "x-wav", "tiff", "x-portable-pixmap")
+    )
+
+
+class Throughput(object):
+    """Moving average of the bytes per second of the transfers"""
+
+    def __init__(self, alpha: float = 0.3) -> None:
+        self.alpha = alpha
+        self._lock = Lock()
+        self._rate: float | None = None
+
+    @property
+    def rate(self) -> float | None:
+        with self._lock:
+            return self._rate
+
+    def observe(self, length: int, elapsed: float) -> None:
+        if length <= 0 or elapsed <= 0:
+            return
+        rate = length / elapsed
+        with self._lock:
+            self._rate = (
+                rate
+                if self._rate is None
+                else (self.alpha * rate + (1 - self.alpha) * self._rate)
+            )
+
+
+# Speed of the uploads to the webdav servers, measured by the services
+UPLINK = Throughput()
+
+
+def threads() -> int:
+    return max(1, os.cpu_count() or 1)
+
+
+def choose_level(sample: bytes, uplink: float | None) -> int | None:
+    """
+    Level that moves the data faster: compression and upload run at the same
+    time, so a level costs the slowest of both. Between similar costs the
+    higher level is preferred (less storage). `None` if the sample doesn't
+    compress
+    """
+    sample = sample[:SAMPLE_SIZE]
+    if len(sample) == 0:
+        return DEFAULT_LEVEL
+
+    best, best_cost = None, None
+    for level in LEVELS:
+        start = time.perf_counter()
+        size = len(zstandard.ZstdCompressor(level=level).compress(sample))
+        elapsed = max(time.perf_counter() - start, 1e-6)
+
+        ratio = size / len(sample)
+        if level == LEVELS[0] and ratio > 0.95:
+            return None  # Incompressible data
+        if uplink is None:
+            return DEFAULT_LEVEL
+
+        # Seconds per input byte of every side of the pipeline
+        compress = elapsed / len(sample) / threads()
+        send = ratio / uplink
+        cost = max(compress, send)
+
+        if best_cost is None or cost <= best_cost * 1.05:
+            best, best_cost = level, min(cost, best_cost or cost)
+        elif compress > send:
+            break  # The next levels are slower
+    return best
+
+
+class ZstdStage(Stage):
+    """
+    Streaming zstd compression, the frame is compressed by `threads` threads
+    of the library. The output of `finalize` closes the frame.
+    """
+
+    def __init__(self, level: int = DEFAULT_LEVEL, threads: int = 0) -> None:
+        self._compressor = zstandard.ZstdCompressor(
+            level=level, threads=threads
+        ).compressobj()
+
+    def update(self, data: memoryview) -> bytes:
+        return self._compressor.compress(data)
+
+    def finalize(self) -> Any:
+        return self._compressor.flush(zstandard.COMPRESSOBJ_FLUSH_FINISH)
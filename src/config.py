@@ -6,3 +6,20 @@ TELEGRAM_BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
 REDIS_HOST = os.getenv("REDIS_HOST")
 ACL_USERS = os.getenv("ACL_USERS")
 ACL_MODE = os.getenv("ACL_MODE", default="blacklist")
+RESOURCE_LIMITS = os.getenv("RESOURCE_LIMITS", default="")
+EXECUTOR_LOOPS = os.getenv("EXECUTOR_LOOPS", default="0")
+STAGE_WORKERS = os.getenv("STAGE_WORKERS", default="")
+COALESCE_DOWNLOADS = os.getenv("COALESCE_DOWNLOADS", default="on")
+MEMORY_FILE_SIZE = os.getenv("MEMORY_FILE_SIZE", default="8")
+MEMORY_BUFFERS = os.getenv("MEMORY_BUFFERS", default="8")
+CHUNK_SIZE_MIN = os.getenv("CHUNK_SIZE_MIN", default="64")
+CHUNK_SIZE_MAX = os.getenv("CHUNK_SIZE_MAX", default="8192")
+TEMP_DIRS = os.getenv("TEMP_DIRS", default="")
+TEMP_BUDGET = os.getenv("TEMP_BUDGET", default="0")
+TMPFS_FILE_SIZE = os.getenv("TMPFS_FILE_SIZE", default="256")
+MEMORY_LIMIT = os.getenv("MEMORY_LIMIT", default="0")
+MEMORY_HIGH_WATERMARK = os.getenv("MEMORY_HIGH_WATERMARK", default="85")
+MEMORY_LOW_WATERMARK = os.getenv("MEMORY_LOW_WATERMARK", default="70")
+BUFFERED_WATERMARK = os.getenv("BUFFERED_WATERMARK", default="64")
+DAV_CONNECTIONS = os.getenv("DAV_CONNECTIONS", default="8")
+DAV_IDLE_TIMEOUT = os.getenv("DAV_IDLE_TIMEOUT", default="300")
@@ -1,3 +1,4 @@
+import json
 from urllib.parse import urlparse
 
 from redis import Redis
@@ -26,12 +27,16 @@ class Database(object):
                 "split-size": 100,
                 "upload-path": "/",
                 "upload-parallel": "false",
+                "parallel-uploads": 4,
                 "streaming": "false",
+                "pieces-in-flight": 2,
                 "use-libcurl": "false",
                 "use-compression": "false",
                 "file-password": "",
                 "checksum": "true",
+                "checksum-algorithm": "sha1",
                 "file-overwrite": "false",
+                "resume-uploads": "true",
                 "is-admin": "false",
             }
 
@@ -57,3 +62,53 @@ class Database(object):
     def is_admin(self, id: int):
         data = self.get_data(id)
         return utils.get_bool(data["admin"])
+
+    def add_task(self, id: str, descriptor: dict):
+        self._redis.sadd("tasks", id)
+        self._redis.hset(f"task:{id}", key="descriptor", value=json.dumps(descriptor))
+
+    def checkpoint_task(self, id: str, piece: str, length: int):
+        self._redis.sadd(f"task:{id}:pieces", piece)
+        self._redis.hincrby(f"task:{id}", "checkpoint", length)
+
+    def get_task_pieces(self, id: str) -> set[str]:
+        return {x.decode("utf-8") for x in self._redis.smembers(f"task:{id}:pieces")}
+
+    def get_tasks(self) -> dict[str, dict]:
+        ret = dict()
+        for id in self._redis.smembers("tasks"):
+            id = id.decode("utf-8")
+            descriptor = self._redis.hget(f"task:{id}", "descriptor")
+            if descriptor is not None:
+                ret[id] = json.loads(descriptor)
+        return ret
+
+    def remove_task(self, id: str):
+        self._redis.srem("tasks", id)
+        self._redis.delete(f"task:{id}", f"task:{id}:pieces")
+
+    def record_piece(self, user: int, path: str, entry: dict):
+        """Size and digest of a remote piece, to reuse it in a resubmission"""
+        self._redis.hset(f"pieces:{user}", key=path, value=json.dumps(entry))
+
+    def lookup_piece(self, user: int, path: str) -> dict | None:
+        entry = self._redis.hget(f"pieces:{user}", path)
+        return json.loads(entry) if entry is not None else None
+
+    def index_content(self, user: int, source: str, content: str, entry: dict):
+        """Map a source identity to its content and the content to the remote files"""
+        self._redis.hset(f"content:{user}", key=content, value=json.dumps(entry))
+        self._redis.hset(f"sources:{user}", key=source, value=content)
+
+    def lookup_content(self, user: int, source: str) -> dict | None:
+        content = self._redis.hget(f"sources:{user}", source)
+        if content is None:
+            return None
+        entry = self._redis.hget(f"content:{user}", content)
+        return json.loads(entry) if entry is not None else None
+
+    def forget_content(self, user: int, source: str):
+        content = self._redis.hget(f"sources:{user}", source)
+        if content is not None:
+            self._redis.hdel(f"content:{user}", content)
+        self._redis.hdel(f"sources:{user}", source)
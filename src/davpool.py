@@ -0,0 +1,220 @@
+import asyncio
+import time
+from contextlib import asynccontextmanager
+from typing import Hashable
+
+import aiohttp
+import config
+import retry
+from aiodav.client import Client as DavClient
+
+from async_executor.loops import LoopLocal
+from chunking import MAX_CHUNK_SIZE
+
+# Largest chunk sent to the server, the reads are sized by a `ChunkSizer`
+CHUNK_SIZE = MAX_CHUNK_SIZE
+
+# Default time limit of the requests
+TIMEOUT = 60 * 60 * 2
+
+# A client without answers for longer is checked before it's used again
+HEALTH_INTERVAL = 60.0
+HEALTH_TIMEOUT = 10.0
+
+# Answers of a working server to the check: the server can reject OPTIONS
+# or ask for the credentials on it
+HEALTHY_STATUS = (401, 405)
+
+
+class _Entry(object):
+    __slots__ = (
+        "hostname",
+        "settings",
+        "client",
+        "users",
+        "used_at",
+        "answered_at",
+        "retired",
+    )
+
+    def __init__(self, hostname: str, settings: Hashable, client: DavClient) -> None:
+        self.hostname = hostname
+        self.settings = settings
+        self.client = client
+        self.users = 0
+        self.used_at = time.monotonic()
+        self.answered_at = self.used_at  # Last response of the server
+        self.retired = False
+
+
+class DavPool(object):
+    """
+    Reusable WebDAV clients of an event loop, one per (server, username). The
+    clients share keep-alive connections limited per host, so the tasks of a
+    user don't open a new connection (and TLS handshake) each time. An idle
+    client without answers of the server for a while is checked before it's
+    used and closed after `idle_timeout` seconds without use.
+    """
+
+    def __init__(self, limit_per_host: int = 8, idle_timeout: float = 300.0) -> None:
+        self.idle_timeout = idle_timeout
+        self.connector = aiohttp.TCPConnector(
+            limit_per_host=limit_per_host,
+            keepalive_timeout=min(idle_timeout, HEALTH_INTERVAL),
+        )
+        self._entries: dict[tuple[str, str], _Entry] = dict()
+        self._sessions: dict[aiohttp.ClientSession, _Entry] = dict()
+        self._sweeper: asyncio.TimerHandle | None = None
+
+        # Every response proves that the server of the client works
+        self._answers = aiohttp.TraceConfig()
+        self._answers.on_request_end.append(self._on_answer)
+
+    async def _on_answer(self, session: aiohttp.ClientSession, *args) -> None:
+        entry = self._sessions.get(session)
+        if entry is not None:
+            entry.answered_at = time.monotonic()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def _create(
+        self, hostname: str, login: str, password: str, timeout: int
+    ) -> DavClient:
+        # The credentials go in every request, with `auth` the client would
+        # make an extra request to authenticate before each one
+        headers = None
+        if login and password:
+            headers = {"Authorization": aiohttp.BasicAuth(login, password).encode()}
+
+        return DavClient(
+            hostname=hostname,
+            login=login,
+            password=password,
+            timeout=timeout,
+            chunk_size=CHUNK_SIZE,
+            session=aiohttp.ClientSession(
+                connector=self.connector,
+                connector_owner=False,
+                headers=headers,
+                timeout=aiohttp.ClientTimeout(total=timeout),
+                # The throttled responses tell the retries how long to wait
+                trace_configs=[retry.RETRY_AFTER.trace_config(), self._answers],
+            ),
+        )
+
+    async def _healthy(self, entry: _Entry) -> bool:
+        """
+        The server answers with the credentials of the client. The check has
+        its own connection, the ones of the pool can be all in use
+        """
+        entry.used_at = time.monotonic()
+        try:
+            async with aiohttp.request(
+                "OPTIONS",
+                entry.hostname,
+                headers=entry.client.session.headers,
+                timeout=aiohttp.ClientTimeout(total=HEALTH_TIMEOUT),
+            ) as response:
+                healthy = response.status < 400 or response.status in HEALTHY_STATUS
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            return False
+
+        if healthy:
+            entry.answered_at = time.monotonic()
+        return healthy
+
+    def _retire(self, key: tuple[str, str], entry: _Entry) -> None:
+        if self._entries.get(key) is entry:
+            self._entries.pop(key)
+        self._sessions.pop(entry.client.session, None)
+        entry.retired = True
+        if entry.users == 0:
+            asyncio.ensure_future(entry.client.session.close())
+
+    def _sweep(self) -> None:
+        self._sweeper = None
+        now = time.monotonic()
+        for key, entry in list(self._entries.items()):
+            if entry.users == 0 and now - entry.used_at >= self.idle_timeout:
+                self._retire(key, entry)
+
+        if len(self._entries) > 0:
+            self._sweeper = asyncio.get_running_loop().call_later(
+                self.idle_timeout, self._sweep
+            )
+
+    async def _acquire(
+        self, hostname: str, login: str, password: str, timeout: int
+    ) -> _Entry:
+        key = (hostname, login or "")
+        settings = (password, timeout)
+
+        entry = self._entries.get(key)
+        if entry is not None and (
+            entry.settings != settings or entry.client.session.closed
+        ):
+            self._retire(key, entry)
+            entry = None
+        elif (
+            entry is not None
+            and entry.users == 0  # The tasks using it would see the failures
+            and time.monotonic() - entry.answered_at > HEALTH_INTERVAL
+        ):
+            if not await self._healthy(entry):
+                self._retire(key, entry)
+                entry = None
+
+        if entry is None:
+            entry = self._entries.get(key)  # Created while it was checked
+            if entry is None or entry.retired:
+                entry = _Entry(
+                    hostname, settings, self._create(hostname, login, password, timeout)
+                )
+                self._entries[key] = entry
+                self._sessions[entry.client.session] = entry
+
+        entry.users += 1
+        entry.used_at = time.monotonic()
+        if self._sweeper is None:
+            self._sweeper = asyncio.get_running_loop().call_later(
+                self.idle_timeout, self._sweep
+            )
+        return entry
+
+    def _release(self, entry: _Entry) -> None:
+        entry.users -= 1
+        entry.used_at = time.monotonic()
+        if entry.retired and entry.users == 0:
+            asyncio.ensure_future(entry.client.session.close())
+
+    @asynccontextmanager
+    async def client(
+        self, hostname: str, login: str, password: str, timeout: int = TIMEOUT
+    ):
+        """Client of `login` in `hostname`, don't close it"""
+        entry = await self._acquire(hostname, login, password, timeout)
+        try:
+            yield entry.client
+        finally:
+            self._release(entry)
+
+    async def close(self) -> None:
+        if self._sweeper is not None:
+            self._sweeper.cancel()
+            self._sweeper = None
+        for key, entry in list(self._entries.items()):
+            self._retire(key, entry)
+        await self.connector.close()
+
+
+# Clients shared by the services and the modules running in the same loop
+POOLS: LoopLocal[DavPool] = LoopLocal(
+    lambda: DavPool(int(config.DAV_CONNECTIONS), float(config.DAV_IDLE_TIMEOUT)),
+    lambda x: x.close(),
+)
+
+
+def open_dav(hostname: str, login: str, password: str, timeout: int = TIMEOUT):
+    """Pooled WebDAV client of the running loop (use it with `async with`)"""
+    return POOLS.get().client(hostname, login, password, timeout)
@@ -0,0 +1,179 @@
+import asyncio
+import os
+import struct
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+from typing import AsyncGenerator, AsyncIterable
+
+from Cryptodome.Cipher import AES, ChaCha20_Poly1305
+from Cryptodome.Protocol.KDF import scrypt
+from Cryptodome.Random import get_random_bytes
+
+# Extension of the encrypted files
+EXTENSION = ".enc"
+
+MAGIC = b"WDENC"
+VERSION = 1
+
+# Ciphers
+AES_GCM = 1
+CHACHA20_POLY1305 = 2
+
+SEGMENT_SIZE = 1048576
+TAG_SIZE = 16
+
+# magic, version, cipher, segment size, key salt, nonce prefix
+HEADER = struct.Struct(">5sBBI16s7s")
+
+
+class DecryptionError(Exception):
+    """The data isn't an encrypted file, the password is wrong or it's damaged"""
+
+
+def encrypted_size(size: int) -> int:
+    segments = max(1, -(-size // SEGMENT_SIZE))
+    return HEADER.size + size + segments * TAG_SIZE
+
+
+def derive_key(password: str, salt: bytes) -> bytes:
+    return scrypt(password, salt, 32, N=2**15, r=8, p=1)
+
+
+def _nonce(prefix: bytes, index: int, last: bool) -> bytes:
+    # The flag of the last segment detects the truncated files
+    return prefix + struct.pack(">I?", index, last)
+
+
+def _cipher(algorithm: int, key: bytes, nonce: bytes):
+    if algorithm == AES_GCM:
+        return AES.new(key, AES.MODE_GCM, nonce=nonce, mac_len=TAG_SIZE)
+    if algorithm == CHACHA20_POLY1305:
+        return ChaCha20_Poly1305.new(key=key, nonce=nonce)
+    raise DecryptionError(f"Unknown cipher {algorithm}")
+
+
+def _seal(algorithm: int, key: bytes, nonce: bytes, data: bytes) -> bytes:
+    ciphertext, tag = _cipher(algorithm, key, nonce).encrypt_and_digest(data)
+    return ciphertext + tag
+
+
+def _open(algorithm: int, key: bytes, nonce: bytes, data: bytes) -> bytes:
+    try:
+        return _cipher(algorithm, key, nonce).decrypt_and_verify(
+            data[:-TAG_SIZE], data[-TAG_SIZE:]
+        )
+    except ValueError:
+        raise DecryptionError("Wrong password or damaged file")
+
+
+# Threads to seal and open the segments, the library releases the GIL
+_THREADS: ThreadPoolExecutor | None = None
+_THREADS_LOCK = Lock()
+
+
+def _threads() -> ThreadPoolExecutor:
+    global _THREADS
+    with _THREADS_LOCK:
+        if _THREADS is None:
+            _THREADS = ThreadPoolExecutor(
+                max_workers=os.cpu_count() or 1, thread_name_prefix="crypto"
+            )
+        return _THREADS
+
+
+async def _segments(
+    generator: AsyncIterable[bytes],
+    record: int,
+    process,
+) -> AsyncGenerator[bytes, None]:
+    """
+    Cut the stream in records of `record` bytes and yield `process(index,
+    data, last)` in order. The records are processed by the threads, up to
+    two per thread at the same time
+    """
+    loop = asyncio.get_running_loop()
+    depth = 2 * (os.cpu_count() or 1)
+    pending: deque[asyncio.Future] = deque()
+    buffer = bytearray()
+    index = 0
+
+    def submit(data: bytes, last: bool) -> None:
+        nonlocal index
+        pending.append(loop.run_in_executor(_threads(), process, index, data, last))
+        index += 1
+
+    try:
+        async for chunk in generator:
+            buffer += chunk
+            # A full record is the last one only if nothing follows it
+            while len(buffer) > record:
+                submit(bytes(buffer[:record]), False)
+                del buffer[:record]
+                while len(pending) >= depth or (len(pending) > 0 and pending[0].done()):
+                    yield await pending.popleft()
+
+        submit(bytes(buffer), True)
+        while len(pending) > 0:
+            yield await pending.popleft()
+    finally:
+        for future in pending:
+            future.cancel()
+
+
+async def encrypt(
+    generator: AsyncIterable[bytes],
+    password: str,
+    algorithm: int = AES_GCM,
+) -> AsyncGenerator[bytes, None]:
+    """
+    Encrypt the stream in independent segments of `SEGMENT_SIZE` bytes, every
+    segment has its own nonce and tag, so the data is never kept whole
+    """
+    salt, prefix = get_random_bytes(16), get_random_bytes(7)
+    key = await asyncio.get_running_loop().run_in_executor(
+        _threads(), derive_key, password, salt
+    )
+    yield HEADER.pack(MAGIC, VERSION, algorithm, SEGMENT_SIZE, salt, prefix)
+
+    def seal(index: int, data: bytes, last: bool) -> bytes:
+        return _seal(algorithm, key, _nonce(prefix, index, last), data)
+
+    async for data in _segments(generator, SEGMENT_SIZE, seal):
+        yield data
+
+
+async def decrypt(
+    generator: AsyncIterable[bytes], password: str
+) -> AsyncGenerator[bytes, None]:
+    """Decrypt a stream of `encrypt`, every segment is verified"""
+    iterator = aiter(generator)
+    header = bytearray()
+    while len(header) < HEADER.size:
+        chunk = await anext(iterator, None)
+        if chunk is None:
+            raise DecryptionError("Not an encrypted file")
+        header += chunk
+
+    header, rest = bytes(header[: HEADER.size]), bytes(header[HEADER.size :])
+    magic, version, algorithm, segment_size, salt, prefix = HEADER.unpack(header)
+    if magic != MAGIC or version != VERSION:
+        raise DecryptionError("Not an encrypted file")
+
+    key = await asyncio.get_running_loop().run_in_executor(
+        _threads(), derive_key, password, salt
+    )
+
+    def open_(index: int, data: bytes, last: bool) -> bytes:
+        if len(data) < TAG_SIZE:
+            raise DecryptionError("Truncated file")
+        return _open(algorithm, key, _nonce(prefix, index, last), data)
+
+    async def source() -> AsyncGenerator[bytes, None]:
+        if len(rest) > 0:
+            yield rest
+        async for chunk in iterator:
+            yield chunk
+
+    async for data in _segments(source(), segment_size + TAG_SIZE, open_):
+        yield data
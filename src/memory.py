@@ -0,0 +1,214 @@
+import asyncio
+import time
+from threading import Lock
+from typing import AsyncGenerator, AsyncIterable
+
+import config
+import psutil
+
+# Seconds between two samples of the process memory
+SAMPLE_INTERVAL = 0.5
+
+# Longest wait for the memory of a new task or a read, then it goes on anyway
+WAIT_TIMEOUT = 60.0
+
+
+def memory_limit() -> int:
+    """Memory available to the process: the cgroup limit or the system RAM"""
+    limit = psutil.virtual_memory().total
+    for path in (
+        "/sys/fs/cgroup/memory.max",  # cgroup v2
+        "/sys/fs/cgroup/memory/memory.limit_in_bytes",  # cgroup v1
+    ):
+        try:
+            with open(path) as file:
+                value = file.read().strip()
+        except OSError:
+            continue
+        if value.isdigit():
+            limit = min(limit, int(value))
+        break
+    return limit
+
+
+def _wake(future: asyncio.Future) -> None:
+    if not future.done():
+        future.set_result(None)
+
+
+class MemoryGovernor(object):
+    """
+    Backpressure of the pipelines by the memory in use. The bytes held in
+    memory by the pipelines and the process RSS are compared with two
+    watermarks: over the high one no task is admitted and nothing new is
+    buffered in memory, until both fall under the low one. Over the high
+    watermark of the held bytes the sources also wait before every read,
+    so the sinks drain what is held.
+
+    The RSS rarely goes down (the allocator keeps the freed memory), it only
+    pauses while the pipelines hold memory. Nothing waits longer than
+    `WAIT_TIMEOUT` seconds either way.
+
+    The pipelines can run in different event loops.
+    """
+
+    def __init__(
+        self,
+        limit: int,
+        high: float = 0.85,
+        low: float = 0.7,
+        buffered_high: int = 0,
+        buffered_low: int | None = None,
+    ) -> None:
+        self.limit = limit
+        self.rss_high = int(limit * high)
+        self.rss_low = int(limit * min(low, high))
+        self.buffered_high = buffered_high
+        self.buffered_low = (
+            buffered_low if buffered_low is not None else buffered_high // 2
+        )
+
+        self._process = psutil.Process()
+        self._lock = Lock()
+        self._rss = 0
+        self._sampled_at = 0.0
+        self._buffered = 0
+        self._paused = False
+        self._throttled = False
+        self._waiters: list[tuple[asyncio.AbstractEventLoop, asyncio.Future]] = []
+
+    @property
+    def rss(self) -> int:
+        with self._lock:
+            return self._rss
+
+    @property
+    def buffered(self) -> int:
+        with self._lock:
+            return self._buffered
+
+    @property
+    def waiting(self) -> int:
+        with self._lock:
+            return len(self._waiters)
+
+    def _sample(self) -> None:
+        # The RSS is sampled at most every half second
+        now = time.monotonic()
+        with self._lock:
+            sample = now - self._sampled_at >= SAMPLE_INTERVAL
+            if sample:
+                self._sampled_at = now
+        if sample:
+            rss = self._process.memory_info().rss
+            with self._lock:
+                self._rss = rss
+                self._update()
+
+    @property
+    def paused(self) -> bool:
+        """Over the watermarks, no new task or buffer"""
+        self._sample()
+        with self._lock:
+            return self._paused
+
+    @property
+    def throttled(self) -> bool:
+        """Over the watermark of the held bytes, the sources don't read"""
+        self._sample()
+        with self._lock:
+            return self._throttled
+
+    def _update(self) -> None:
+        # WARNING: Must be called with the lock held
+        held = self._buffered
+        limited = self.buffered_high > 0
+        released = False
+
+        if not self._throttled:
+            self._throttled = limited and held > self.buffered_high
+        elif held <= self.buffered_low:
+            self._throttled = False
+            released = True
+
+        if not self._paused:
+            self._paused = self._throttled or (held > 0 and self._rss > self.rss_high)
+        elif not self._throttled and (held == 0 or self._rss <= self.rss_low):
+            self._paused = False
+            released = True
+
+        if released:
+            for loop, future in self._waiters:
+                loop.call_soon_threadsafe(_wake, future)
+            self._waiters.clear()
+
+    def track(self, size: int) -> None:
+        """Account `size` bytes held in memory by a pipeline"""
+        with self._lock:
+            self._buffered += size
+            self._update()
+
+    def untrack(self, size: int) -> None:
+        with self._lock:
+            self._buffered -= size
+            self._update()
+
+    async def wait(self, timeout: float = WAIT_TIMEOUT, read: bool = False) -> None:
+        """
+        Wait until the memory is under the low watermarks (only the one of
+        the held bytes for a `read`), at most `timeout` seconds
+        """
+        deadline = time.monotonic() + timeout
+        while (self.throttled if read else self.paused) and (
+            time.monotonic() < deadline
+        ):
+            loop = asyncio.get_running_loop()
+            future = loop.create_future()
+            with self._lock:
+                self._waiters.append((loop, future))
+
+            # Woken by a release, or polled while the RSS goes down
+            try:
+                await asyncio.wait_for(
+                    asyncio.shield(future),
+                    max(0, min(SAMPLE_INTERVAL, deadline - time.monotonic())),
+                )
+            except asyncio.TimeoutError:
+                with self._lock:
+                    if (loop, future) in self._waiters:
+                        self._waiters.remove((loop, future))
+
+    async def governed(
+        self, generator: AsyncIterable[bytes]
+    ) -> AsyncGenerator[bytes, None]:
+        """
+        Yield the chunks of `generator`, a chunk isn't read while too many
+        bytes are held (at most `WAIT_TIMEOUT` seconds). A chunk is accounted
+        until the consumer asks for the next one
+        """
+        held = 0
+        try:
+            iterator = aiter(generator)
+            while True:
+                await self.wait(read=True)
+                chunk = await anext(iterator, None)
+                if chunk is None:
+                    break
+
+                self.track(len(chunk))
+                held = len(chunk)
+                yield chunk
+                self.untrack(held)
+                held = 0
+        finally:
+            if held > 0:
+                self.untrack(held)
+
+
+# Memory governor of all the tasks
+GOVERNOR = MemoryGovernor(
+    (int(config.MEMORY_LIMIT) * 1024 * 1024) or memory_limit(),
+    int(config.MEMORY_HIGH_WATERMARK) / 100,
+    int(config.MEMORY_LOW_WATERMARK) / 100,
+    int(config.BUFFERED_WATERMARK) * 1024 * 1024,
+)
@@ -1,6 +1,7 @@
 import asyncio
 import os
-from typing import Callable
+import re
+from typing import AsyncGenerator, Callable
 from urllib.parse import urlparse
 
 from aiodav.client import Client as DavClient
@@ -15,12 +16,44 @@ from pyrogram.types import (
 )
 
 import dialogs
-import tempfile
 from context import UserContext
 from database import Database
+from davpool import open_dav
+from encryption import EXTENSION, DecryptionError, decrypt
 from humanize import naturalsize
+from memory import GOVERNOR
 from module import Module
 from button import ButtonFactory
+from storage import STORAGE
+
+
+async def encrypted_pieces(dav: DavClient, path: str) -> list[str]:
+    """
+    Paths of the pieces of the split encrypted file (`name.enc.001`,
+    `name.enc.002`, ...) that `path` belongs to, in order
+    """
+    directory, name = os.path.split(path)
+    stem = name.rsplit(".", 1)[0]
+    pattern = re.compile(re.escape(stem) + r"\.(\d{3})")
+
+    numbers = sorted(
+        int(x.group(1))
+        for x in map(pattern.fullmatch, await dav.list(directory or "/"))
+        if x is not None
+    )
+    for i, number in enumerate(numbers):
+        if number != i + 1:
+            raise DecryptionError(f"the piece #{i + 1} of {stem} is missing")
+    return [os.path.join(directory, f"{stem}.{x:0=3}") for x in numbers]
+
+
+async def download_pieces(
+    dav: DavClient, paths: list[str]
+) -> AsyncGenerator[bytes, None]:
+    """Content of the files of `paths` joined"""
+    for path in paths:
+        async for chunk in await dav.download_iter(path):
+            yield chunk
 
 
 class FileModule(Module):
@@ -38,10 +71,8 @@ class FileModule(Module):
         cwd = "/"
         ret = urlparse(data["server-uri"])
 
-        async with DavClient(
-            hostname=data["server-uri"],
-            login=data["username"],
-            password=data["password"],
+        async with open_dav(
+            data["server-uri"], data["username"], data["password"]
         ) as dav:
             try:
 
@@ -115,29 +146,53 @@ class FileModule(Module):
 
         name = os.path.basename(path)
         data = self.database.get_data(user)
+        password = data.get("file-password", "")
 
-        async with DavClient(
-            hostname=data["server-uri"],
-            login=data["username"],
-            password=data["password"],
+        async with open_dav(
+            data["server-uri"], data["username"], data["password"]
         ) as dav:
             try:
-                with tempfile.NamedTemporaryFile() as file:
-                    # Download to temporary file
-                    message = await app.send_message(user, "Downloading file ...")
-                    await dav.download_to(path, file)
-                    await message.delete(True)
-
-                    assert file.seek(0) == 0, "Unable to seek"
-
-                    # Upload
-                    message = await app.send_message(user, "Uploading file ...")
-                    await app.send_document(user, file, file_name=name)
-                    await message.delete(True)
+                # Not started while the memory is exhausted
+                await GOVERNOR.wait()
+
+                # Not preallocated, the size of the file is the sent size
+                async with await STORAGE.reserve(None) as reservation:
+                    with reservation.temporary_file() as file:
+                        # Download to temporary file
+                        message = await app.send_message(user, "Downloading file ...")
+                        paths = [path]
+                        if password and re.fullmatch(
+                            rf".+{re.escape(EXTENSION)}\.\d{{3}}", name
+                        ):
+                            # A piece of a split encrypted file, the whole
+                            # file is joined and decrypted
+                            paths = await encrypted_pieces(dav, path)
+                            name = name.rsplit(".", 1)[0]
+
+                        if password and name.endswith(EXTENSION):
+                            # Decrypted while it's downloaded
+                            name = name.removesuffix(EXTENSION)
+                            async for chunk in GOVERNOR.governed(
+                                decrypt(download_pieces(dav, paths), password)
+                            ):
+                                file.write(chunk)
+                            file.flush()
+                        else:
+                            await dav.download_to(path, file)
+                        await message.delete(True)
+
+                        assert file.seek(0) == 0, "Unable to seek"
+
+                        # Upload
+                        message = await app.send_message(user, "Uploading file ...")
+                        await app.send_document(user, file, file_name=name)
+                        await message.delete(True)
             except RemoteResourceNotFound:
                 await app.send_message(
                     user, f"Resource **{path}** isn't longer available"
                 )
+            except DecryptionError as e:
+                await app.send_message(user, f"Unable to decrypt **{path}**: {e}")
             except Exception as e:
                 await app.send_message(
                     user, f"Unexpected error while delete **{path}**: {e}"
@@ -151,10 +206,8 @@ class FileModule(Module):
         name = os.path.basename(path)
         data = self.database.get_data(user)
 
-        async with DavClient(
-            hostname=data["server-uri"],
-            login=data["username"],
-            password=data["password"],
+        async with open_dav(
+            data["server-uri"], data["username"], data["password"]
         ) as dav:
             try:
                 await dav.unlink(path)
@@ -178,10 +231,8 @@ class FileModule(Module):
         user = message.from_user.id
         data = self.database.get_data(user)
 
-        async with DavClient(
-            hostname=data["server-uri"],
-            login=data["username"],
-            password=data["password"],
+        async with open_dav(
+            data["server-uri"], data["username"], data["password"]
         ) as dav:
             try:
                 n = await dav.free()
@@ -206,10 +257,8 @@ class FileModule(Module):
         )
 
         if answer == "Yes":
-            async with DavClient(
-                hostname=data["server-uri"],
-                login=data["username"],
-                password=data["password"],
+            async with open_dav(
+                data["server-uri"], data["username"], data["password"]
             ) as dav:
                 try:
                     nodes = await dav.list()
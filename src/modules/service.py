@@ -1,40 +1,97 @@
 import asyncio
 import functools
 import aiofiles
+import aiohttp
+import config
+import davpool
+import json
+import retry
 import utils
 import os
+import time
 
 # import copy
 
 # import aiofiles.tempfile
-import tempfile
 
 from pyrogram.types import Message
 from aiofiles.threadpool.binary import AsyncBufferedIOBase
+from async_executor.loops import LoopLocal
+from async_executor.stages import StageRunner, StageStream, TreeHashStage, merkle_root
 from async_executor.task import Task, TaskState
+from buffers import BufferPool, PooledFile
+from chunking import ChunkSizer
+from coalesce import COALESCER, CoalescedSourceError, FlightHandle
+from compression import UPLINK, ZstdStage, choose_level, is_compressed, threads
+from encryption import EXTENSION, encrypt, encrypted_size
+from memory import GOVERNOR
+from slices import FileSlice, file_descriptor
+from storage import STORAGE
 from aiodav.client import Client as DavClient
 from pyrogram import emoji, Client
 from asyncio.exceptions import CancelledError
-from typing import Any, AsyncGenerator, Callable
+from contextlib import asynccontextmanager
+from typing import Any, AsyncGenerator, Awaitable, Callable
 from io import IOBase
-from Cryptodome.Hash import SHA1
+
+# Keep-alive connections shared by the services running in the same loop
+CONNECTORS: LoopLocal[aiohttp.TCPConnector] = LoopLocal(
+    aiohttp.TCPConnector, lambda x: x.close()
+)
+
+# Reusable memory buffers for the small files, instead of temporary files.
+# A file larger than announced moves to the temporary storage
+BUFFERS = BufferPool(
+    int(config.MEMORY_FILE_SIZE) * 1024 * 1024,
+    int(config.MEMORY_BUFFERS),
+    STORAGE.spill,
+)
+
+# Worker processes for the CPU-bound stages (checksums), off the event loop
+STAGES = StageRunner(int(config.STAGE_WORKERS) if config.STAGE_WORKERS != "" else None)
 
 
 class Service(Task):
+    # Arguments that can't be stored in the task journal (objects and secrets)
+    TRANSIENT_KWARGS = (
+        "user",
+        "file_message",
+        "pyrogram",
+        "password",
+        "file_password",
+        "push_task_method",
+        "checkpoint_method",
+        "completed_pieces",
+        "record_piece_method",
+        "lookup_piece_method",
+        "index_method",
+        "lookup_method",
+        "forget_method",
+        "journal_id",
+    )
+
     def __init__(self, *args, **kwargs) -> None:
         self.user: int = kwargs.get("user")
         self.file_message: Message = kwargs.get("file_message")
 
-        self.pyrogram: Client = kwargs.get("pyrogram", self.file_message._client)
+        self._pyrogram: Client = kwargs.get("pyrogram", self.file_message._client)
         self.split_size: int = kwargs.get("split_size", 100) * 1024 * 1024  # Bytes
         self.use_streaming: bool = kwargs.get("streaming", False)
         self.parallel: bool = kwargs.get("parallel", False)
+        self.pieces_in_flight: int = kwargs.get("pieces_in_flight", 2)
+        self.parallel_uploads: int = kwargs.get("parallel_uploads", 4)
         self.checksum: bool = kwargs.get("checksum", True)
         self.overwrite: bool = kwargs.get("overwrite", False)
+        self.resume: bool = kwargs.get("resume", True)
+        self.compression: bool = kwargs.get("compression", False)
+        self.file_password: str = kwargs.get("file_password", "")
+        self._remote_sizes: dict[str, int] | None = None
+
+        self.checksum_algorithm: str = kwargs.get("checksum_algorithm", "sha1")
 
         if self.checksum:
-            self.sha1 = None
             self.sums = dict()
+            self.trees = dict()  # Hash tree of every remote file
 
         self.webdav_hostname: str = kwargs.get("hostname")
         self.webdav_username: str = kwargs.get("username")
@@ -42,12 +99,232 @@ class Service(Task):
         self.webdav_path: str = kwargs.get("path")
         self.timeout: int = kwargs.get("timeout", 60 * 60 * 2)
 
+        # Journal to resume the task after a restart
+        self.journal_id: str | None = kwargs.get("journal_id")
+        self.checkpoint_method: Callable[[str, str, int], None] | None = kwargs.get(
+            "checkpoint_method"
+        )
+        self.completed_pieces: set[str] = set(kwargs.get("completed_pieces", ()))
+        # Digest of the pieces of the user, a piece is only reused if it matches
+        self.record_piece_method: Callable[[int, str, dict], None] | None = kwargs.get(
+            "record_piece_method"
+        )
+        self.lookup_piece_method: Callable[[int, str], dict | None] | None = kwargs.get(
+            "lookup_piece_method"
+        )
+
+        # Content index of the user, to copy the sources already uploaded
+        self.index_method: Callable[[int, str, str, dict], None] | None = kwargs.get(
+            "index_method"
+        )
+        self.lookup_method: Callable[[int, str], dict | None] | None = kwargs.get(
+            "lookup_method"
+        )
+        self.forget_method: Callable[[int, str], None] | None = kwargs.get(
+            "forget_method"
+        )
+        self.uploaded: dict[str, int] = dict()  # Remote files of this task
+        # (name, indexed path or `None` if it's in place) of the index hits
+        self.deduplicated: list[tuple[str, str | None]] = []
+
+        if self.file_password:
+            # Every upload of an encrypted file has a new key and nonces, the
+            # pieces of a previous upload can't be reused
+            self.resume = False
+            self.completed_pieces = set()
+
         super().__init__(**kwargs)
 
     @staticmethod
     def check(message: Message) -> bool:
         raise NotImplementedError
 
+    def descriptor(self) -> dict[str, Any]:
+        """Data needed to schedule again this task"""
+        kwargs = dict()
+        for k, v in self.kwargs.items():
+            if k in Service.TRANSIENT_KWARGS:
+                continue
+            try:
+                json.dumps(v)
+            except TypeError:
+                continue
+            kwargs[k] = v
+
+        return {
+            "service": type(self).__name__,
+            "user": self.user,
+            "chat": self.file_message.chat.id,
+            "message": self.file_message.id,
+            "kwargs": kwargs,
+        }
+
+    def checkpoint(self, remote_name: str, length: int) -> None:
+        """Mark a remote piece as completely uploaded"""
+        self.completed_pieces.add(remote_name)
+        self.uploaded[remote_name] = length
+        if self.checkpoint_method is not None and self.journal_id is not None:
+            self.checkpoint_method(self.journal_id, remote_name, length)
+
+    @property
+    def pyrogram(self) -> Client:
+        # The client belongs to the home loop, bridge it from the worker loops
+        return self.bridge(self._pyrogram)
+
+    async def retry(
+        self,
+        policy: retry.RetryPolicy,
+        operation: Callable[[], Awaitable[Any]],
+        track: bool = True,
+    ) -> Any:
+        """Await `operation()` with the retry `policy`, the retries are shown"""
+
+        def on_retry(attempt: int, error: Exception, delay: float) -> None:
+            if track:
+                self.set_state(
+                    TaskState.WORKING,
+                    description=f"{emoji.CLOCKWISE_VERTICAL_ARROWS} Trying again in {delay:.0f}s at error ({attempt} attempts): {error}",
+                )
+
+        return await policy.run(operation, on_retry)
+
+    def coalesce(self, key: Any):
+        """
+        Join the in-flight download of the source identified by `key`, only
+        the leader of the flight downloads it
+        """
+        if not utils.get_bool(config.COALESCE_DOWNLOADS):
+            key = None
+        return COALESCER.join(key)
+
+    async def coalesced(
+        self, key: Any, fetch: Callable[[FlightHandle], Awaitable[Any]]
+    ) -> Any:
+        """
+        Run `fetch` in the flight of `key`. A follower whose leader didn't
+        finish (failed or was cancelled) runs it again out of any flight, so
+        it downloads the source by itself
+        """
+        async with self.coalesce(key) as flight:
+            try:
+                return await fetch(flight)
+            except CoalescedSourceError:
+                if flight.leader:
+                    raise
+
+        self.set_state(
+            TaskState.WORKING,
+            description=f"{emoji.CLOCKWISE_VERTICAL_ARROWS} The shared download stopped, downloading it again",
+        )
+        async with self.coalesce(None) as flight:
+            return await fetch(flight)
+
+    @asynccontextmanager
+    async def content_index(self, dav: DavClient, source: str | None):
+        """
+        Look up the source identity (known before download it) in the content
+        index of the user. On a hit the indexed files are copied in the server
+        (or are already in place) and the context gets `True`, otherwise the
+        files uploaded inside the context are indexed
+        """
+        if await self.find_indexed(dav, source):
+            yield True
+            return
+
+        source = self.index_key(source)
+
+        mark = len(self.uploaded)
+        yield False
+        names = list(self.uploaded)[mark:]
+        if source is not None and len(names) > 0 and self.index_method is not None:
+            self.index_uploaded(source, names)
+
+    def index_key(self, source: str | None) -> str | None:
+        """Key of the source in the content index, `None` if it's not indexed"""
+        if (
+            source is None
+            or self.lookup_method is None
+            or self.overwrite
+            or self.file_password  # Other password would be needed
+        ):
+            return None
+        # The compressed uploads are other content
+        return f"{source}:zst" if self.compression else source
+
+    def index_uploaded(self, source: str, names: list[str]) -> None:
+        files = [[os.path.join(self.webdav_path, x), self.uploaded[x]] for x in names]
+        manifests = [x for x in names if x.endswith(".manifest.json")]
+        size = sum(self.uploaded[x] for x in names if x not in manifests)
+
+        # Content of the whole file: its root or the root of the manifest
+        tree = (
+            self.trees.get(manifests[0] if manifests else names[0])
+            if self.checksum
+            else None
+        )
+        root = tree["root"] if tree is not None else None
+        content = f"{self.checksum_algorithm}:{root}:{size}" if root else source
+
+        self.index_method(
+            self.user,
+            source,
+            content,
+            {"server": self.webdav_hostname, "files": files, "size": size},
+        )
+
+    async def find_indexed(self, dav: DavClient, source: str | None) -> bool:
+        """Copy the indexed files of `source` to the upload path, if any"""
+        source = self.index_key(source)
+        if source is None:
+            return False
+
+        entry = self.lookup_method(self.user, source)
+        if entry is None or entry.get("server") != self.webdav_hostname:
+            return False
+
+        # The files could be removed or replaced since they were indexed
+        try:
+            for path, size in entry["files"]:
+                info = await dav.info(path)
+                if int(info.get("size") or -1) != size:
+                    raise ValueError(f"{path} changed")
+        except CancelledError:
+            raise
+        except Exception:
+            if self.forget_method is not None:
+                self.forget_method(self.user, source)
+            return False
+
+        for path, _ in entry["files"]:
+            name = os.path.basename(path)
+            destination = os.path.join(self.webdav_path, name)
+            if os.path.normpath(destination) == os.path.normpath(path):
+                self.deduplicated.append((name, None))
+                continue
+
+            self.set_state(
+                TaskState.WORKING,
+                description=f"{emoji.CLIPBOARD} Copying **{name}** from {os.path.dirname(path)}",
+            )
+            await dav.copy(path, destination)
+            self.deduplicated.append((name, path))
+        return True
+
+    def open_session(self, **kwargs) -> aiohttp.ClientSession:
+        """HTTP session bound to the connections of the running loop"""
+        return aiohttp.ClientSession(
+            connector=CONNECTORS.get(), connector_owner=False, **kwargs
+        )
+
+    def open_dav(self):
+        """Pooled WebDAV client of the running loop (use it with `async with`)"""
+        return davpool.open_dav(
+            self.webdav_hostname,
+            self.webdav_username,
+            self.webdav_password,
+            self.timeout,
+        )
+
     @staticmethod
     def settings() -> (
         dict[str, tuple[str, str, str | dict, Callable[[str], Any]]] | None
@@ -65,14 +342,165 @@ class Service(Task):
 
         return pieces
 
-    def upload(self, *args, **kwargs):
+    async def open_spool(self, size: int | None) -> IOBase:
+        """
+        Temporary file for `size` bytes, in memory for the small files while
+        the memory isn't exhausted. The others wait for their space in the
+        temporary storage
+        """
+        if size is not None and size <= BUFFERS.size and not GOVERNOR.paused:
+            file = BUFFERS.open()
+            if file is not None:
+                return file
+        reservation = await STORAGE.reserve(size)
+        try:
+            return reservation.temporary_file()
+        except BaseException:
+            reservation.release()
+            raise
+
+    async def write_spool(self, file: IOBase, data: bytes) -> None:
+        """
+        Write in a file of `open_spool`, a memory buffer that overflows waits
+        its turn for the temporary storage
+        """
+        if isinstance(file, PooledFile):
+            await file.make_room(len(data))
+        file.write(data)
+
+    @asynccontextmanager
+    async def scratch(self, size: int | None = None):
+        """Temporary directory for `size` bytes (`None` if unknown)"""
+        async with await STORAGE.reserve(size) as reservation:
+            yield reservation.directory
+
+    async def cut_pieces(
+        self, generator: AsyncGenerator[bytes, None]
+    ) -> AsyncGenerator[bytes, None]:
+        """Cut the chunks at the pieces boundaries, so no piece exceeds `split_size`"""
+        position = 0
+        async for chunk in generator:
+            room = self.split_size - position % self.split_size
+            if len(chunk) <= room:
+                position += len(chunk)
+                yield chunk
+                continue
+
+            view = memoryview(chunk)
+            while len(view) > 0:
+                part = bytes(view[:room])
+                view = view[len(part) :]
+                position += len(part)
+                room = self.split_size
+                yield part
+
+    def upload(
+        self,
+        dav: DavClient,
+        filename: str,
+        file_size: int,
+        generator: AsyncGenerator[bytes, None],
+    ):
         if self.parallel:
             func = self.copy if self.split_size <= 0 else self.upload_parallel
         elif self.use_streaming:
             func = self.streaming if self.split_size <= 0 else self.streaming_by_pieces
         else:
             func = self.copy
-        return func(*args, **kwargs)
+
+        # The source isn't read while the pipelines hold too much memory
+        generator = GOVERNOR.governed(generator)
+        if self.compression or self.file_password:
+            return self.encode(func, dav, filename, file_size, generator)
+        return func(dav, filename, file_size, generator)
+
+    async def encode(
+        self,
+        func: Callable,
+        dav: DavClient,
+        filename: str,
+        file_size: int,
+        generator: AsyncGenerator[bytes, None],
+    ) -> None:
+        """Compress and encrypt the stream before `func` uploads it"""
+        if self.compression:
+            filename, file_size, generator = await self.compress(
+                filename, file_size, generator
+            )
+
+        if self.file_password:
+            filename = f"{filename}{EXTENSION}"
+            file_size = encrypted_size(file_size) if file_size is not None else None
+            generator = encrypt(generator, self.file_password)
+
+        await func(dav, filename, file_size, generator)
+
+    async def compress(
+        self,
+        filename: str,
+        file_size: int,
+        generator: AsyncGenerator[bytes, None],
+    ) -> tuple[str, int | None, AsyncGenerator[bytes, None]]:
+        """
+        Compress the stream with zstd. The level is chosen from the first
+        chunk, the uplink speed and the cores. The compressed media and the
+        incompressible data are left as is
+        """
+        if is_compressed(filename):
+            return filename, file_size, generator
+
+        first = b""
+        async for chunk in generator:
+            first = chunk
+            break
+
+        async def source() -> AsyncGenerator[bytes, None]:
+            if len(first) > 0:
+                yield first
+            async for chunk in generator:
+                yield chunk
+
+        level = await asyncio.to_thread(choose_level, first, UPLINK.rate)
+        if level is None:
+            return filename, file_size, source()
+
+        async def compressed() -> AsyncGenerator[bytes, None]:
+            stage = STAGES.open(ZstdStage, level, threads())
+            try:
+                async for chunk in source():
+                    data = await stage.transform(chunk)
+                    if len(data) > 0:
+                        yield data
+            finally:
+                data = await stage.close()
+            if data:
+                yield data
+
+        # The size of the compressed file isn't known until the end
+        return f"{filename}.zst", None, compressed()
+
+    async def send_file(
+        self,
+        dav: DavClient,
+        file: IOBase,
+        file_size: int,
+        filename: str = None,
+        title: str = None,
+    ) -> None:
+        """Upload a local file, through the compression and encryption if on"""
+        if not self.file_password and (
+            not self.compression or is_compressed(filename or file.name)
+        ):
+            return await self.upload_file(
+                dav, file, file_size, title=title, filename=filename
+            )
+
+        await self.upload(
+            dav,
+            filename or os.path.basename(file.name),
+            file_size,
+            self.read_piece(file, 0, file_size),
+        )
 
     async def upload_parallel(
         self,
@@ -81,18 +509,76 @@ class Service(Task):
         file_size: int,
         generator: AsyncGenerator[bytes, None],
     ):
-        with tempfile.TemporaryDirectory() as directory:
-            k = 1
-            offset = 0
-            paths = [os.path.join(directory, f"{k}")]
-            file = open(paths[-1], "wb")
+        """
+        Split the source in pieces while it's downloaded, every finished piece
+        is uploaded by a child task. Up to `parallel_uploads` pieces are
+        uploaded at the same time
+        """
+        slots = asyncio.Semaphore(max(1, self.parallel_uploads))
 
-            self.set_state(
-                TaskState.WORKING, description=f"{emoji.HOURGLASS_DONE} Downloading"
-            )
+        async def get_file(service: "Service", path: str, length: int, index: int):
+            service.set_state(TaskState.STARTING)
 
+            # The child can run in other loop, so it needs its own client
+            async with service.open_dav() as dav, aiofiles.open(path, "rb") as file:
+                await service.upload_file(
+                    dav,
+                    file,
+                    length,
+                    description=f"Piece {index}",
+                    filename=f"{filename}.{index:0=3}",
+                    piece=True,
+                )
+
+        k = 1
+        offset = 0
+        names = []
+        failed: list[tuple[int, TaskState]] = []  # Pieces not uploaded
+
+        def check_pieces() -> None:
+            if len(failed) > 0:
+                pieces = ", ".join(
+                    f"#{index} ({state.name.lower()})"
+                    for index, state in sorted(failed)
+                )
+                raise Exception(f"Unable to upload the pieces {pieces}")
+
+        def upload_piece(reservation, path: str, length: int, index: int) -> None:
+            names.append(utils.sanitaze_filename(f"{filename}.{index:0=3}"))
+            child = self.clone(child=True)  # Make a clone with this service data
+            child.start = functools.partial(get_file, child, path, length, index)
+
+            # The piece is removed with its reservation once it's uploaded
+            def on_end(child: Task) -> None:
+                state, _ = child.state
+                if state != TaskState.SUCCESSFULL:
+                    failed.append((index, state))
+                reservation.release()
+                slots.release()
+
+            self.schedule_child(child, on_end_callback=on_end)
+
+        async def new_piece():
+            # Wait for a free upload slot and the space of the piece
+            await slots.acquire()
+            try:
+                check_pieces()  # Stop the download once a piece failed
+                reservation = await STORAGE.reserve(self.split_size)
+                return reservation, reservation.create(f"{k}")
+            except BaseException:
+                slots.release()
+                raise
+
+        reservation, file = await new_piece()
+
+        self.reset_stats()
+        self.set_state(
+            TaskState.WORKING, description=f"{emoji.HOURGLASS_DONE} Downloading"
+        )
+
+        try:
             # Download and generate the chunks
-            async for chunk in generator:
+            async for chunk in self.cut_pieces(generator):
                 offset += len(chunk)
                 self.make_progress(offset, file_size)
 
@@ -101,45 +587,38 @@ class Service(Task):
                 # reach size limit
                 length = file.tell()
                 if length >= self.split_size:
+                    file.truncate()
                     file.close()
+                    upload_piece(reservation, file.name, length, k)
+                    reservation = None
 
-                    # Change to the next file
-                    paths.append(os.path.join(directory, f"{k}"))
-                    file = open(paths[-1], "wb")
+                    # Change to the next file once a upload slot is free
+                    k += 1
+                    reservation, file = await new_piece()
+        except BaseException:
             file.close()
+            if reservation is not None:
+                reservation.release()
+                slots.release()
+            raise
 
-            async def get_file(service: "Service", path: str, index: int):
-                service.set_state(TaskState.STARTING)
-
-                async with aiofiles.open(path, "rb") as file:
-                    length = os.path.getsize(path)
-                    await service.upload_file(
-                        dav,
-                        file,
-                        length,
-                        description=f"Piece {index}",
-                        filename=f"{filename}.{index:0=3}",
-                    )
-                try:
-                    os.unlink(path)
-                except Exception:
-                    pass
-
-            # await asyncio.gather([get_file(x) for x in files])
-            # Schedule the tasks
-            self.reset_stats()
-            self.set_state(
-                TaskState.WORKING, description=f"{emoji.HOURGLASS_DONE} Uploading"
-            )
-            self.make_progress(None, None)
-
-            for i, path in enumerate(paths):
-                child = self.clone(child=True)  # Make a clone with this service data
-                child.start = functools.partial(get_file, child, path, i + 1)
-
-                self.schedule_child(child)
+        length = file.tell()
+        file.truncate()
+        file.close()
+        if length > 0:
+            upload_piece(reservation, file.name, length, k)
+        else:
+            reservation.release()
+            slots.release()
 
-            await self.wait_for_childs()
+        self.set_state(
+            TaskState.WORKING,
+            description=f"{emoji.HOURGLASS_DONE} Uploading the last pieces",
+        )
+        await self.wait_for_childs()
+        # An incomplete file isn't described by a manifest nor indexed
+        check_pieces()
+        await self.upload_manifest(dav, filename, names)
 
     async def copy(
         self,
@@ -150,7 +629,7 @@ class Service(Task):
     ) -> None:
         """Download the whole file before to send it to the webdav server"""
 
-        with tempfile.TemporaryFile() as file:
+        with await self.open_spool(file_size) as file:
             self.set_state(
                 TaskState.WORKING,
                 description=f"{emoji.HOURGLASS_DONE} Downloading to local filesystem",
@@ -161,13 +640,16 @@ class Service(Task):
             async for chunk in generator:
                 offset += len(chunk)
                 self.make_progress(offset, file_size)
-                file.write(chunk)
+                await self.write_spool(file, chunk)
 
+            # The file was preallocated for the declared size, only the
+            # downloaded bytes are sent
+            file.truncate(offset)
             file.flush()
             await self.upload_file(
                 dav,
                 file,
-                (file_size or offset),
+                offset,
                 filename=filename,
             )
 
@@ -187,6 +669,12 @@ class Service(Task):
         )
         self.reset_stats()
 
+        digest = (
+            STAGES.open(TreeHashStage, self.checksum_algorithm)
+            if self.checksum
+            else None
+        )
+
         async def file_sender():
             offset = 0
 
@@ -194,18 +682,23 @@ class Service(Task):
                 offset += len(chunk)
                 self.make_progress(offset, file_size)
 
-                if self.checksum:
-                    self.sha1.update(chunk)
+                if digest is not None:
+                    await digest.feed(chunk)
 
                 yield chunk
 
-        if self.checksum:
-            self.sha1 = SHA1.new()
-
-        await dav.upload_to(remote_path, buffer=file_sender(), overwrite=self.overwrite)
+        try:
+            await dav.upload_to(
+                remote_path, buffer=file_sender(), overwrite=self.overwrite
+            )
+        finally:
+            if digest is not None:
+                await digest.close()
 
-        if self.checksum:
-            self.sums[name] = self.sha1.hexdigest()
+        if digest is not None:
+            self.trees[name] = digest.result
+            self.sums[name] = digest.result["digest"]
+        self.checkpoint(name, self.progress[0] or 0)
 
     async def streaming_by_pieces(
         self,
@@ -214,58 +707,217 @@ class Service(Task):
         file_size: int,
         generator: AsyncGenerator[bytes, None],
     ) -> None:
-        """Download a small piece with specified size and upload it"""
-        with tempfile.TemporaryFile() as file:
-            k = 1
-            offset = 0
-            pieces = self.get_pieces_count(file_size)
+        """
+        Download a small piece with specified size and upload it. Up to
+        `pieces_in_flight` pieces are kept in disk, so the next pieces are
+        downloaded while the previous ones are uploaded
+        """
+        pieces = self.get_pieces_count(file_size)
+        slots = asyncio.Semaphore(max(1, self.pieces_in_flight))
+        queue: asyncio.Queue[tuple | None] = asyncio.Queue()
+        downloading, uploading = 1, None
+        names = []
 
-            async for chunk in generator:
-                self.set_state(
-                    TaskState.WORKING, description=f"{emoji.HOURGLASS_DONE} Downloading"
+        def update_state() -> None:
+            text = f"{emoji.HOURGLASS_DONE} Downloading piece #{downloading}"
+            if pieces is not None:
+                text += f" of {pieces}"
+            if uploading is not None:
+                text += f", uploading piece #{uploading}"
+            self.set_state(TaskState.WORKING, description=text)
+
+        async def upload(file: IOBase, length: int, k: int, last: bool) -> None:
+            nonlocal uploading
+            uploading = k
+            update_state()
+            name = f"{filename}.{k:0=3}" if not (last and k == 1) else filename
+            names.append(utils.sanitaze_filename(name))
+            try:
+                file.flush()
+                await self.upload_file(
+                    dav,
+                    file,
+                    length,
+                    filename=name,
+                    track=False,
+                    piece=not (last and k == 1),
                 )
+            finally:
+                file.close()
+                slots.release()
+                uploading = None
+
+        async def uploader() -> None:
+            while (item := await queue.get()) is not None:
+                await upload(*item)
+
+        worker = asyncio.create_task(uploader())
+
+        async def new_piece() -> IOBase:
+            # Wait for a free place in the pipeline or for the uploader to fail
+            acquire = asyncio.ensure_future(slots.acquire())
+            await asyncio.wait({acquire, worker}, return_when=asyncio.FIRST_COMPLETED)
+            if not acquire.done():
+                acquire.cancel()
+            if worker.done():
+                if acquire.done() and not acquire.cancelled():
+                    slots.release()
+                worker.result()
+                raise RuntimeError("The uploader finished before the source")
+            return await self.open_spool(
+                min(file_size, self.split_size)
+                if file_size is not None
+                else self.split_size
+            )
+
+        file = None
+        try:
+            k = 1
+            offset = 0
+            self.reset_stats()
+            update_state()
+            file = await new_piece()
 
+            async for chunk in self.cut_pieces(generator):
                 offset += len(chunk)
                 self.make_progress(offset, file_size)
 
-                file.write(chunk)
+                await self.write_spool(file, chunk)
 
                 # reach size limit
                 length = file.tell()
                 if length >= self.split_size:
-                    file.flush()
-                    await self.upload_file(
-                        dav,
-                        file,
-                        length,
-                        filename=f"{filename}.{k:0=3}",
-                        title=f"{filename} [Piece #{k}]"
-                        if pieces is None
-                        else f"{filename} [{k}/{pieces}]",
-                    )
-
-                    assert file.seek(0) == 0, "Impossible seek to start of stream"
-                    assert file.truncate(0) == 0, "Impossible truncate temporary file"
+                    queue.put_nowait((file, length, k, False))
+                    file = None
                     k += 1
-
-                    self.reset_stats()
+                    downloading = k
+                    update_state()
+                    file = await new_piece()
 
             # has some bytes still to write
             length = file.tell()
             if length != 0:
-                file.flush()
-                await self.upload_file(
-                    dav,
-                    file,
-                    length,
-                    filename=f"{filename}.{(k + 1):0=3}" if pieces != 1 else filename,
-                    title=f"{filename} [Piece #{k}]"
-                    if pieces is None
-                    else f"{filename} [{k}/{pieces}]",
-                )
+                queue.put_nowait((file, length, k, True))
+                file = None
+
+            queue.put_nowait(None)
+            await worker
 
-                assert file.seek(0) == 0, "Impossible seek to start of stream"
-                assert file.truncate(0) == 0, "Impossible truncate temporary file"
+            if len(names) > 1:
+                await self.upload_manifest(dav, filename, names)
+        finally:
+            if file is not None:
+                file.close()
+            if not worker.done():
+                worker.cancel()
+            while not queue.empty():
+                item = queue.get_nowait()
+                if item is not None:
+                    item[0].close()
+
+    async def remote_sizes(self, dav: DavClient) -> dict[str, int]:
+        """Size of the files already in the upload path (one PROPFIND per task)"""
+        if self._remote_sizes is None:
+            try:
+                files = await dav.list(self.webdav_path, get_info=True)
+            except Exception:
+                files = []
+
+            self._remote_sizes = {
+                os.path.basename(x["path"].rstrip("/")): int(x["size"])
+                for x in files
+                if not x.get("isdir") and x.get("size")
+            }
+        return self._remote_sizes
+
+    def piece_key(self, remote_path: str) -> str:
+        return f"{self.webdav_hostname.rstrip('/')}{remote_path}"
+
+    async def verify_piece(
+        self, file: IOBase, offset: int, length: int, remote_path: str
+    ) -> dict | None:
+        """
+        Hash tree of the local piece if it's the one recorded for the remote
+        path (with the recorded algorithm), `None` if it isn't or is unknown
+        """
+        if self.lookup_piece_method is None:
+            return None
+        record = self.lookup_piece_method(self.user, self.piece_key(remote_path))
+        if record is None or record.get("size") != length:
+            return None
+
+        digest = STAGES.open(TreeHashStage, record["algorithm"])
+        try:
+            async for _ in self.read_piece(file, offset, length, digest):
+                pass
+        finally:
+            await digest.close()
+
+        tree = digest.result
+        return tree if tree["root"] == record.get("root") else None
+
+    async def read_piece(
+        self,
+        file: IOBase,
+        offset: int,
+        length: int,
+        digest: StageStream | None = None,
+        progress: Callable[[int, int], None] | None = None,
+        sizer: ChunkSizer | None = None,
+    ) -> AsyncGenerator[bytes, None]:
+        """
+        Read `length` bytes at `offset`, feeding the digest. Regular files are
+        read through an independent slice, any other file is seeked. The
+        chunks are sized by the time that the consumer takes to send them
+        """
+        sizer = sizer or ChunkSizer()
+        fd = file_descriptor(file)
+        if fd is not None:
+            source = FileSlice(fd, offset, length, sizer.size)
+            chunks = source.chunks()
+        else:
+            source = None
+            chunks = self._read_stream(file, offset, length, sizer)
+
+        current = 0
+        start = time.monotonic()
+        async for chunk in chunks:
+            if digest is not None:
+                await digest.feed(chunk)
+            current += len(chunk)
+            if progress is not None:
+                progress(current, length)
+            yield chunk
+
+            # Read, hashed and sent
+            now = time.monotonic()
+            sizer.observe(len(chunk), now - start)
+            start = now
+            if source is not None:
+                source.chunk_size = sizer.size
+
+    async def _read_stream(
+        self, file: IOBase, offset: int, length: int, sizer: ChunkSizer
+    ) -> AsyncGenerator[bytes, None]:
+        pos = (
+            (await file.seek(offset))
+            if isinstance(file, AsyncBufferedIOBase)
+            else file.seek(offset)
+        )
+        assert pos == offset, "Impossible seek stream"
+
+        current = 0
+        while current < length:
+            size = min(length - current, sizer.size)
+            chunk = (
+                await file.read(size)
+                if isinstance(file, AsyncBufferedIOBase)
+                else file.read(size)
+            )
+            if not chunk:
+                break
+            current += len(chunk)
+            yield chunk
 
     async def upload_file(
         self,
@@ -275,32 +927,81 @@ class Service(Task):
         title: str = None,
         description: str = None,
         filename: str = None,
+        track: bool = True,
+        piece: bool = False,
     ) -> None:
-        """Upload a file to webdav. If the file need to split, this split it"""
-        retry_count = 3
-
+        """
+        Upload a file to webdav. If the file need to split, this split it.
+        With `track` off the task state and progress are left to the caller.
+        In parallel mode the pieces of a regular file are uploaded at the
+        same time. With `piece` the file is a piece (named `filename`) of a
+        file split by the caller, it's resumed like the pieces split here
+        """
         split_size = self.split_size if self.split_size > 0 else file_size
         pieces = self.get_pieces_count(file_size)
+        # The pieces of a split file are resumed and their digest recorded
+        split = piece or pieces > 1
 
         filename = filename or os.path.basename(file.name)
         name = utils.sanitaze_filename(filename)
         title = title or name
-        remote_path = os.path.join(self.webdav_path, name)
 
-        for piece in range(pieces):
-            while True:  # Try loop
-                try:
-                    remote_name = f"{name}.{(piece + 1):0=3}" if pieces != 1 else name
-                    remote_path = os.path.join(self.webdav_path, remote_name)
+        # Pieces that landed in the server in a previous submission, never
+        # reused when the user asked to replace the files
+        resume = self.resume and not self.overwrite and split
+        remote = await self.remote_sizes(dav) if resume else dict()
 
-                    pos = (
-                        (await file.seek(piece * split_size))
-                        if isinstance(file, AsyncBufferedIOBase)
-                        else file.seek(piece * split_size)
-                    )
-                    assert pos == piece * split_size, "Impossible seek stream"
-                    length = min(split_size, file_size - pos)
+        concurrent = (
+            self.parallel
+            and self.parallel_uploads > 1
+            and pieces > 1
+            and file_descriptor(file) is not None
+        )
+        sent = [0] * pieces
+        # The pieces sent one after another continue with the same chunk size
+        sizer = ChunkSizer()
+
+        def progress(piece: int) -> Callable[[int, int], None] | None:
+            if not track:
+                return None
+            if not concurrent:
+                return self.make_progress
+
+            def callback(current: int, total: int) -> None:
+                sent[piece] = current
+                self.make_progress(sum(sent), file_size)
+
+            return callback
+
+        async def upload_piece(piece: int) -> None:
+            remote_name = f"{name}.{(piece + 1):0=3}" if pieces != 1 else name
+            remote_path = os.path.join(self.webdav_path, remote_name)
+
+            pos = piece * split_size
+            length = min(split_size, file_size - pos)
+
+            # Landed before a restart or in a previous submission, it's reused
+            # only if it has the content of this piece
+            landed = split and (
+                remote.get(remote_name) == length
+                or remote_name in self.completed_pieces
+            )
+            if landed:
+                tree = await self.verify_piece(file, pos, length, remote_path)
+                if tree is not None:
+                    if self.checksum and tree["algorithm"] == self.checksum_algorithm:
+                        self.trees[remote_name] = tree
+                        self.sums[remote_name] = tree["digest"]
+                    self.checkpoint(remote_name, length)
+                    return
+
+            # A landed piece that doesn't match is replaced
+            retried = landed or remote_name in remote
 
+            async def attempt() -> None:
+                nonlocal retried
+
+                if track and not concurrent:
                     self.set_state(
                         TaskState.WORKING,
                         description=(
@@ -310,52 +1011,144 @@ class Service(Task):
                     )
                     self.reset_stats()
                     self.make_progress(0, length)
-                    await dav.upload_to(
-                        remote_path,
-                        buffer=file,
-                        buffer_size=length,
-                        overwrite=self.overwrite,
-                        progress=self.make_progress,
+                # The digest is computed while the piece is sent, a new
+                # digest is started on every attempt. The pieces are hashed
+                # for the resubmissions even without checksums
+                digest = (
+                    STAGES.open(TreeHashStage, self.checksum_algorithm)
+                    if self.checksum or (split and self.record_piece_method is not None)
+                    else None
+                )
+                try:
+                    sender = self.read_piece(
+                        file,
+                        pos,
+                        length,
+                        digest,
+                        progress(piece),
+                        ChunkSizer(initial=sizer.size) if concurrent else sizer,
                     )
 
-                    if self.checksum:
-                        # Compute the piece checksum
-                        assert (
-                            (await file.seek(piece * split_size))
-                            if isinstance(file, AsyncBufferedIOBase)
-                            else file.seek(piece * split_size)
-                        ) == piece * split_size, "Impossible seek stream"
-                        self.sha1 = SHA1.new()
-
-                        while length > 0:
-                            size = min(length, 65535)
-                            data = (
-                                await file.read(size)
-                                if isinstance(file, AsyncBufferedIOBase)
-                                else file.read(size)
-                            )
-                            self.sha1.update(data)
-                            length -= len(data)
-
-                        self.sums[remote_name] = self.sha1.hexdigest()
-
-                    break
-                except CancelledError:
-                    raise CancelledError
-                except Exception as e:
-                    self.set_state(
-                        TaskState.WORKING,
-                        description=f"{emoji.CLOCKWISE_VERTICAL_ARROWS} Trying again at error: {retry_count} attemps",
+                    # A failed attempt can leave a partial piece, it's replaced
+                    overwrite = self.overwrite or retried
+                    retried = True
+                    # Without overwrite an existing file is kept, that is only
+                    # known to be absent when the upload path was probed
+                    written = overwrite or resume
+
+                    start = time.monotonic()
+                    await dav.upload_to(remote_path, buffer=sender, overwrite=overwrite)
+                    UPLINK.observe(length, time.monotonic() - start)
+
+                    # Not sent (the file already exists), but the checksum
+                    # is still needed
+                    if digest is not None:
+                        async for _ in sender:
+                            pass
+                finally:
+                    if digest is not None:
+                        await digest.close()
+
+                if digest is None:
+                    return
+                if self.checksum:
+                    self.trees[remote_name] = digest.result
+                    self.sums[remote_name] = digest.result["digest"]
+                if written and split and self.record_piece_method is not None:
+                    self.record_piece_method(
+                        self.user,
+                        self.piece_key(remote_path),
+                        {
+                            "size": length,
+                            "algorithm": digest.result["algorithm"],
+                            "root": digest.result["root"],
+                        },
                     )
 
-                    await asyncio.sleep(5)  # Wait
-                    retry_count -= 1
-                    if retry_count < 0:
-                        raise e
+            # Every piece has its own retry budget
+            await self.retry(retry.UPLOAD, attempt, track)
+            self.checkpoint(remote_name, length)
+
+        if not concurrent:
+            for piece in range(pieces):
+                await upload_piece(piece)
+        else:
+            if track:
+                self.set_state(
+                    TaskState.WORKING,
+                    description=(
+                        description
+                        or f"{emoji.HOURGLASS_DONE} Uploading **{title}** ({pieces} pieces, {self.parallel_uploads} at the same time)"
+                    ),
+                )
+                self.reset_stats()
+                self.make_progress(0, file_size)
+            await utils.gather_limited(
+                [upload_piece(piece) for piece in range(pieces)],
+                self.parallel_uploads,
+            )
+
+        if pieces > 1:
+            await self.upload_manifest(
+                dav,
+                filename,
+                [f"{name}.{(piece + 1):0=3}" for piece in range(pieces)],
+            )
+
+    async def upload_manifest(
+        self, dav: DavClient, filename: str, names: list[str]
+    ) -> None:
+        """
+        Upload next to the pieces of a file the hash trees of every piece and
+        the root of the tree over the pieces hashes, to verify only the
+        damaged pieces (and leaves)
+        """
+        if not self.checksum:
+            return
+
+        trees = [self.trees.get(name) for name in names]
+        # Pieces uploaded before a restart don't have their tree
+        complete = all(x is not None for x in trees)
+        root = (
+            merkle_root(
+                self.checksum_algorithm, [bytes.fromhex(x["root"]) for x in trees]
+            ).hex()
+            if complete
+            else None
+        )
+
+        manifest = json.dumps(
+            {
+                "algorithm": self.checksum_algorithm,
+                "root": root,
+                "pieces": [
+                    {"name": name, **tree} if tree is not None else {"name": name}
+                    for name, tree in zip(names, trees)
+                ],
+            },
+            indent=1,
+        ).encode()
+
+        async def sender():
+            yield manifest
+
+        name = utils.sanitaze_filename(f"{filename}.manifest.json")
+        await dav.upload_to(
+            os.path.join(self.webdav_path, name), buffer=sender(), overwrite=True
+        )
+        self.uploaded[name] = len(manifest)
+        # The root isn't the hash of the joined file, it's not reported with
+        # the checksums (the pieces are listed with their plain hashes)
+        if root is not None:
+            self.trees[name] = {"algorithm": self.checksum_algorithm, "root": root}
 
     def clone(self, child=False) -> "Service":
         service = Service(**self.kwargs)
         if self.checksum and child:
             service.sums = self.sums
+            service.trees = self.trees
+        if child:
+            service.uploaded = self.uploaded
+        service._remote_sizes = self._remote_sizes
 
         return service
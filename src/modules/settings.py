@@ -69,18 +69,42 @@ class SettingsModule(Module):
             r"(on|off|true|false)",
             bool,
         ),
+        "pieces-in-flight": (
+            f"{emoji.ROCKET} Pieces in flight",
+            "Write the number of pieces kept while streaming by pieces, the next pieces are downloaded while the previous ones are uploaded (Default: 2)",
+            r"[1-9]\d*",
+            int,
+        ),
+        "parallel-uploads": (
+            f"{emoji.SHUFFLE_TRACKS_BUTTON} Parallel Uploads",
+            "Write the number of pieces uploaded at the same time in parallel mode (Default: 4)",
+            r"[1-9]\d*",
+            int,
+        ),
         "checksum": (
             f"{emoji.UPWARDS_BUTTON} Checksum",
             "Turn on for perform a checksum of the uploaded files (Default: True)",
             r"(on|off|true|false)",
             bool,
         ),
-        # "use-compression": (
-        #     f"{emoji.CARD_FILE_BOX} Compress",
-        #     "Turn on for compress all files with tar.zstd format (Default: False)",
-        #     r"(on|off|true|false)",
-        #     bool,
-        # ),
+        "checksum-algorithm": (
+            f"{emoji.LOCKED_WITH_KEY} Checksum Algorithm",
+            "Write the checksum algorithm: sha1, sha256, blake2b or blake2s. The split files get a manifest with the hash tree of the pieces (Default: sha1)",
+            r"(sha1|sha256|blake2b|blake2s)",
+            str,
+        ),
+        "use-compression": (
+            f"{emoji.CARD_FILE_BOX} Compress",
+            "Turn on for compress the files with zstd (.zst), the level follows the upload speed. The compressed media (videos, images, archives, ...) are uploaded as is (Default: False)",
+            r"(on|off|true|false)",
+            bool,
+        ),
+        "resume-uploads": (
+            f"{emoji.RECYCLING_SYMBOL} Resume Uploads",
+            "Turn on for skip the pieces already uploaded by a previous submission with the same content, the others are replaced. Not used with File Overwrite (Default: True)",
+            r"(on|off|true|false)",
+            bool,
+        ),
         "file-overwrite": (
             f"{emoji.WRITING_HAND} File Overwrite",
             "Turn on overwrite the files in the server (Default: False)",
@@ -89,11 +113,20 @@ class SettingsModule(Module):
         ),
         "file-password": (
             f"{emoji.KEYCAP_ASTERISK} File Password",
-            "Write the password to encrypt all files (Default: Empty)",
+            "Write the password to encrypt all files with AES-GCM (.enc), these are decrypted when downloaded with /list (Default: Empty)",
             r".*",
             str,
         ),
     }
+    # Entries of the "Others settings" page
+    OTHERS = (
+        "pieces-in-flight",
+        "parallel-uploads",
+        "checksum-algorithm",
+        "resume-uploads",
+    )
+    # Values of the users registered before an entry was added
+    DEFAULTS = {"checksum": "true", "resume-uploads": "true"}
 
     def __init__(self, context: UserContext, database: Database) -> None:
         super().__init__(context, database)
@@ -101,6 +134,7 @@ class SettingsModule(Module):
         self.buttons: dict[str, ActionButton] = dict()
         self.close_action = self.factory.create_action("close-action")
         self.others_action = self.factory.create_action("others-action")
+        self.back_action = self.factory.create_action("back-action")
         # self.handlers = []
         self.entries = dict()
 
@@ -113,7 +147,7 @@ class SettingsModule(Module):
 
         if issubclass(cls, bool):
             data = self.database.get_data(user)
-            v = utils.get_bool(data.get(id, False))
+            v = utils.get_bool(data.get(id, SettingsModule.DEFAULTS.get(id, False)))
             return button.button(
                 f"[{emoji.CHECK_MARK_BUTTON if v else emoji.CROSS_MARK}] {name}"
             )
@@ -139,7 +173,7 @@ class SettingsModule(Module):
                     self._get_button(user, "use-libcurl"),
                 ],
                 [
-                    # self._get_button(user, "use-compression"),
+                    self._get_button(user, "use-compression"),
                     self._get_button(user, "checksum"),
                     self._get_button(user, "file-password"),
                 ],
@@ -151,6 +185,21 @@ class SettingsModule(Module):
             ]
         )
 
+    def _get_others_keyboard(self, user: int):
+        return InlineKeyboardMarkup(
+            [
+                [
+                    self._get_button(user, "pieces-in-flight"),
+                    self._get_button(user, "parallel-uploads"),
+                ],
+                [
+                    self._get_button(user, "checksum-algorithm"),
+                    self._get_button(user, "resume-uploads"),
+                ],
+                [self.back_action.button(f"{emoji.LEFT_ARROW} Back")],
+            ]
+        )
+
     async def settings(self, app: Client, message: Message):
         user = message.from_user.id
 
@@ -200,11 +249,15 @@ class SettingsModule(Module):
             )
         else:
             data = self.database.get_data(user)
-            v = utils.get_bool(data.get(id, False))
+            v = utils.get_bool(data.get(id, SettingsModule.DEFAULTS.get(id, False)))
             payload = {id: str((not v))}
             self.database.set_data(user, **payload)
 
-            await callback_query.edit_message_reply_markup(self._get_keyboard(user))
+            await callback_query.edit_message_reply_markup(
+                self._get_others_keyboard(user)
+                if id in SettingsModule.OTHERS
+                else self._get_keyboard(user)
+            )
             await callback_query.answer(f"Setted {caption} to {not v}")
 
     async def close(self, app: Client, callback_query: CallbackQuery):
@@ -214,8 +267,11 @@ class SettingsModule(Module):
 
     async def others_settings(self, app: Client, callback_query: CallbackQuery):
         user = callback_query.from_user.id
+        await callback_query.edit_message_reply_markup(self._get_others_keyboard(user))
 
-        # await callback_query.edit_message_reply_markup(InlineKeyboardMarkup([[self._get_button(None) for x in ]]))
+    async def back(self, app: Client, callback_query: CallbackQuery):
+        user = callback_query.from_user.id
+        await callback_query.edit_message_reply_markup(self._get_keyboard(user))
 
     def register(self, app: Client):
         handlers = [
@@ -226,6 +282,7 @@ class SettingsModule(Module):
             ),
             self.close_action.callback_handler(self.close),
             self.others_action.callback_handler(self.others_settings),
+            self.back_action.callback_handler(self.back),
         ]
 
         for k in SettingsModule.MENU.keys():
@@ -1,5 +1,6 @@
 import asyncio
-from uuid import UUID
+from uuid import UUID, uuid4
+import config
 import utils
 import psutil
 import time
@@ -21,7 +22,9 @@ from context import CONTEXT, UserContext
 from database import Database
 from humanize import naturalsize, naturaldelta
 from module import Module
+from memory import GOVERNOR
 from modules.service import Service
+from storage import STORAGE
 
 # Services
 from services.http import HttpService
@@ -55,7 +58,16 @@ class WebdavModule(Module):
         self.app = None
 
         self.tasks_id: dict[UUID, Task] = dict()
-        self.executor = TaskExecutor()
+        # Run the services in worker loops (multi-loop mode) when is set
+        self.loops = int(config.EXECUTOR_LOOPS)
+        self.executor = TaskExecutor(
+            workers=self.loops or None,
+            resource_limits={
+                k: int(v)
+                for k, v in utils.parse_mapping(config.RESOURCE_LIMITS).items()
+            },
+            gate=GOVERNOR.wait,
+        )
         self.tasks: dict[Task, Message] = dict()
         self.tasks_lock = asyncio.Lock()
         self.factory = ButtonFactory()
@@ -78,7 +90,21 @@ class WebdavModule(Module):
                         user, piece, reply_to_message_id=task.file_message.id
                     )
             case TaskState.SUCCESSFULL:
-                if task.checksum and len(task.sums) > 0:
+                if len(task.deduplicated) > 0:
+                    files = "\n".join(
+                        (
+                            f"**{name}**: copied from `{path}`"
+                            if path is not None
+                            else f"**{name}**: already present"
+                        )
+                        for name, path in task.deduplicated
+                    )
+                    await self.app.send_message(
+                        user,
+                        f"{emoji.CHECK_MARK_BUTTON} Successfull\n\n{emoji.CLIPBOARD} Files already uploaded:\n\n{files}",
+                        reply_to_message_id=task.file_message.id,
+                    )
+                elif task.checksum and len(task.sums) > 0:
                     checksums = "\n".join(
                         [
                             f"**{filename}**: `{checksum}`\n"
@@ -87,7 +113,7 @@ class WebdavModule(Module):
                     )
                     await self.app.send_message(
                         user,
-                        f"{emoji.CHECK_MARK_BUTTON} Successfull\n\n{emoji.INBOX_TRAY} Checksums (SHA1):\n\n{checksums}",
+                        f"{emoji.CHECK_MARK_BUTTON} Successfull\n\n{emoji.INBOX_TRAY} Checksums ({task.checksum_algorithm.upper()}):\n\n{checksums}",
                         reply_to_message_id=task.file_message.id,
                     )
                 else:
@@ -97,6 +123,11 @@ class WebdavModule(Module):
                         reply_to_message_id=task.file_message.id,
                     )
 
+        # Only the tasks interrupted by a restart are resumed, a failed task
+        # is resubmitted by the user (the landed pieces are reused by their
+        # recorded digest)
+        self.database.remove_task(task.journal_id)
+
         async with self.tasks_lock:
             message = self.tasks.pop(task)
             self.tasks_id.pop(task.id)
@@ -115,7 +146,10 @@ class WebdavModule(Module):
 
         async with self.tasks_lock:
             if id in self.tasks_id:
-                self.tasks_id[id].cancel()
+                task = self.tasks_id[id]
+                # Not resumed after a restart, even if it doesn't end before
+                self.database.remove_task(task.journal_id)
+                task.cancel()
 
     async def upload_file(self, app: Client, message: Message):
         user = message.from_user.id
@@ -139,26 +173,51 @@ class WebdavModule(Module):
     ):
         data = self.database.get_data(user)
 
-        # Instantiate task
-        task: Task = cls(
+        # Restored tasks keep their journal (and the pieces already uploaded)
+        journal_id = kwargs.pop("journal_id", None) or str(uuid4())
+
+        options = dict(
             user=user,
             file_message=message,
             pyrogram=app,
             split_size=int(data["split-size"]),
             streaming=utils.get_bool(data["streaming"]),
+            pieces_in_flight=int(data.get("pieces-in-flight", 2)),
             parallel=utils.get_bool(data["upload-parallel"]),
+            parallel_uploads=int(data.get("parallel-uploads", 4)),
             checksum=utils.get_bool(data["checksum"]),
+            checksum_algorithm=data.get("checksum-algorithm", "sha1"),
             overwrite=utils.get_bool(data["file-overwrite"]),
+            resume=utils.get_bool(data.get("resume-uploads", "true")),
+            compression=utils.get_bool(data.get("use-compression", "false")),
+            file_password=data.get("file-password", ""),
             hostname=data["server-uri"],
             username=data["username"],
             password=data["password"],
             path=data["upload-path"],
             push_task_method=self.push_task,  # To allow the services push anothers services call
-            **kwargs,
+            journal_id=journal_id,
+            checkpoint_method=self.database.checkpoint_task,
+            completed_pieces=self.database.get_task_pieces(journal_id),
+            record_piece_method=self.database.record_piece,
+            lookup_piece_method=self.database.lookup_piece,
+            index_method=self.database.index_content,
+            lookup_method=self.database.lookup_content,
+            forget_method=self.database.forget_content,
         )
+        options.update(kwargs)
 
-        # Add the task to the executor
-        self.executor.schedule(task, on_end_callback=self._on_task_end)
+        # Instantiate task
+        task: Task = cls(**options)
+        self.database.add_task(journal_id, task.descriptor())
+
+        # Add the task to the executor (one fair-share queue per user)
+        self.executor.schedule(
+            task,
+            on_end_callback=self._on_task_end,
+            current_thread=self.loops == 0,
+            key=user,
+        )
 
         if task == None:
             await app.send_message(user, f"{emoji.CROSS_MARK} Unable to start task")
@@ -175,6 +234,33 @@ class WebdavModule(Module):
 
             self.tasks_id[task.id] = task
 
+    async def restore(self, app: Client):
+        """Schedule again the tasks interrupted by a restart"""
+        services = {cls.__name__: cls for cls in WebdavModule.SERVICES}
+
+        for journal_id, descriptor in self.database.get_tasks().items():
+            cls = services.get(descriptor["service"])
+            user = descriptor["user"]
+
+            try:
+                message = await app.get_messages(
+                    descriptor["chat"], descriptor["message"]
+                )
+                if cls is None or message is None or message.empty:
+                    raise ValueError("The task can't be restored")
+            except Exception:
+                self.database.remove_task(journal_id)
+                continue
+
+            await app.send_message(
+                user,
+                f"{emoji.CLOCKWISE_VERTICAL_ARROWS} Resuming task",
+                reply_to_message_id=message.id,
+            )
+            await self.push_task(
+                app, user, cls, message, journal_id=journal_id, **descriptor["kwargs"]
+            )
+
     async def _updater(self):
         async with self.tasks_lock:
             for task, message in self.tasks.items():
@@ -220,11 +306,26 @@ class WebdavModule(Module):
                 # Walk to task childs (1 depth level)
                 childs = task.childs()
                 if len(childs) > 0:
-                    text += "\n\n"
+                    # Totals of the whole tree, kept up to date by the childs
+                    c, t = task.childs_progress
+                    speed = task.childs_speed
+                    states = ", ".join(
+                        f"{n} {s.name.lower()}" for s, n in task.childs_states().items()
+                    )
+                    speed_text = (
+                        utils.get_str(naturalsize(speed, binary=True))
+                        if speed is not None
+                        else "Unknown"
+                    )
+                    text += (
+                        f"\n\nOverall: {naturalsize(c, binary=True, format='%.3f')}"
+                        f" / {naturalsize(t, binary=True, format='%.3f')}"
+                        f" ({speed_text}/sec)\n{states}\n\n"
+                    )
 
                     for child in childs:
                         s, d = child.state
-                        c, t = task.progress
+                        c, t = child.progress
                         c_text = (
                             naturalsize(c, binary=True, format="%.3f")
                             if c is not None
@@ -241,7 +342,11 @@ class WebdavModule(Module):
                                 e = emoji.RED_CIRCLE
                             case TaskState.SUCCESSFULL:
                                 e = emoji.GREEN_CIRCLE
-                            case TaskState.WORKING | TaskState.WAITING | TaskState.STARTING:
+                            case (
+                                TaskState.WORKING
+                                | TaskState.WAITING
+                                | TaskState.STARTING
+                            ):
                                 e = emoji.YELLOW_CIRCLE
 
                         text += f"{e} {d} [{c_text} / {t_text}]\n"
@@ -266,8 +371,42 @@ class WebdavModule(Module):
 
         active = self.executor.active_count
         total = self.executor.total_count
+        stats = self.executor.stats()
+        lags = await self.executor.loops_lag()
+
+        def states(x: dict[str, int]) -> str:
+            return ", ".join(f"{n} {s.lower()}" for s, n in x.items()) or "0"
+
+        wait = self.executor.admission_wait
+        wait_p50, wait_p95 = wait.quantile(0.5), wait.quantile(0.95)
+        wait_text = (
+            f"p50 < {wait_p50:.2f}s, p95 < {wait_p95:.2f}s"
+            if wait_p50 is not None
+            else "Unknown"
+        )
+        lag_text = ", ".join(
+            f"{name} {lag * 1000:.1f}ms" if lag is not None else f"{name} blocked"
+            for name, lag in lags.items()
+        )
+
+        classes_text = ""
+        for name in stats["classes"]:
+            cs = self.executor.class_stats(name)
+            duration = cs.duration.quantile(0.5)
+            speed = cs.throughput.mean
+            classes_text += (
+                f"\n• {name}: {cs.duration.count} done, "
+                f"p50 < {naturaldelta(duration) if duration is not None else 'Unknown'}"
+                f", {utils.get_str(naturalsize(speed, binary=True)) + '/sec' if speed is not None else 'Unknown'}"
+            )
+
+        resources_text = ", ".join(
+            f"{r} {stats['resources'].get(r, 0)}/{l}"
+            for r, l in stats["limits"].items()
+        )
 
         memory = psutil.virtual_memory()
+        paused = GOVERNOR.paused  # Samples the memory of the bot
         disk = psutil.disk_usage("/")
 
         me = psutil.Process()
@@ -279,9 +418,18 @@ class WebdavModule(Module):
             f"{emoji.ELECTRIC_PLUG} CPU: {psutil.cpu_count()} cores\n"
             f"{emoji.BATTERY} RAM: {naturalsize(memory.used)} used of {naturalsize(memory.total)} [{memory.percent}%]\n"
             f"{emoji.FILE_FOLDER} Disk: {naturalsize(disk.used)} used of {naturalsize(disk.total)}\n"
+            f"{emoji.BRAIN} Bot memory: {naturalsize(GOVERNOR.rss)} of {naturalsize(GOVERNOR.limit)}, {naturalsize(GOVERNOR.buffered)} buffered{' [paused]' if paused else ''}\n"
+            f"{emoji.CARD_FILE_BOX} Temporary storage: {naturalsize(STORAGE.reserved)} reserved of {naturalsize(STORAGE.budget)}, {STORAGE.waiting} waiting\n"
             "\n"
             f"{emoji.YELLOW_CIRCLE} Active tasks: {active}\n"
-            f"{emoji.BLUE_CIRCLE} Total tasks: {total}",
+            f"{emoji.BLUE_CIRCLE} Total tasks: {total}\n"
+            "\n"
+            f"{emoji.HOURGLASS_NOT_DONE} Queued: {states(stats['queued'])}\n"
+            f"{emoji.GEAR} Running: {states(stats['running'])}\n"
+            f"{emoji.TIMER_CLOCK} Admission wait: {wait_text}\n"
+            f"{emoji.HIGH_VOLTAGE} Loops lag: {lag_text}\n"
+            f"{emoji.BAR_CHART} Resources: {resources_text or 'None'}"
+            f"{classes_text}",
         )
 
     def register(self, app: Client):
@@ -0,0 +1,208 @@
+import asyncio
+import random
+import time
+from email.utils import parsedate_to_datetime
+from enum import Enum
+from threading import Lock
+from typing import Awaitable, Callable, TypeVar
+from urllib.parse import urlsplit
+
+import aiohttp
+from aiodav.exceptions import (
+    CertificateNotValid,
+    ConnectionException,
+    MethodNotSupported,
+    NoConnection,
+    NotConnection,
+    NotEnoughSpace,
+    NotFound,
+    OptionNotValid,
+    ResponseErrorCode,
+)
+
+T = TypeVar("T")
+
+
+class ErrorClass(Enum):
+    RETRYABLE = 0  # Transient, try again after a backoff
+    THROTTLED = 1  # The server asks to slow down, wait what it says
+    FATAL = 2  # Will fail again, don't retry
+
+
+# HTTP status that can succeed later
+RETRYABLE_STATUS = {408, 425, 500, 502, 504}
+THROTTLED_STATUS = {429, 503}
+
+
+def parse_retry_after(value: str | None) -> float | None:
+    """Seconds of a `Retry-After` header (delay in seconds or a HTTP date)"""
+    if value is None:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return float(value)
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class RetryAfterHints(object):
+    """
+    `Retry-After` of the last throttled response of every host. The WebDAV
+    client errors don't carry the response headers, these are taken by a
+    trace of the session (see `trace_config`)
+    """
+
+    def __init__(self) -> None:
+        self._lock = Lock()
+        self._hints: dict[str, float] = dict()
+
+    def set(self, host: str, seconds: float) -> None:
+        with self._lock:
+            self._hints[host] = seconds
+
+    def pop(self, host: str | None) -> float | None:
+        with self._lock:
+            return self._hints.pop(host, None)
+
+    def trace_config(self) -> aiohttp.TraceConfig:
+        async def on_request_end(session, context, params) -> None:
+            response = params.response
+            if response.status in THROTTLED_STATUS:
+                seconds = parse_retry_after(response.headers.get("Retry-After"))
+                if seconds is not None:
+                    self.set(response.url.host, seconds)
+
+        trace = aiohttp.TraceConfig()
+        trace.on_request_end.append(on_request_end)
+        return trace
+
+
+RETRY_AFTER = RetryAfterHints()
+
+
+def classify_status(status: int) -> ErrorClass:
+    if status in THROTTLED_STATUS:
+        return ErrorClass.THROTTLED
+    if status in RETRYABLE_STATUS or status >= 500:
+        return ErrorClass.RETRYABLE
+    return ErrorClass.FATAL
+
+
+def classify(error: BaseException) -> tuple[ErrorClass, float | None]:
+    """Class of the error and the delay asked by the server, if any"""
+    if isinstance(error, aiohttp.ClientResponseError):
+        retry_after = (
+            parse_retry_after(error.headers.get("Retry-After"))
+            if error.headers is not None
+            else None
+        )
+        return classify_status(error.status), retry_after
+
+    if isinstance(error, ConnectionException) and isinstance(
+        error.exception, Exception
+    ):
+        return classify(error.exception)
+
+    if isinstance(error, ResponseErrorCode):
+        return classify_status(error.code), RETRY_AFTER.pop(
+            urlsplit(error.url).hostname
+        )
+
+    if isinstance(
+        error,
+        (
+            NotEnoughSpace,
+            NotFound,
+            MethodNotSupported,
+            OptionNotValid,
+            CertificateNotValid,
+            aiohttp.InvalidURL,
+        ),
+    ):
+        return ErrorClass.FATAL, None
+
+    if isinstance(
+        error,
+        (
+            NoConnection,
+            NotConnection,
+            ConnectionException,
+            aiohttp.ClientError,
+            asyncio.TimeoutError,
+            ConnectionError,
+        ),
+    ):
+        return ErrorClass.RETRYABLE, None
+
+    # Unknown errors were always retried, keep doing it
+    return ErrorClass.RETRYABLE, None
+
+
+class RetryPolicy(object):
+    """
+    Retry budget of one operation. The retryable errors wait an exponential
+    backoff with full jitter and count against `attempts`, the throttled
+    errors wait the delay asked by the server (or the backoff) and only
+    count against `budget`, the maximum seconds waited by the operation
+    """
+
+    def __init__(
+        self,
+        attempts: int = 5,
+        base: float = 1.0,
+        cap: float = 30.0,
+        budget: float = 300.0,
+    ) -> None:
+        self.attempts = attempts
+        self.base = base
+        self.cap = cap
+        self.budget = budget
+
+    def backoff(self, attempt: int) -> float:
+        return random.uniform(0, min(self.cap, self.base * 2**attempt))
+
+    async def run(
+        self,
+        operation: Callable[[], Awaitable[T]],
+        on_retry: Callable[[int, Exception, float], None] | None = None,
+    ) -> T:
+        """Await `operation()` until it succeeds or the budget is spent"""
+        failures = 0
+        waited = 0.0
+        throttles = 0
+
+        while True:
+            try:
+                return await operation()
+            except Exception as e:
+                kind, retry_after = classify(e)
+                if kind == ErrorClass.FATAL:
+                    raise
+
+                if kind == ErrorClass.THROTTLED:
+                    throttles += 1
+                    delay = (
+                        retry_after + random.uniform(0, self.base)
+                        if retry_after is not None
+                        else max(self.base, self.backoff(throttles))
+                    )
+                else:
+                    failures += 1
+                    if failures >= self.attempts:
+                        raise
+                    delay = self.backoff(failures)
+
+                if waited + delay > self.budget:
+                    raise
+                waited += delay
+
+                if on_retry is not None:
+                    on_retry(failures + throttles, e, delay)
+                await asyncio.sleep(delay)
+
+
+# Budgets of the operations
+UPLOAD = RetryPolicy(attempts=6, base=1.0, cap=30.0, budget=600.0)  # A DAV piece
+REQUEST = RetryPolicy(attempts=5, base=0.5, cap=15.0, budget=120.0)  # A source request
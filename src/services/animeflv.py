@@ -4,7 +4,6 @@ import aiofiles
 import tempfile
 
 from animeflv import AnimeFLV
-from aiodav.client import Client as DavClient
 from pyrogram import emoji
 from async_executor.task import TaskState
 from modules.service import Service
@@ -32,13 +31,7 @@ class AnimeFLVService(Service):
         self.set_state(TaskState.STARTING)
         url = urlparse(self.kwargs.get("url", self.file_message.text)).path
 
-        async with DavClient(
-            hostname=self.webdav_hostname,
-            login=self.webdav_username,
-            password=self.webdav_password,
-            timeout=self.timeout,
-            chunk_size=2097152,
-        ) as dav:
+        async with self.open_dav() as dav:
             with AnimeFLV() as api:
                 fmt, desc = url.split("/")
 
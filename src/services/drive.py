@@ -1,6 +1,5 @@
 import os
 import re
-import tempfile
 import time
 import gdown
 import aiofiles
@@ -8,10 +7,12 @@ from async_executor.task import TaskState
 from modules.service import Service
 from pyrogram import emoji
 from pyrogram.types import Message
-from aiodav.client import Client as DavClient
 
 
 class DriveService(Service):
+    RESOURCE_CLASS = "drive"
+    RESOURCE_LIMIT = 2
+
     def __init__(self, *args, **kwargs) -> None:
         super().__init__(*args, **kwargs)
 
@@ -24,14 +25,8 @@ class DriveService(Service):
     async def start(self) -> None:
         self.set_state(TaskState.STARTING)
 
-        async with DavClient(
-            hostname=self.webdav_hostname,
-            login=self.webdav_username,
-            password=self.webdav_password,
-            timeout=self.timeout,
-            chunk_size=2097152,
-        ) as dav:
-            with tempfile.TemporaryDirectory() as directory:
+        async with self.open_dav() as dav:
+            async with self.scratch() as directory:
                 link = self.kwargs.get("url", self.file_message.text)
 
                 self.reset_stats()
@@ -47,4 +42,4 @@ class DriveService(Service):
 
                 async with aiofiles.open(output, "rb") as file:
                     size = os.path.getsize(path)
-                    await self.upload_file(dav, file, size)
+                    await self.send_file(dav, file, size)
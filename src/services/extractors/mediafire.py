@@ -14,7 +14,7 @@ class MediafireExtractor(object):
 
     @staticmethod
     async def get_url(session: ClientSession, url: str) -> str:
-        async with session.get(url) as response:
+        async with session.get(url, raise_for_status=True) as response:
             page = BeautifulSoup(await response.text(), "lxml")
             info = page.find("a", {"aria-label": "Download file"})
 
@@ -1,6 +1,5 @@
 import asyncio
 import re
-import tempfile
 import os
 import utils
 import aiofiles
@@ -9,10 +8,12 @@ from async_executor.task import TaskState
 from modules.service import Service
 from pyrogram import emoji
 from pyrogram.types import Message
-from aiodav.client import Client as DavClient
 
 
 class GitService(Service):
+    RESOURCE_CLASS = "git"
+    RESOURCE_LIMIT = 1
+
     def __init__(self, *args, **kwargs) -> None:
         super().__init__(*args, **kwargs)
 
@@ -28,13 +29,7 @@ class GitService(Service):
     async def start(self) -> None:
         self.set_state(TaskState.STARTING)
 
-        async with DavClient(
-            hostname=self.webdav_hostname,
-            login=self.webdav_username,
-            password=self.webdav_password,
-            timeout=self.timeout,
-            chunk_size=2097152,
-        ) as dav:
+        async with self.open_dav() as dav:
             url = self.kwargs.get("url", self.file_message.text)
             filename = os.path.basename(url).removesuffix(".git")
 
@@ -43,7 +38,7 @@ class GitService(Service):
                 description=f"{emoji.HOURGLASS_DONE} Cloning the repository",
             )
 
-            with tempfile.TemporaryDirectory() as directory:
+            async with self.scratch() as directory:
                 path = os.path.join(directory, "repo")
 
                 # Cloning the repository
@@ -64,6 +59,6 @@ class GitService(Service):
 
                 file_size = os.path.getsize(f"{path}.tar")
                 async with aiofiles.open(f"{path}.tar", "rb") as file:
-                    await self.upload_file(
+                    await self.send_file(
                         dav, file, file_size, filename=f"{filename}.tar"
                     )
@@ -1,8 +1,10 @@
-import aiohttp
+import functools
 import os
 import re
+import retry
 
-from aiodav.client import Client as DavClient
+from chunking import ChunkSizer
+from coalesce import FlightHandle, url_key
 from async_executor.task import TaskState
 from modules.service import Service
 from pyrogram import emoji
@@ -20,6 +22,9 @@ class HttpService(Service):
     Download web file and upload to webdav
     """
 
+    RESOURCE_CLASS = "http"
+    RESOURCE_LIMIT = 8
+
     EXTRACTORS: list[Extractor] = [
         # AnimeFLVExtractor,
         # ZippyshareExtractor,
@@ -40,47 +45,89 @@ class HttpService(Service):
 
     async def start(self) -> None:
         self.set_state(TaskState.STARTING)
+        link = self.kwargs.get("url", self.file_message.text)
 
-        async with DavClient(
-            hostname=self.webdav_hostname,
-            login=self.webdav_username,
-            password=self.webdav_password,
-            timeout=self.timeout,
-            chunk_size=2097152,
-        ) as dav:
-            async with aiohttp.ClientSession() as session:
-                url = self.kwargs.get("url", self.file_message.text)
-
-                for e in HttpService.EXTRACTORS:
-                    if e.check(url):
-                        url = await e.get_url(session, url)
-
-                        # Try to execute extractor own method,
-                        # else invoke default http downloader
-                        try:
-                            await e.execute(session, url, **self.kwargs)
-                            return
-                        except NotImplementedError:
-                            pass
-                        except Exception as e:
-                            raise e
-
-                        break
-
-                async with session.get(url) as response:
-                    try:
-                        d = response.headers["content-disposition"]
-                        filename = re.findall("filename=(.+)", d)[0].split(";")[0]
-                    except Exception:
-                        req = urlparse(url)
-                        filename = os.path.basename(req.path)
-
-                    gen = response.content.iter_chunked(2097152)
-                    await self.upload(
-                        dav,
-                        filename,
-                        response.content_length,
-                        gen,
+        async with self.open_dav() as dav:
+
+            async def fetch(flight: FlightHandle) -> None:
+                url = link
+                if not flight.leader:
+                    # Another task is downloading the same URL
+                    self.set_state(
+                        TaskState.WORKING,
+                        description=f"{emoji.HOURGLASS_DONE} Waiting the download",
                     )
+                    filename, size, source = await flight.result()
+                    async with self.content_index(dav, source) as hit:
+                        if hit:
+                            return None
+                        if await flight.shared():
+                            await self.upload(dav, filename, size, flight.replay())
+                            return None
+                    # The leader doesn't share the stream, it's downloaded again
+
+                async with self.open_session() as session:
+                    for e in HttpService.EXTRACTORS:
+                        if e.check(url):
+                            url = await self.retry(
+                                retry.REQUEST,
+                                functools.partial(e.get_url, session, url),
+                            )
+
+                            # Try to execute extractor own method,
+                            # else invoke default http downloader
+                            try:
+                                await e.execute(session, url, **self.kwargs)
+                                return
+                            except NotImplementedError:
+                                pass
+                            except Exception as e:
+                                raise e
+
+                            break
+
+                    # Only the request is retried, the body is streamed to the server
+                    response = await self.retry(
+                        retry.REQUEST,
+                        functools.partial(session.get, url, raise_for_status=True),
+                    )
+                    async with response:
+                        try:
+                            d = response.headers["content-disposition"]
+                            filename = re.findall("filename=(.+)", d)[0].split(";")[0]
+                        except Exception:
+                            req = urlparse(url)
+                            filename = os.path.basename(req.path)
+
+                        # The same entity of the server, known before read the body
+                        etag = response.headers.get("ETag")
+                        source = (
+                            f"http:{url_key(url)}:{etag}:{response.content_length}"
+                            if etag is not None
+                            and not etag.startswith("W/")  # Not byte for byte
+                            and response.content_length is not None
+                            else None
+                        )
+
+                        if flight.leader:
+                            flight.set_result(
+                                (filename, response.content_length, source)
+                            )
+                        async with self.content_index(dav, source) as hit:
+                            if hit:
+                                # The files were copied in the server of this task,
+                                # the followers can't replay them
+                                if flight.leader:
+                                    flight.unshare()
+                                return None
+
+                            gen = ChunkSizer().iter_stream(response.content)
+                            if flight.leader:
+                                gen = flight.tee(gen, response.content_length)
+                            await self.upload(
+                                dav, filename, response.content_length, gen
+                            )
+
+            await self.coalesced(url_key(link), fetch)
 
         return None
@@ -1,10 +1,9 @@
 import re
 import os
 import aiofiles
-import tempfile
 
 from aiomega import Mega
-from aiodav.client import Client as DavClient
+from coalesce import FlightHandle, url_key
 from pyrogram import emoji
 from async_executor.task import TaskState
 from modules.service import Service
@@ -16,6 +15,9 @@ class MegaService(Service):
     Download Mega file and upload to webdav
     """
 
+    RESOURCE_CLASS = "mega"
+    RESOURCE_LIMIT = 2
+
     def __init__(self, *args, **kwargs) -> None:
         super().__init__(*args, **kwargs)
 
@@ -25,38 +27,51 @@ class MegaService(Service):
 
     async def start(self) -> None:
         self.set_state(TaskState.STARTING)
+        link = self.kwargs.get("url", self.file_message.text)
+
+        async with self.open_dav() as dav:
+
+            async def fetch(flight: FlightHandle) -> None:
+                if flight.leader:
+                    async with Mega("ox8xnQZL") as mega:
+                        node = await mega.get_public_node(link)
+                        if not node.isFile():
+                            raise Exception("Only can download files")
+
+                        async def progress(c, t, s):
+                            self.make_progress(c, t, speed=s)
 
-        async with DavClient(
-            hostname=self.webdav_hostname,
-            login=self.webdav_username,
-            password=self.webdav_password,
-            timeout=self.timeout,
-            chunk_size=2097152,
-        ) as dav:
-            with tempfile.TemporaryDirectory() as directory:
-                async with Mega("ox8xnQZL") as mega:
-                    link = self.kwargs.get("url", self.file_message.text)
-                    node = await mega.get_public_node(link)
-                    if not node.isFile():
-                        raise Exception("Only can download files")
-
-                    async def progress(c, t, s):
-                        self.make_progress(c, t, speed=s)
-
-                    self.reset_stats()
-                    filename = node.getName()
-                    size = node.getSize()
+                        self.reset_stats()
+                        filename = node.getName()
+                        size = node.getSize()
+                        self.set_state(
+                            TaskState.WORKING,
+                            description=f"{emoji.HOURGLASS_DONE} Download {filename}",
+                        )
+
+                        # The downloaded file is kept in the flight directory until
+                        # the last task uploading it finish
+                        await flight.reserve(size)
+                        directory = flight.directory
+
+                        # Fix bug
+                        directory = (
+                            f"{directory}/" if directory[-1] != "/" else directory
+                        )
+                        await mega.download(node, directory, progress=progress)
+                    flight.set_result((filename, size))
+                else:
                     self.set_state(
                         TaskState.WORKING,
-                        description=f"{emoji.HOURGLASS_DONE} Download {filename}",
+                        description=f"{emoji.HOURGLASS_DONE} Waiting the download",
                     )
+                    filename, size = await flight.result()
 
-                    # Fix bug
-                    directory = f"{directory}/" if directory[-1] != "/" else directory
-                    await mega.download(node, directory, progress=progress)
-
-                path = os.path.join(directory, filename)
+                path = os.path.join(flight.directory, filename)
                 async with aiofiles.open(path, "rb") as file:
-                    await self.upload_file(dav, file, size)
+                    await self.send_file(dav, file, size)
+
+            # The node and its key are in the fragment
+            await self.coalesced(url_key(link, fragment=True), fetch)
 
         return None
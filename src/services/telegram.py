@@ -1,6 +1,6 @@
 from datetime import datetime as dt
-from aiodav.client import Client as DavClient
 from async_executor.task import TaskState
+from coalesce import FlightHandle
 from modules.service import Service
 from pyrogram import emoji
 from pyrogram.types import Message
@@ -11,6 +11,9 @@ class TelegramService(Service):
     Download telegram file and upload to webdav
     """
 
+    RESOURCE_CLASS = "telegram"
+    RESOURCE_LIMIT = 4
+
     def __init__(self, *args, **kwargs) -> None:
         super().__init__(*args, **kwargs)
 
@@ -18,7 +21,7 @@ class TelegramService(Service):
     def check(m: Message):
         return bool(m.document) | bool(m.photo) | bool(m.video) | bool(m.audio)
 
-    def __get_file_name(message: Message) -> tuple[str, int]:
+    def __get_file_name(message: Message) -> tuple[str, int, str]:
         available_media = (
             "audio",
             "document",
@@ -42,32 +45,45 @@ class TelegramService(Service):
         else:
             media = message
 
-        return (getattr(media, "file_name", None), getattr(media, "file_size", None))
+        return (
+            getattr(media, "file_name", None),
+            getattr(media, "file_size", None),
+            getattr(media, "file_unique_id", None),
+        )
 
     async def start(self) -> None:
         self.set_state(TaskState.STARTING)
-        filename, total_bytes = TelegramService.__get_file_name(self.file_message)
+        filename, total_bytes, unique_id = TelegramService.__get_file_name(
+            self.file_message
+        )
 
         if filename is None:
             filename = f"file-{str(dt.now()).replace(' ', '-')}"
 
-        async with DavClient(
-            hostname=self.webdav_hostname,
-            login=self.webdav_username,
-            password=self.webdav_password,
-            timeout=self.timeout,
-            chunk_size=2097152,
-        ) as dav:
-
-            async def gen():
-                async for chunk in self.pyrogram.stream_media(self.file_message):
-                    yield chunk
-
-            await self.upload(
-                dav,
-                filename,
-                total_bytes,
-                gen(),
-            )
+        # The same file forwarded by several users shares the unique ID
+        key = f"telegram:{unique_id}" if unique_id is not None else None
+
+        async with self.open_dav() as dav, self.content_index(dav, key) as hit:
+            if hit:
+                return None
+
+            async def fetch(flight: FlightHandle) -> None:
+                if not flight.leader and await flight.shared():
+                    await self.upload(dav, filename, total_bytes, flight.replay())
+                    return None
+
+                async def gen():
+                    async for chunk in self.pyrogram.stream_media(self.file_message):
+                        yield chunk
+
+                # A follower of a stream that isn't shared downloads it by itself
+                await self.upload(
+                    dav,
+                    filename,
+                    total_bytes,
+                    flight.tee(gen(), total_bytes) if flight.leader else gen(),
+                )
+
+            await self.coalesced(key, fetch)
 
         return None
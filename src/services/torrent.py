@@ -5,8 +5,8 @@ import aiofiles
 
 import aria2p
 import dialogs
-from aiodav.client import Client as DavClient
 from async_executor.task import TaskState
+from coalesce import FlightHandle
 from modules.service import Service
 from pyrogram import emoji
 from pyrogram.types import Message
@@ -19,6 +19,9 @@ class TorrentService(Service):
     Download web file and upload to webdav
     """
 
+    RESOURCE_CLASS = "torrent"
+    RESOURCE_LIMIT = 2
+
     # yapf: disable
     def __init__(
         self,
@@ -55,21 +58,24 @@ class TorrentService(Service):
                     break
             torrent_path = os.path.join(DATA_FOLDER_PATH, f"{d.info_hash}.torrent")
         else:
-            torrent_path = await self.file_message.download(DATA_FOLDER_PATH)
+            torrent_path = await self.call_home(
+                self.file_message.download, DATA_FOLDER_PATH
+            )
 
 
         d = aria2.add_torrent(torrent_path,
                               options={'dry-run': 'true'})
 
         app = self.pyrogram
-        files = await dialogs.selection(
+        files = await self.call_home(
+            dialogs.selection,
             app,
             self.user,
             options=d.files,
             description='**Select files to download**',
             name_selector=lambda x: os.path.basename(x.path))
 
-        return torrent_path, d.info_hash, [p.index for p in files]
+        return torrent_path, d.info_hash, {p.index: p.length for p in files}
 
     async def start(self) -> None:
         aria2 = aria2p.API(aria2p.Client(host="http://127.0.0.1"))
@@ -78,40 +84,56 @@ class TorrentService(Service):
         torrent_path, info_hash, files = await self.options(aria2)       
 
         self.set_state(TaskState.STARTING)
-        download = aria2.add_torrent(torrent_path, options={'select-file': ",".join(map(str, files))})
-
-        # Wait for download complete
-        self.set_state(TaskState.WORKING,
-                        description=
-                        f"{emoji.HOURGLASS_DONE} Download torrent"
-        )
-        self.reset_stats()
-            
-        while not download.is_complete and download.status != "error":
-            await asyncio.sleep(3)
-            download.update()
-            self.make_progress(download.completed_length, 
-                                download.total_length, 
-                                speed=download.download_speed,
-                                eta=download.eta.seconds)
-
-        self.set_state(TaskState.WAITING, description=f"{emoji.HOURGLASS_DONE} Files successfull downloaded")
-
-        if download.status != 'complete':
-            raise Exception(f"{download.status}: {download.error_message}")
-        
-
-        async with DavClient(hostname=self.webdav_hostname,
-                            login=self.webdav_username,
-                            password=self.webdav_password,
-                            timeout=self.timeout,
-                            chunk_size=2097152) as dav:
-            for file in download.files:
-                if file.is_metadata or not file.selected:
-                    continue
+
+        # The files already uploaded are copied in the server instead
+        source = lambda index: f"btih:{info_hash.lower()}:{index}"
+        async with self.open_dav() as dav:
+            files = {index: length for index, length in files.items()
+                        if not await self.find_indexed(dav, source(index))}
+        if len(files) == 0:
+            return None
+
+        key = (f"btih:{info_hash.lower()}", tuple(sorted(files)))
+
+        async def fetch(flight: FlightHandle) -> None:
+            if flight.leader:
+                # Saved in the flight directory, removed once every task uploaded them
+                await flight.reserve(sum(files.values()))
+                download = aria2.add_torrent(torrent_path, options={'select-file': ",".join(map(str, files)),
+                                                                    'dir': flight.directory})
+
+                # Wait for download complete
+                self.set_state(TaskState.WORKING,
+                                description=
+                                f"{emoji.HOURGLASS_DONE} Download torrent"
+                )
+                self.reset_stats()
                     
-                async with aiofiles.open(file.path, 'rb') as f:
-                    await self.upload_file(dav, f, file.length)
-                os.unlink(file.path) # Delete file
+                while not download.is_complete and download.status != "error":
+                    await asyncio.sleep(3)
+                    download.update()
+                    self.make_progress(download.completed_length, 
+                                        download.total_length, 
+                                        speed=download.download_speed,
+                                        eta=download.eta.seconds)
+
+                self.set_state(TaskState.WAITING, description=f"{emoji.HOURGLASS_DONE} Files successfull downloaded")
+
+                if download.status != 'complete':
+                    raise Exception(f"{download.status}: {download.error_message}")
+
+                paths = [(str(file.path), file.length, file.index) for file in download.files 
+                            if not file.is_metadata and file.selected]
+                flight.set_result(paths)
+            else:
+                self.set_state(TaskState.WORKING, description=f"{emoji.HOURGLASS_DONE} Waiting the torrent download")
+                paths = await flight.result()
+
+            async with self.open_dav() as dav:
+                for path, length, index in paths:
+                    async with self.content_index(dav, source(index)), aiofiles.open(path, 'rb') as f:
+                        await self.send_file(dav, f, length)
+
+        await self.coalesced(key, fetch)
 
         return None
@@ -1,19 +1,23 @@
+import functools
 import os
 import re
-import tempfile
+import retry
 from urllib.parse import urlparse
-import aiohttp
 import aiofiles
 import utils
 
 from async_executor.task import TaskState
+from chunking import ChunkSizer
+from memory import GOVERNOR
 from modules.service import Service
 from pyrogram import emoji
 from pyrogram.types import Message
-from aiodav.client import Client as DavClient
 
 
 class URLBatchService(Service):
+    RESOURCE_CLASS = "batch"
+    RESOURCE_LIMIT = 2
+
     def __init__(self, *args, **kwargs) -> None:
         super().__init__(*args, **kwargs)
 
@@ -24,16 +28,22 @@ class URLBatchService(Service):
     async def start(self) -> None:
         self.set_state(TaskState.STARTING)
 
-        with await self.file_message.download(in_memory=True) as file:
+        # The list is downloaded in memory
+        await GOVERNOR.wait()
+        with await self.call_home(self.file_message.download, in_memory=True) as file:
             urls = file.readlines()
             urls = list(
                 set([url.decode() for url in urls if re.match(rb"^https?://", url)])
             )
 
-        with tempfile.TemporaryDirectory() as directory:
-            async with aiohttp.ClientSession() as session:
-                for url in urls:
-                    async with session.get(url) as response:
+        async with self.scratch() as scratch:
+            directory = os.path.join(scratch, "files")
+            os.mkdir(directory)
+
+            async with self.open_session() as session:
+
+                async def download(url: str) -> None:
+                    async with session.get(url, raise_for_status=True) as response:
                         try:
                             d = response.headers["content-disposition"]
                             filename = re.findall("filename=(.+)", d)[0].split(";")[0]
@@ -46,39 +56,38 @@ class URLBatchService(Service):
                             description=f"{emoji.HOURGLASS_DONE} Downloading {filename}",
                         )
 
-                        # Download file
+                        # Download file, a retry writes it again
                         async with aiofiles.open(
                             os.path.join(directory, filename), "wb"
                         ) as f:
-                            async for chunk in response.content.iter_chunked(2097152):
+                            async for chunk in GOVERNOR.governed(
+                                ChunkSizer().iter_stream(response.content)
+                            ):
                                 await f.write(chunk)
 
+                for url in urls:
+                    await self.retry(retry.REQUEST, functools.partial(download, url))
+
             # Compress files with tar
-            with tempfile.NamedTemporaryFile() as tar:
-                self.set_state(
-                    TaskState.WORKING,
-                    description=f"{emoji.HOURGLASS_DONE} Compressing the repository",
-                )
+            tar = os.path.join(scratch, "batch.tar")
+            self.set_state(
+                TaskState.WORKING,
+                description=f"{emoji.HOURGLASS_DONE} Compressing the repository",
+            )
 
-                await utils.execute_process(
-                    "tar",
-                    "-cf",
-                    tar.name,
-                    ".",
-                    cwd=directory,
-                )
+            await utils.execute_process(
+                "tar",
+                "-cf",
+                tar,
+                ".",
+                cwd=directory,
+            )
 
-                # Upload file to WebDAV
-                async with DavClient(
-                    hostname=self.webdav_hostname,
-                    login=self.webdav_username,
-                    password=self.webdav_password,
-                    timeout=self.timeout,
-                    chunk_size=2097152,
-                ) as dav:
-                    await self.upload_file(
-                        dav,
-                        tar,
-                        os.path.getsize(tar.name),
-                        filename=f"batch-{self.file_message.id}.tar",
-                    )
+            # Upload file to WebDAV
+            async with self.open_dav() as dav, aiofiles.open(tar, "rb") as file:
+                await self.send_file(
+                    dav,
+                    file,
+                    os.path.getsize(tar),
+                    filename=f"batch-{self.file_message.id}.tar",
+                )
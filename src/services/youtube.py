@@ -5,12 +5,11 @@ import yt_dlp
 import functools
 from asyncio.exceptions import CancelledError
 
-from aiodav.client import Client as DavClient
-
 from pyrogram import emoji
 from pyrogram.types import Message
 
 import dialogs
+from coalesce import FlightHandle, url_key
 from async_executor.task import TaskState
 from modules.service import Service
 from humanize import naturalsize
@@ -21,6 +20,9 @@ class YoutubeService(Service):
     Download web file and upload to webdav
     """
 
+    RESOURCE_CLASS = "youtube"
+    RESOURCE_LIMIT = 2
+
     # yapf: disable
     def __init__(
         self,
@@ -49,7 +51,8 @@ class YoutubeService(Service):
             formats = meta.get('formats', [meta]) # Filter no-audio streams
 
             app = self.pyrogram
-            format = await dialogs.selection(
+            format = await self.call_home(
+                dialogs.selection,
                 app,
                 self.user,
                 options=formats,
@@ -61,57 +64,60 @@ class YoutubeService(Service):
             return format    
 
     async def start(self) -> None:        
-        try:
-            # Chosen video format
-            format = await self.options()
-            if format is None:
-                raise CancelledError
-
-            self.set_state(TaskState.STARTING)
-
-            def progress_wrapper(d):                   
-                self.make_progress(d.get('downloaded_bytes', None), 
-                                    d.get('total_bytes', None), 
-                                    speed=d.get('speed', None), 
-                                    eta=d.get('eta', None))
-
-            options = {
-                'format': f"{format['format_id']}+bestaudio",
-                'quiet': True,
-                'noplaylist' : True,
-                'writesubtitles': True,
-                'allsubtitles': True,
-                'progress_hooks': [progress_wrapper]
-            }
-            
-            with yt_dlp.YoutubeDL(options) as ydl:  
-                self.set_state(TaskState.WORKING, description=f"{emoji.HOURGLASS_DONE} Downloading video")
-                self.reset_stats()
-
-                loop = asyncio.get_running_loop()
-                link = self.kwargs.get('url', self.file_message.text)
-                meta = await loop.run_in_executor(None, 
-                    functools.partial(ydl.extract_info, link, download=True))               
-                filename = ydl.prepare_filename(meta)
-
-            # Check if changed format
-            if not os.path.exists(filename):
-                filename, _ = os.path.splitext(filename)
-                filename = filename + '.mkv'
-
-            async with DavClient(hostname=self.webdav_hostname,
-                                login=self.webdav_username,
-                                password=self.webdav_password,
-                                timeout=self.timeout,
-                                chunk_size=2097152) as dav:
+        # Chosen video format
+        format = await self.options()
+        if format is None:
+            raise CancelledError
+
+        self.set_state(TaskState.STARTING)
+        link = self.kwargs.get('url', self.file_message.text)
+
+        async def fetch(flight: FlightHandle) -> None:
+            if flight.leader:
+                # The size of the video, with room for the audio
+                size = format.get('filesize') or format.get('filesize_approx')
+                await flight.reserve(int(size * 1.2) if size else None)
+
+                def progress_wrapper(d):                   
+                    self.make_progress(d.get('downloaded_bytes', None), 
+                                        d.get('total_bytes', None), 
+                                        speed=d.get('speed', None), 
+                                        eta=d.get('eta', None))
+
+                options = {
+                    'format': f"{format['format_id']}+bestaudio",
+                    'quiet': True,
+                    'noplaylist' : True,
+                    'writesubtitles': True,
+                    'allsubtitles': True,
+                    'progress_hooks': [progress_wrapper],
+                    # Removed with the flight, once every task uploaded it
+                    'paths': {'home': flight.directory},
+                }
+                
+                with yt_dlp.YoutubeDL(options) as ydl:  
+                    self.set_state(TaskState.WORKING, description=f"{emoji.HOURGLASS_DONE} Downloading video")
+                    self.reset_stats()
+
+                    loop = asyncio.get_running_loop()
+                    meta = await loop.run_in_executor(None, 
+                        functools.partial(ydl.extract_info, link, download=True))               
+                    filename = ydl.prepare_filename(meta)
+
+                # Check if changed format
+                if not os.path.exists(filename):
+                    filename, _ = os.path.splitext(filename)
+                    filename = filename + '.mkv'
+                title = meta['title']
+                flight.set_result((filename, title))
+            else:
+                self.set_state(TaskState.WORKING, description=f"{emoji.HOURGLASS_DONE} Waiting the download")
+                filename, title = await flight.result()
+
+            async with self.open_dav() as dav:
                 async with aiofiles.open(filename, 'rb') as file:
-                    await self.upload_file(dav, file, os.path.getsize(filename), title=meta['title'])
-        except Exception as e:
-            raise e
-        finally:
-            try:
-                os.unlink(filename) # Delete file
-            except Exception:
-                pass
+                    await self.send_file(dav, file, os.path.getsize(filename), title=title)
+
+        await self.coalesced((url_key(link), format['format_id']), fetch)
 
         return None
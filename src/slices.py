@@ -0,0 +1,97 @@
+import io
+import mmap
+import os
+import stat
+from typing import AsyncGenerator
+
+
+def file_descriptor(file) -> int | None:
+    """Descriptor of `file` if it's a regular file, these can be sliced"""
+    try:
+        fd = file.fileno()
+    except (AttributeError, OSError, io.UnsupportedOperation):
+        return None
+    if not isinstance(fd, int) or not stat.S_ISREG(os.fstat(fd).st_mode):
+        return None
+    return fd
+
+
+class FileSlice(object):
+    """
+    Read-only view of `length` bytes at `offset` of a file. The slices are
+    independent of the file position, so many slices of the same file can be
+    read at the same time. The range is memory mapped and the chunks are
+    views of the mapping (no copies), the kernel reads ahead the next chunks.
+
+    If the file can't be mapped the chunks are read with `os.pread`. The
+    `chunk_size` can be changed while the chunks are read.
+    """
+
+    def __init__(self, fd: int, offset: int, length: int, chunk_size: int) -> None:
+        self.fd = fd
+        self.offset = offset
+        self.length = length
+        self.chunk_size = chunk_size
+        self._map: mmap.mmap | None = None
+        self._skip = 0
+
+    def _open(self) -> memoryview | None:
+        # The mapping must start at a multiple of the allocation granularity
+        start = self.offset - self.offset % mmap.ALLOCATIONGRANULARITY
+        self._skip = self.offset - start
+        try:
+            self._map = mmap.mmap(
+                self.fd,
+                self._skip + self.length,
+                offset=start,
+                access=mmap.ACCESS_READ,
+            )
+        except (OSError, ValueError):
+            return None
+
+        if hasattr(self._map, "madvise"):
+            self._map.madvise(mmap.MADV_SEQUENTIAL)
+        return memoryview(self._map)[self._skip :]
+
+    def close(self) -> None:
+        if self._map is not None:
+            try:
+                self._map.close()
+            except BufferError:  # Some chunk is still referenced, left to the GC
+                pass
+            self._map = None
+
+    async def chunks(self) -> AsyncGenerator[memoryview | bytes, None]:
+        if self.length <= 0:
+            return
+
+        view = self._open()
+        try:
+            start = 0
+            while start < self.length:
+                # The chunk size can be changed between chunks
+                end = min(start + self.chunk_size, self.length)
+                if view is not None:
+                    if hasattr(self._map, "madvise") and end < self.length:
+                        # Ask the kernel for the next chunk while this is sent
+                        position = self._skip + end
+                        aligned = position - position % mmap.PAGESIZE
+                        self._map.madvise(
+                            mmap.MADV_WILLNEED,
+                            aligned,
+                            position
+                            - aligned
+                            + min(self.chunk_size, self.length - end),
+                        )
+                    yield view[start:end]
+                else:
+                    chunk = os.pread(self.fd, end - start, self.offset + start)
+                    if not chunk:
+                        break
+                    end = start + len(chunk)
+                    yield chunk
+                start = end
+        finally:
+            if view is not None:
+                view.release()
+            self.close()
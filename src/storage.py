@@ -0,0 +1,303 @@
+import asyncio
+import io
+import os
+import shutil
+import tempfile
+from threading import Lock
+
+import config
+
+# Reservation of the files with unknown size
+UNKNOWN_SIZE = 1073741824
+
+# Fraction of the free space of every location that can be reserved
+DISK_SHARE = 0.9
+TMPFS_SHARE = 0.5
+
+# Max wait of a spill file for its turn in the queue
+SPILL_TIMEOUT = 60.0
+
+
+class StorageError(Exception):
+    """The temporary storage can't hold the requested size"""
+
+
+def filesystem_type(path: str) -> str | None:
+    """Type of the filesystem mounted at `path` (from /proc/mounts)"""
+    path = os.path.realpath(path)
+    found, kind = "", None
+    try:
+        with open("/proc/mounts") as mounts:
+            for line in mounts:
+                parts = line.split()
+                if len(parts) < 3:
+                    continue
+                mountpoint = parts[1]
+                if (
+                    path == mountpoint or path.startswith(mountpoint.rstrip("/") + "/")
+                ) and len(mountpoint) > len(found):
+                    found, kind = mountpoint, parts[2]
+    except OSError:
+        return None
+    return kind
+
+
+class Location(object):
+    """Directory for the temporary files, in memory (tmpfs) or in disk"""
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.memory = filesystem_type(path) in ("tmpfs", "ramfs")
+        share = TMPFS_SHARE if self.memory else DISK_SHARE
+        self.capacity = int(shutil.disk_usage(path).free * share)
+        self.reserved = 0
+
+    def fits(self, size: int) -> bool:
+        return (
+            self.reserved + size <= self.capacity
+            and shutil.disk_usage(self.path).free >= size
+        )
+
+
+class ReservedFile(io.FileIO):
+    """Raw temporary file that returns its reservation when it's closed"""
+
+    def __init__(self, fd: int, reservation: "Reservation") -> None:
+        super().__init__(fd, "r+b")
+        self._reservation = reservation
+
+    def close(self) -> None:
+        try:
+            super().close()
+        finally:
+            if self._reservation is not None:
+                self._reservation.release()
+                self._reservation = None
+
+
+def preallocate(fd: int, size: int) -> None:
+    """Allocate the blocks of the file now, it can't run out of space later"""
+    if size <= 0 or not hasattr(os, "posix_fallocate"):
+        return
+    try:
+        os.posix_fallocate(fd, 0, size)
+    except OSError as e:
+        if e.errno not in (95, 22):  # EOPNOTSUPP, EINVAL: not supported here
+            raise
+
+
+class Reservation(object):
+    """Space reserved in a location, returned with `release`"""
+
+    def __init__(
+        self, storage: "TempStorage", location: Location, size: int, known: bool
+    ) -> None:
+        self.storage = storage
+        self.location = location
+        self.size = size
+        self.preallocate = known  # An estimated size isn't allocated
+        self._directory: str | None = None
+        self._released = False
+
+    @property
+    def directory(self) -> str:
+        """Private directory in the location, removed on release"""
+        if self._directory is None:
+            self._directory = tempfile.mkdtemp(
+                prefix="scratch-", dir=self.location.path
+            )
+        return self._directory
+
+    def temporary_file(self) -> io.BufferedRandom:
+        """Anonymous preallocated file, closing it releases the reservation"""
+        fd, path = tempfile.mkstemp(dir=self.location.path)
+        os.unlink(path)
+        try:
+            if self.preallocate:
+                preallocate(fd, self.size)
+        except BaseException:
+            os.close(fd)
+            raise
+        return io.BufferedRandom(ReservedFile(fd, self))
+
+    def create(self, name: str) -> io.BufferedRandom:
+        """Preallocated file in the directory, truncate it to the written size"""
+        file = open(os.path.join(self.directory, name), "w+b")
+        if self.preallocate:
+            preallocate(file.fileno(), self.size)
+        return file
+
+    def release(self) -> None:
+        if self._released:
+            return
+        self._released = True
+        if self._directory is not None:
+            shutil.rmtree(self._directory, ignore_errors=True)
+        self.storage._release(self)
+
+    async def __aenter__(self) -> "Reservation":
+        return self
+
+    async def __aexit__(self, *args) -> None:
+        self.release()
+
+
+def _wake(future: asyncio.Future) -> None:
+    if not future.done():
+        future.set_result(None)
+
+
+class _Waiter(object):
+    def __init__(self, loop: asyncio.AbstractEventLoop) -> None:
+        self.loop = loop
+        self.future = loop.create_future()
+
+    def wake(self) -> None:
+        self.loop.call_soon_threadsafe(_wake, self.future)
+
+
+class TempStorage(object):
+    """
+    Byte budget of the temporary files of all the tasks. The tasks reserve
+    the size of their files before download them and wait in order while the
+    budget or the locations are full, so a full disk slows down the tasks
+    instead of failing them. Every reservation is placed in the fastest
+    location with room: the memory ones only take the small files.
+
+    The tasks can run in different event loops.
+    """
+
+    def __init__(
+        self, paths: list[str], budget: int = 0, memory_file_size: int = 0
+    ) -> None:
+        self.locations = [Location(x) for x in paths if os.path.isdir(x)]
+        if len(self.locations) == 0:
+            self.locations = [Location(tempfile.gettempdir())]
+        # Fastest first
+        self.locations.sort(key=lambda x: not x.memory)
+
+        capacity = sum(x.capacity for x in self.locations)
+        self.budget = min(budget, capacity) if budget > 0 else capacity
+        self.memory_file_size = memory_file_size
+
+        self._lock = Lock()
+        self._reserved = 0
+        self._waiters: list[_Waiter] = []
+
+    @property
+    def reserved(self) -> int:
+        with self._lock:
+            return self._reserved
+
+    @property
+    def waiting(self) -> int:
+        with self._lock:
+            return len(self._waiters)
+
+    def _place(self, size: int, known: bool) -> Location | None:
+        # WARNING: Must be called with the lock held
+        if self._reserved + size > self.budget:
+            return None
+        for location in self.locations:
+            if location.memory and (not known or size > self.memory_file_size):
+                continue
+            if location.fits(size):
+                return location
+        return None
+
+    def try_reserve(self, size: int | None) -> Reservation | None:
+        """Reserve `size` bytes now, `None` if they don't fit or others wait"""
+        known = size is not None
+        size = size if known else min(UNKNOWN_SIZE, self.budget // 4)
+        with self._lock:
+            if len(self._waiters) > 0:
+                return None
+            location = self._place(size, known)
+            if location is None:
+                return None
+            location.reserved += size
+            self._reserved += size
+            return Reservation(self, location, size, known)
+
+    async def spill(self, timeout: float = SPILL_TIMEOUT) -> io.BufferedRandom:
+        """
+        Temporary file of unknown size for data that can't wait long (e.g. a
+        memory buffer that overflows). It waits its turn like the other
+        reservations, but it fails after `timeout` seconds without room
+        """
+        try:
+            reservation = await asyncio.wait_for(self.reserve(None), timeout)
+        except asyncio.TimeoutError:
+            raise StorageError("There isn't temporary storage for the file")
+        try:
+            return reservation.temporary_file()
+        except BaseException:
+            reservation.release()
+            raise
+
+    async def reserve(self, size: int | None) -> Reservation:
+        """Wait until `size` bytes (`None` if unknown) can be reserved"""
+        known = size is not None
+        size = size if known else min(UNKNOWN_SIZE, self.budget // 4)
+        if size > max(x.capacity for x in self.locations) or size > self.budget:
+            raise StorageError(f"There isn't temporary storage for {size} bytes")
+
+        waiter = None
+        try:
+            while True:
+                with self._lock:
+                    # First come, first served
+                    if len(self._waiters) == 0 or self._waiters[0] is waiter:
+                        location = self._place(size, known)
+                        if location is not None:
+                            if waiter is not None:
+                                self._waiters.pop(0)
+                                self._notify()
+                            location.reserved += size
+                            self._reserved += size
+                            return Reservation(self, location, size, known)
+
+                    if waiter is None:
+                        waiter = _Waiter(asyncio.get_running_loop())
+                        self._waiters.append(waiter)
+                    elif waiter.future.done():
+                        waiter.future = waiter.loop.create_future()
+                    future = waiter.future
+
+                # Woken by a release, or polled if other processes free space
+                try:
+                    await asyncio.wait_for(asyncio.shield(future), 5)
+                except asyncio.TimeoutError:
+                    pass
+        except BaseException:
+            with self._lock:
+                if waiter in self._waiters:
+                    self._waiters.remove(waiter)
+                    self._notify()
+            raise
+
+    def _notify(self) -> None:
+        # WARNING: Must be called with the lock held
+        if len(self._waiters) > 0:
+            self._waiters[0].wake()
+
+    def _release(self, reservation: Reservation) -> None:
+        with self._lock:
+            reservation.location.reserved -= reservation.size
+            self._reserved -= reservation.size
+            self._notify()
+
+
+def _paths() -> list[str]:
+    if config.TEMP_DIRS != "":
+        return [x.strip() for x in config.TEMP_DIRS.split(",") if x.strip() != ""]
+    # A tmpfs is opt-in: its files are memory that the governor doesn't see
+    return [tempfile.gettempdir()]
+
+
+# Temporary storage shared by all the tasks
+STORAGE = TempStorage(
+    _paths(),
+    int(config.TEMP_BUDGET) * 1024 * 1024,
+    int(config.TMPFS_FILE_SIZE) * 1024 * 1024,
+)
@@ -2,7 +2,7 @@ import re
 import itertools
 import asyncio
 import time
-from typing import Any, Callable, Iterator, TypeVar
+from typing import Any, Callable, Coroutine, Iterator, TypeVar
 
 
 EMOJI_PATTERN = re.compile(
@@ -53,6 +53,21 @@ def get_bool(x: str) -> bool:
     raise ValueError("Impossible convert from this string to bool")
 
 
+def parse_mapping(x: str) -> dict[str, str]:
+    # Format: `key=value,key=value`
+    ret = dict()
+    for item in x.split(","):
+        item = item.strip()
+        if item == "":
+            continue
+
+        key, sep, value = item.partition("=")
+        if sep == "":
+            raise ValueError(f"Invalid mapping item: {item}")
+        ret[key.strip()] = value.strip()
+    return ret
+
+
 def cut(x: str, length: int) -> list[str]:
     ret = []
     while x is not None and x != "":
@@ -108,6 +123,33 @@ async def execute_process(
         )
 
 
+async def gather_limited(coros: list[Coroutine], limit: int) -> list[Any]:
+    """
+    Await the coroutines with at most `limit` running at the same time. At
+    the first error the others are cancelled and the error raised
+    """
+    results = [None] * len(coros)
+    pending = iter(enumerate(coros))
+
+    async def worker() -> None:
+        for index, coro in pending:
+            results[index] = await coro
+
+    workers = [asyncio.ensure_future(worker()) for _ in range(min(limit, len(coros)))]
+    try:
+        if len(workers) > 0:
+            done, _ = await asyncio.wait(workers, return_when=asyncio.FIRST_EXCEPTION)
+            for task in done:
+                task.result()
+    finally:
+        for task in workers:
+            task.cancel()
+        for _, coro in pending:  # Never started
+            coro.close()
+
+    return results
+
+
 X = TypeVar("X")
 
 
@@ -0,0 +1,214 @@
+"""
+Scheduling overhead of the async_executor. Run from the repository root:
+
+    python test/executor_benchmark.py [--sizes 1000,10000,100000] [--sleep 0.001]
+
+For every case reports the scheduling latency (time spent inside
+`TaskExecutor.schedule`), the completion-callback latency (end of the task
+body to the `on_end_callback` call), the memory allocated per scheduled task
+and the throughput (tasks completed per second).
+"""
+
+import argparse
+import asyncio
+import gc
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src")
+)
+
+from async_executor.executor import TaskExecutor
+from async_executor.task import Task
+
+
+class NoopTask(Task):
+    async def start(self) -> None:
+        self.ended_at = time.perf_counter()
+
+
+class SleepTask(Task):
+    def __init__(self, delay: float, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self.delay = delay
+
+    async def start(self) -> None:
+        await asyncio.sleep(self.delay)
+        self.ended_at = time.perf_counter()
+
+
+class TreeTask(Task):
+    """Fan out `fanout` childs per level up to `depth` levels"""
+
+    def __init__(self, depth: int, fanout: int, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self.depth = depth
+        self.fanout = fanout
+
+    async def start(self) -> None:
+        if self.depth > 0:
+            for _ in range(self.fanout):
+                self.schedule_child(TreeTask(self.depth - 1, self.fanout))
+            await self.wait_for_childs()
+        self.ended_at = time.perf_counter()
+
+
+def percentiles(values: list[float]) -> str:
+    if len(values) == 0:
+        return "n/a"
+    values = sorted(values)
+    p = lambda q: values[min(len(values) - 1, int(q * len(values)))] * 1e6
+    return f"p50 {p(0.5):8.1f}us  p99 {p(0.99):8.1f}us  max {values[-1] * 1e6:9.1f}us"
+
+
+async def run_flat(
+    factory,
+    count: int,
+    current_thread: bool,
+    max_tasks: int,
+    workers: int,
+    trace: bool = False,
+) -> dict:
+    executor = TaskExecutor(max_tasks=max_tasks, workers=workers)
+    done = asyncio.Event()
+    callback_latency: list[float] = []
+    schedule_latency: list[float] = []
+    finished = 0
+
+    def on_end(task: Task) -> None:
+        nonlocal finished
+        ended_at = getattr(task, "ended_at", None)
+        if ended_at is not None:
+            callback_latency.append(time.perf_counter() - ended_at)
+        finished += 1
+        if finished == count:
+            done.set()
+
+    gc.collect()
+    if trace:
+        tracemalloc.start()
+        base, _ = tracemalloc.get_traced_memory()
+
+    start = time.perf_counter()
+    for _ in range(count):
+        task = factory()
+        t0 = time.perf_counter()
+        executor.schedule(task, on_end, current_thread=current_thread)
+        schedule_latency.append(time.perf_counter() - t0)
+
+    memory = None
+    if trace:
+        memory, _ = tracemalloc.get_traced_memory()
+        memory = (memory - base) / count
+        tracemalloc.stop()
+
+    await done.wait()
+    elapsed = time.perf_counter() - start
+    executor.shutdown()
+
+    return {
+        "schedule": schedule_latency,
+        "callback": callback_latency,
+        "memory": memory,
+        "throughput": count / elapsed,
+        "elapsed": elapsed,
+    }
+
+
+async def run_tree(
+    depth: int, fanout: int, current_thread: bool, max_tasks: int, workers: int
+) -> dict:
+    executor = TaskExecutor(max_tasks=max_tasks, workers=workers)
+    done = asyncio.Event()
+    nodes = sum(fanout**i for i in range(depth + 1))
+
+    gc.collect()
+    tracemalloc.start()
+    base, _ = tracemalloc.get_traced_memory()
+
+    start = time.perf_counter()
+    t0 = time.perf_counter()
+    executor.schedule(
+        TreeTask(depth, fanout), lambda t: done.set(), current_thread=current_thread
+    )
+    schedule_latency = [time.perf_counter() - t0]
+
+    await done.wait()
+    elapsed = time.perf_counter() - start
+    _, peak_memory = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    executor.shutdown()
+
+    return {
+        "schedule": schedule_latency,
+        "callback": [],
+        "memory": (peak_memory - base) / nodes,
+        "throughput": nodes / elapsed,
+        "elapsed": elapsed,
+        "nodes": nodes,
+    }
+
+
+async def measure_flat(factory, count: int, *args) -> dict:
+    # tracemalloc slows down the allocations, the memory is measured apart
+    result = await run_flat(factory, count, *args)
+    traced = await run_flat(factory, min(count, 10000), *args, trace=True)
+    result["memory"] = traced["memory"]
+    return result
+
+
+def report(name: str, result: dict) -> None:
+    print(
+        f"{name}\n"
+        f"    schedule  {percentiles(result['schedule'])}\n"
+        f"    callback  {percentiles(result['callback'])}\n"
+        f"    memory    {result['memory']:10.0f} B/task\n"
+        f"    throughput {result['throughput']:9.0f} tasks/sec ({result['elapsed']:.2f}s)"
+    )
+
+
+async def main(args: argparse.Namespace) -> None:
+    sizes = [int(x) for x in args.sizes.split(",")]
+
+    for current_thread in (True, False):
+        mode = "current_thread" if current_thread else "worker loops"
+
+        for size in sizes:
+            report(
+                f"noop  x{size:<7} [{mode}]",
+                await measure_flat(
+                    NoopTask, size, current_thread, args.max_tasks, args.workers
+                ),
+            )
+            report(
+                f"sleep x{size:<7} [{mode}]",
+                await measure_flat(
+                    lambda: SleepTask(args.sleep),
+                    size,
+                    current_thread,
+                    args.max_tasks,
+                    args.workers,
+                ),
+            )
+
+        for depth, fanout in ((args.depth, 2), (3, args.fanout)):
+            # The whole tree must fit in the executor, every parent holds a slot
+            nodes = sum(fanout**i for i in range(depth + 1))
+            result = await run_tree(depth, fanout, current_thread, nodes, args.workers)
+            report(
+                f"tree  depth {depth} fanout {fanout} ({nodes} tasks) [{mode}]", result
+            )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--sizes", default="1000,10000,100000")
+    parser.add_argument("--sleep", type=float, default=0.001)
+    parser.add_argument("--max-tasks", type=int, default=10)
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--depth", type=int, default=10)
+    parser.add_argument("--fanout", type=int, default=20)
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,145 @@
+"""
+Resume of the split uploads after a restart, against an in-memory WebDAV
+server. Run from the repository root:
+
+    python test/resume.py
+
+The task is uploaded once, then restored from its journal (the completed
+pieces) and uploaded again: the pieces that landed are verified with their
+recorded digest and aren't sent again. Every transfer mode is checked (the
+whole file is downloaded, streamed or uploaded by parallel pieces).
+"""
+
+import asyncio
+import functools
+import os
+import sys
+from contextlib import asynccontextmanager
+from types import SimpleNamespace
+
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src")
+)
+os.environ.setdefault("STAGE_WORKERS", "0")
+
+from async_executor.executor import TaskExecutor
+from modules.service import Service
+
+MiB = 1024 * 1024
+
+
+class MemoryDav(object):
+    """The calls of `aiodav.Client` used by the uploads"""
+
+    def __init__(self) -> None:
+        self.files: dict[str, bytes] = dict()
+        self.puts: list[str] = []
+
+    async def list(self, path: str, get_info: bool = False) -> list:
+        return [
+            {"path": name, "size": str(len(data)), "isdir": False}
+            for name, data in self.files.items()
+            if os.path.dirname(name) == path.rstrip("/")
+        ]
+
+    async def upload_to(self, path: str, buffer, overwrite: bool = False) -> None:
+        if path in self.files and not overwrite:
+            return
+        self.puts.append(os.path.basename(path))
+        self.files[path] = b"".join([bytes(x) async for x in buffer])
+
+
+class Journal(object):
+    """Completed pieces of the task and digests of the pieces of the user"""
+
+    def __init__(self) -> None:
+        self.completed: dict[str, int] = dict()
+        self.pieces: dict[tuple[int, str], dict] = dict()
+
+    def kwargs(self) -> dict:
+        return {
+            "user": 1,
+            "file_message": SimpleNamespace(_client=None),
+            "hostname": "http://localhost",
+            "path": "/files",
+            "split_size": 1,  # MiB
+            "checksum": True,
+            "journal_id": "task",
+            "checkpoint_method": lambda _, name, size: self.completed.update(
+                {name: size}
+            ),
+            "completed_pieces": list(self.completed),
+            "record_piece_method": lambda user, key, entry: self.pieces.update(
+                {(user, key): entry}
+            ),
+            "lookup_piece_method": lambda user, key: self.pieces.get((user, key)),
+        }
+
+
+async def source(data: bytes):
+    for offset in range(0, len(data), 256 * 1024):
+        yield data[offset : offset + 256 * 1024]
+
+
+async def upload(dav: MemoryDav, journal: Journal, data: bytes, **kwargs) -> None:
+    """Upload `data` as the task would do it, in an executor"""
+    service = Service(**kwargs, **journal.kwargs())
+    service.start = functools.partial(
+        service.upload, dav, "f.bin", len(data), source(data)
+    )
+
+    ended = asyncio.get_running_loop().create_future()
+    executor = TaskExecutor(workers=1)
+    executor.schedule(service, ended.set_result)
+    await ended
+    executor.shutdown()
+
+    state, description = service.state
+    assert state.name == "SUCCESSFULL", description
+
+
+async def restored_task_skips_landed_pieces(**kwargs) -> None:
+    data = os.urandom(3 * MiB)
+    dav, journal = MemoryDav(), Journal()
+
+    # The children of the parallel uploads open their own client
+    @asynccontextmanager
+    async def open_dav(self):
+        yield dav
+
+    Service.open_dav = open_dav
+
+    await upload(dav, journal, data, **kwargs)
+    assert sorted(dav.puts) == [
+        "f.bin.001",
+        "f.bin.002",
+        "f.bin.003",
+        "f.bin.manifest.json",
+    ], dav.puts
+    assert len(journal.pieces) == 3, journal.pieces
+
+    # Restored after a restart, the source is downloaded again
+    dav.puts.clear()
+    await upload(dav, journal, data, **kwargs)
+    assert dav.puts == ["f.bin.manifest.json"], dav.puts
+
+    # A piece with other content is replaced
+    dav.puts.clear()
+    other = data[: 2 * MiB] + os.urandom(MiB)
+    await upload(dav, journal, other, **kwargs)
+    assert dav.puts == ["f.bin.003", "f.bin.manifest.json"], dav.puts
+    assert dav.files["/files/f.bin.003"] == other[2 * MiB :]
+
+
+async def main() -> None:
+    for mode, kwargs in (
+        ("copy", {}),
+        ("streaming", {"streaming": True}),
+        ("parallel", {"parallel": True, "parallel_uploads": 2}),
+    ):
+        await restored_task_skips_landed_pieces(**kwargs)
+        print(f"restored task skips landed pieces ({mode}): ok")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())